@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Activity-adaptive encoding of the cameras
+ * ffmpeg writes a tiny grayscale frame (PGM) every few seconds from the decoded video
+ * frame differencing (NumPy if installed) scores the activity of the scene
+ * a policy with hysteresis switches the camera between the 'active' and the
+   'idle' (lower framerate/bitrate) rendition profile
+ * the switch replaces ffmpeg right after a segment was completed; the stopped ffmpeg
+   closes the segment being encoded (a short one) and the stream pauses for the RTSP
+   reconnect and the encoder warm-up, a state is therefore kept for at least min_dwell seconds
+"""
+
+import os
+import re
+import time
+import logging
+
+try:
+    import numpy
+except ImportError:
+    # pure python differencing, fast enough for the default 64 pixel wide frames
+    numpy = None
+
+from transcoding_observer import TranscodingObserver
+
+ACTIVE = 'active'
+IDLE   = 'idle'
+PGM_HEADER = re.compile(rb'P5\s+(\d+)\s+(\d+)\s+(\d+)\s')
+
+
+def read_pgm(filename):
+    """Returns (width, height, pixels) of a binary 8 bit PGM (P5) image"""
+    with open(str(filename), 'rb') as f:
+        data = f.read()
+    # header: P5 <width> <height> <maxval> and a single whitespace, comments are not written by ffmpeg
+    header = PGM_HEADER.match(data)
+    if header is None or int(header.group(3)) > 255:
+        raise ValueError('Not an 8 bit binary PGM: %s' % (filename))
+    width, height = int(header.group(1)), int(header.group(2))
+    pixels = data[header.end():header.end() + width * height]
+    if len(pixels) != width * height:
+        raise ValueError('Truncated PGM: %s' % (filename))
+    return width, height, pixels
+
+def activity_score(previous, current, pixel_threshold=12):
+    """Fraction of the pixels that changed by more than pixel_threshold
+
+    The change of the mean brightness (lights, IR switch, auto exposure) is
+    subtracted first, so it does not count as activity.
+    """
+    if numpy is not None:
+        a = numpy.frombuffer(previous, dtype=numpy.uint8).astype(numpy.int16)
+        b = numpy.frombuffer(current, dtype=numpy.uint8).astype(numpy.int16)
+        diff = b - a
+        diff -= int(round(diff.mean()))
+        return float(numpy.count_nonzero(numpy.abs(diff) > pixel_threshold)) / diff.size
+    offset = int(round((sum(current) - sum(previous)) / float(len(current))))
+    changed = sum(1 for x,y in zip(previous, current) if abs(y - x - offset) > pixel_threshold)
+    return changed / float(len(current))
+
+
+class ActivityPolicy(object):
+    """
+    Hysteresis between the active and the idle state
+
+     * a score >= threshold is activity, it switches an idle camera to active
+       after active_samples consecutive samples
+     * an active camera stays active while the score is >= idle_threshold
+       (lower than threshold), it becomes idle idle_after seconds later
+     * every state is kept for at least min_dwell seconds, a flickering scene
+       does not replace the process over and over
+    """
+    def __init__(self, threshold=0.02, idle_threshold=None, idle_after=300, active_samples=1,
+                 min_dwell=60, state=ACTIVE, now=None):
+        now = time.monotonic() if now is None else now
+        self.threshold = threshold
+        self.idle_threshold = threshold / 2.0 if idle_threshold is None else idle_threshold
+        self.idle_after = idle_after
+        self.active_samples = active_samples
+        self.min_dwell = min_dwell
+        self.state = state
+        self._since = now
+        self._last_activity = now
+        self._consecutive = 0
+
+    def update(self, score, now=None):
+        """Feeds a score, returns the new state if it changed, None otherwise"""
+        now = time.monotonic() if now is None else now
+        dwelled = now - self._since >= self.min_dwell
+        if self.state == IDLE:
+            self._consecutive = self._consecutive + 1 if score >= self.threshold else 0
+            if self._consecutive >= self.active_samples and dwelled:
+                self.state = ACTIVE
+                self._since = self._last_activity = now
+                self._consecutive = 0
+                return ACTIVE
+            return None
+        if score >= self.idle_threshold:
+            self._last_activity = now
+        elif now - self._last_activity >= self.idle_after and dwelled:
+            self.state = IDLE
+            self._since = now
+            return IDLE
+        return None
+
+
+class ActivityMonitor(TranscodingObserver):
+    """
+    Observer that adapts the encoding of the processes with an activity file
+
+    It is notified when ffmpeg wrote a variant playlist, i.e. a segment was
+    completed. New activity frames are scored, a changed state switches the
+    process factory (setActivity) and replaces the process (respawn).
+    """
+    def __init__(self, cam_id, events=None):
+        self._cam_id = cam_id
+        self._events = events
+        # process factory -> [ActivityPolicy, pixels of the last frame, mtime, last score]
+        self._factories = dict()
+        self.switches = 0
+
+    def _state(self, factory):
+        state = self._factories.get(factory)
+        if state is None:
+            cfg = factory.activity
+            # starts in the state of the factory, e.g. restored from an adopted process
+            policy = ActivityPolicy(cfg.get('threshold', 0.02), cfg.get('idle_threshold'),
+                                    cfg.get('idle_after', 300), cfg.get('active_samples', 1),
+                                    cfg.get('min_dwell', 60), IDLE if factory.idle else ACTIVE)
+            state = self._factories[factory] = [ policy, None, None, None ]
+        return state
+
+    def update(self, s):
+        for idx,factory in enumerate(s.process_descriptors):
+            if not factory.activityFile():
+                continue
+            state = self._state(factory)
+            try:
+                mtime = os.stat(str(factory.activityFile())).st_mtime
+                if mtime == state[2]:
+                    continue
+                _, _, pixels = read_pgm(factory.activityFile())
+            except (OSError, ValueError) as e:
+                # not written yet or being replaced
+                logging.debug('No activity frame of cam %s: %s' % (self._cam_id, e))
+                continue
+            previous, state[1], state[2] = state[1], pixels, mtime
+            if previous is None or len(previous) != len(pixels):
+                continue
+            state[3] = activity_score(previous, pixels)
+            changed = state[0].update(state[3])
+            if changed is None:
+                continue
+            logging.info('Cam %s is %s (activity %.3f) -> switching profile' % (self._cam_id, changed, state[3]))
+            factory.setActivity(changed == IDLE)
+            if s.respawn(idx):
+                self.switches += 1
+            if self._events:
+                self._events.publish(self._cam_id, 'activity', index=idx, state=changed, score=state[3])
+
+    def report(self):
+        return [ dict(state=policy.state, score=score, idle=factory.idle)
+                 for factory,(policy, _, _, score) in self._factories.items() ]
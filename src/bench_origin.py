@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Load benchmark of the HLS origin
+ * 'concurrency' clients with keep-alive connections fetch the given paths in turn
+ * reports requests/sec, throughput and latency percentiles
+"""
+
+import time
+import asyncio
+import argparse
+
+from latency_stats import percentile
+
+
+async def client(host, port, paths, deadline, latencies, counters):
+    reader, writer = await asyncio.open_connection(host, port)
+    request = 0
+    try:
+        while time.perf_counter() < deadline:
+            path = paths[request % len(paths)]
+            request += 1
+            start = time.perf_counter()
+            writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (path, host)).encode())
+            head = await reader.readuntil(b'\r\n\r\n')
+            status = int(head.split(b' ', 2)[1])
+            length = 0
+            for line in head.split(b'\r\n'):
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            counters['bytes'] += length
+            if status >= 400:
+                counters['errors'] += 1
+    finally:
+        writer.close()
+
+async def run(host, port, paths, concurrency, duration):
+    latencies = list()
+    counters = dict(bytes=0, errors=0)
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+    await asyncio.gather(*(client(host, port, paths, deadline, latencies, counters)
+                           for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return dict(requests=len(latencies), errors=counters['errors'], elapsed=elapsed,
+                rps=len(latencies) / elapsed, mbps=counters['bytes'] * 8 / elapsed / 1e6,
+                p50=percentile(latencies, 50), p99=percentile(latencies, 99))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', help="Paths to fetch, e.g. /1/playlist.m3u8")
+    parser.add_argument('-H', '--host', type=str, default='127.0.0.1', help="Host of the origin")
+    parser.add_argument('-p', '--port', type=int, default=8080, help="Port of the origin")
+    parser.add_argument('-c', '--concurrency', type=int, default=64, help="Concurrent clients")
+    parser.add_argument('-d', '--duration', type=float, default=10, help="Duration in seconds")
+    args = parser.parse_args()
+
+    r = asyncio.run(run(args.host, args.port, args.paths, args.concurrency, args.duration))
+    print('%d requests in %.2fs, %d errors' % (r['requests'], r['elapsed'], r['errors']))
+    print('%.0f requests/s, %.1f Mbit/s, latency p50 %.2fms p99 %.2fms'
+          % (r['rps'], r['mbps'], (r['p50'] or 0) * 1000, (r['p99'] or 0) * 1000))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Load benchmark of the JSON-RPC server
+ * keeps 'concurrency' requests in flight on one DEALER socket
+ * reports requests/sec and latency percentiles
+"""
+
+import sys
+import time
+import argparse
+
+import zmq
+from zmq.utils import jsonapi as json
+
+from latency_stats import percentile
+
+
+def request(req_id, method, params, batch):
+    calls = [ dict(jsonrpc='2.0', method=method, params=params, id='%d.%d' % (req_id, i))
+              for i in range(batch) ]
+    return json.dumps(calls if batch > 1 else calls[0])
+
+def run(addr, method, params, count, concurrency, batch, timeout):
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.DEALER)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.connect(addr)
+    poller = zmq.Poller()
+    poller.register(sock, zmq.POLLIN)
+
+    sent = 0
+    in_flight = dict()
+    latencies = list()
+    errors = 0
+    start = time.perf_counter()
+    while len(latencies) + errors < count:
+        while sent < count and len(in_flight) < concurrency:
+            # empty delimiter frame, compatible with REQ envelopes
+            sock.send_multipart([ b'', request(sent, method, params, batch) ])
+            in_flight[sent] = time.perf_counter()
+            sent += 1
+        if not poller.poll(timeout * 1000):
+            sys.stderr.write('Timeout, %d requests without answer\n' % (len(in_flight)))
+            errors += len(in_flight)
+            break
+        reply = json.loads(sock.recv_multipart()[-1])
+        now = time.perf_counter()
+        replies = reply if isinstance(reply, list) else [ reply ]
+        req_id = int(str(replies[0]['id']).split('.')[0])
+        latencies.append(now - in_flight.pop(req_id))
+        if any('error' in r for r in replies):
+            errors += 1
+    elapsed = time.perf_counter() - start
+    sock.close()
+    ctx.term()
+    return dict(requests=len(latencies), calls=len(latencies) * batch, errors=errors, elapsed=elapsed,
+                rps=len(latencies) / elapsed if elapsed else None,
+                p50=percentile(latencies, 50), p99=percentile(latencies, 99), max=max(latencies or [0]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-a', '--addr', type=str, default='tcp://127.0.0.1:5559', help="Address of the server")
+    parser.add_argument('-m', '--method', type=str, default='list', help="Method to call")
+    parser.add_argument('-p', '--params', type=int, nargs='*', default=[], help="Parameters of the method")
+    parser.add_argument('-n', '--count', type=int, default=10000, help="Number of requests")
+    parser.add_argument('-c', '--concurrency', type=int, default=16, help="Requests in flight")
+    parser.add_argument('-b', '--batch', type=int, default=1, help="Calls per request (JSON-RPC batch)")
+    parser.add_argument('-t', '--timeout', type=float, default=5, help="Timeout in seconds")
+    args = parser.parse_args()
+
+    r = run(args.addr, args.method, args.params, args.count, args.concurrency, args.batch, args.timeout)
+    print('%d requests (%d calls) in %.2fs, %d errors' % (r['requests'], r['calls'], r['elapsed'], r['errors']))
+    print('%.0f requests/s, latency p50 %.2fms p99 %.2fms max %.2fms'
+          % (r['rps'] or 0, (r['p50'] or 0) * 1000, (r['p99'] or 0) * 1000, r['max'] * 1000))
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Client library of the camera backend
+ * one persistent DEALER connection per client, shared by all threads
+ * requests are correlated by their JSON-RPC id and can be pipelined
+ * per call timeout, retries of read-only calls, sync (call) and asyncio (acall) API
+ * EventSubscriber receives the event stream of the backend (PUB socket)
+"""
+
+import os
+import time
+import asyncio
+import logging
+import itertools
+import threading
+import collections
+import concurrent.futures
+
+import zmq
+from zmq.utils import jsonapi as json
+
+# methods that change the state of the backend, the server does not deduplicate
+# requests, so these are never sent twice
+MUTATING_METHODS = frozenset(('start', 'stop', 'start_many', 'stop_many', 'stop_all',
+                              'reload_config', 'capture_image'))
+
+
+class RpcError(Exception):
+    """Error returned by the server"""
+    def __init__(self, error):
+        super().__init__('%s (%s)' % (error.get('message'), error.get('code')))
+        self.code = error.get('code')
+        self.data = error.get('data')
+
+
+class _Pending(object):
+    """Request waiting for its reply"""
+    __slots__ = ('ids', 'payload', 'future', 'timeout', 'retries', 'deadline', 'attempts')
+
+    def __init__(self, ids, payload, timeout, retries):
+        self.ids = ids
+        self.payload = payload
+        self.future = concurrent.futures.Future()
+        self.timeout = timeout
+        self.retries = retries
+        self.deadline = None
+        self.attempts = 0
+
+
+class CamClient(object):
+    """
+    CamClient talks JSON-RPC to the backend over one DEALER socket
+
+    The socket is owned by an I/O thread; call() and friends only queue the
+    request and wake the I/O thread up, so any number of requests of any
+    number of threads can be in flight. A request without reply within
+    timeout is sent again (same id) up to retries times, then its future
+    fails with TimeoutError. Requests (or batches) with a MUTATING_METHOD
+    are not retried, a slow start must not run twice. Replies to requests
+    that were given up are dropped.
+    """
+    def __init__(self, addr, timeout=5, retries=2, context=None):
+        self._addr = addr
+        self._timeout = timeout
+        self._retries = retries
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._outbox = collections.deque()
+        # json-rpc id -> _Pending (a batch is registered with all its ids)
+        self._pending = dict()
+        self._closed = False
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        self._context = context or zmq.Context.instance()
+        self._socket = self._context.socket(zmq.DEALER)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.connect(addr)
+        self._thread = threading.Thread(target=self._run, name='CamClient')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _request(self, method, params):
+        return dict(jsonrpc='2.0', method=method, params=list(params), id=next(self._ids))
+
+    def _submit(self, requests, payload, timeout):
+        retries = 0 if any(r['method'] in MUTATING_METHODS for r in requests) else self._retries
+        pending = _Pending([ r['id'] for r in requests ], json.dumps(payload),
+                           self._timeout if timeout is None else timeout, retries)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('Client is closed')
+            for i in pending.ids:
+                self._pending[i] = pending
+            self._outbox.append(pending)
+        os.write(self._wakeup_w, b'x')
+        return pending.future
+
+    def submit(self, method, *params, timeout=None):
+        """Sends a request and returns a Future of its result"""
+        request = self._request(method, params)
+        return self._submit([ request ], request, timeout)
+
+    def call(self, method, *params, timeout=None):
+        """Sends a request and waits for its result"""
+        return self.submit(method, *params, timeout=timeout).result()
+
+    def submit_batch(self, calls, timeout=None):
+        """Sends [(method, params), ...] as one JSON-RPC batch, returns a Future
+
+        The result is the list of results (or RpcError instances) in the
+        order of calls.
+        """
+        requests = [ self._request(method, params) for method,params in calls ]
+        return self._submit(requests, requests, timeout)
+
+    def batch(self, calls, timeout=None):
+        return self.submit_batch(calls, timeout).result()
+
+    async def acall(self, method, *params, timeout=None):
+        """asyncio variant of call()"""
+        return await asyncio.wrap_future(self.submit(method, *params, timeout=timeout))
+
+    async def abatch(self, calls, timeout=None):
+        """asyncio variant of batch()"""
+        return await asyncio.wrap_future(self.submit_batch(calls, timeout))
+
+    def _run(self):
+        poller = zmq.Poller()
+        poller.register(self._socket, zmq.POLLIN)
+        poller.register(self._wakeup_r, zmq.POLLIN)
+        while True:
+            with self._lock:
+                if self._closed:
+                    break
+                deadlines = [ p.deadline for p in self._pending.values() if p.deadline is not None ]
+            wait = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+            events = dict(poller.poll(None if wait is None else wait * 1000))
+            if self._wakeup_r in events:
+                try:
+                    os.read(self._wakeup_r, 4096)
+                except BlockingIOError:
+                    pass
+            self._send_outbox()
+            while self._socket.poll(0, zmq.POLLIN):
+                self._on_reply(self._socket.recv_multipart()[-1])
+            self._check_timeouts()
+        self._socket.close()
+
+    def _send_outbox(self):
+        while True:
+            with self._lock:
+                if not self._outbox:
+                    return
+                pending = self._outbox.popleft()
+            pending.attempts += 1
+            pending.deadline = time.monotonic() + pending.timeout
+            # empty delimiter frame, the server also serves REQ clients
+            self._socket.send_multipart([ b'', pending.payload ])
+
+    def _on_reply(self, message):
+        try:
+            reply = json.loads(message)
+        except ValueError:
+            logging.warning('Malformed reply: %s' % (message))
+            return
+        if not reply:
+            # reply to notifications
+            return
+        replies = [ reply ] if isinstance(reply, dict) else reply
+        with self._lock:
+            pending = next((self._pending.get(r.get('id')) for r in replies
+                            if r.get('id') in self._pending), None)
+            if pending is None:
+                logging.debug('Dropping reply to unknown request: %s' % (message))
+                return
+            for i in pending.ids:
+                self._pending.pop(i, None)
+        if len(pending.ids) == 1 and isinstance(reply, dict):
+            if 'error' in reply:
+                pending.future.set_exception(RpcError(reply['error']))
+            else:
+                pending.future.set_result(reply.get('result'))
+            return
+        by_id = dict((r.get('id'), r) for r in replies)
+        results = list()
+        for i in pending.ids:
+            r = by_id.get(i, dict(error=dict(code=-32603, message='Missing reply')))
+            results.append(RpcError(r['error']) if 'error' in r else r.get('result'))
+        pending.future.set_result(results)
+
+    def _check_timeouts(self):
+        now = time.monotonic()
+        expired = list()
+        with self._lock:
+            for pending in set(self._pending.values()):
+                if pending.deadline is None or pending.deadline > now:
+                    continue
+                if pending.attempts <= pending.retries:
+                    logging.debug('Request %s timed out, retry %d' % (pending.ids, pending.attempts))
+                    pending.deadline = None
+                    self._outbox.append(pending)
+                else:
+                    for i in pending.ids:
+                        self._pending.pop(i, None)
+                    expired.append(pending)
+        self._send_outbox()
+        for pending in expired:
+            pending.future.set_exception(TimeoutError('No reply from %s after %d attempts'
+                                                      % (self._addr, pending.attempts)))
+
+    def close(self):
+        """Stops the I/O thread, pending requests fail"""
+        with self._lock:
+            self._closed = True
+            pending = set(self._pending.values())
+            self._pending = dict()
+        os.write(self._wakeup_w, b'x')
+        self._thread.join()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+        for p in pending:
+            p.future.set_exception(RuntimeError('Client closed'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class EventSubscriber(object):
+    """
+    EventSubscriber receives the events of the backend
+
+    Without cam_ids all events are received, otherwise only the events of
+    the given cameras (topic prefix 'cam.<cam_id>.').
+    """
+    def __init__(self, addr, cam_ids=None, context=None):
+        self._context = context or zmq.Context.instance()
+        self._socket = self._context.socket(zmq.SUB)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        for prefix in ([ 'cam.%s.' % (c) for c in cam_ids ] if cam_ids else [ '' ]):
+            self._socket.setsockopt(zmq.SUBSCRIBE, prefix.encode('utf-8'))
+        self._socket.connect(addr)
+
+    def recv(self, timeout=None):
+        """Returns the next (topic, event) or None after timeout seconds"""
+        if not self._socket.poll(None if timeout is None else timeout * 1000, zmq.POLLIN):
+            return None
+        topic, message = self._socket.recv_multipart()
+        return topic.decode('utf-8'), json.loads(message)
+
+    def __iter__(self):
+        while True:
+            yield self.recv()
+
+    def close(self):
+        self._socket.close()
@@ -4,10 +4,13 @@
 """
  * Runs the event loops
  * starts/stops cameras via CamManager()
+ * serves JSON-RPC (incl. batches) on a ROUTER socket, slow methods run in workers
 """
 import sys
+import signal
 import logging
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import zmq
 from zmq_process import ZmqThread
@@ -32,6 +35,23 @@ def stop(*cam_id):
     CamManager().stop(cam_id[0])
     return "cam_stopped"
 
+@my_dispatcher.add_method
+def start_many(*cam_ids):
+    CamManager().start_many(cam_ids)
+    return "cams_started"
+
+@my_dispatcher.add_method
+def stop_many(*cam_ids):
+    return CamManager().stop_many(cam_ids)
+
+@my_dispatcher.add_method
+def stop_all():
+    return CamManager().stop_all()
+
+@my_dispatcher.add_method
+def reload_config(*filename):
+    return CamManager().reload_config(filename[0] if filename else None)
+
 @my_dispatcher.add_method
 def capture_image(*cam_id):
     print("Capturing image from %d" % cam_id[0])
@@ -42,24 +62,95 @@ def capture_image(*cam_id):
 def list():
     return CamManager().cam_list
 
+@my_dispatcher.add_method
+def status(*cam_id):
+    if cam_id:
+        return CamManager().status(cam_id[0])
+    return [ CamManager().status(c) for c in CamManager().cam_list ]
+
+@my_dispatcher.add_method
+def progress(*cam_id):
+    if cam_id:
+        return CamManager().progress(cam_id[0])
+    return [ CamManager().progress(c) for c in CamManager().cam_list ]
+
+@my_dispatcher.add_method
+def activity(*cam_id):
+    if cam_id:
+        return CamManager().activity(cam_id[0])
+    return [ CamManager().activity(c) for c in CamManager().cam_list ]
+
+@my_dispatcher.add_method
+def stats(*cam_id):
+    return CamManager().stats(cam_id[0] if cam_id else None)
+
+@my_dispatcher.add_method
+def commands(*cam_id):
+    return CamManager().commands(cam_id[0] if cam_id else None)
+
+@my_dispatcher.add_method
+def storage():
+    return CamManager().storage()
+
+@my_dispatcher.add_method
+def recording(cam_id, start, end):
+    return CamManager().recording(cam_id, start, end)
+
+@my_dispatcher.add_method
+def queues(*cam_id):
+    return CamManager().queues(cam_id[0] if cam_id else None)
+
+@my_dispatcher.add_method
+def schedule():
+    return CamManager().schedule()
+
+# methods that may block, they never delay the answers of the other methods
+SLOW_METHODS = frozenset(('start', 'stop', 'start_many', 'stop_many', 'stop_all', 'reload_config'))
+
+def is_slow(message):
+    """True if the request (or one request of the batch) calls a slow method."""
+    try:
+        request = json.loads(message[-1])
+    except ValueError:
+        return False
+    # batch or single request ('list' is shadowed by the rpc method)
+    requests = [ request ] if isinstance(request, dict) else request
+    return any(isinstance(r, dict) and r.get('method') in SLOW_METHODS for r in requests)
+
 def handle_json(manager, message):
     """Callback function, called if new message is received."""
 
-    logging.log(logging.INFO,  'Request: %s' % (message))
-    response = manager.handle(message[0].decode('utf-8'), my_dispatcher)
-    result = response.json
-    logging.log(logging.INFO,  'Result: %s' % (result))
+    logging.debug('Request: %s' % (message[-1]))
+    response = manager.handle(message[-1].decode('utf-8'), my_dispatcher)
+    # notifications only -> empty reply, REQ clients expect one
+    result = response.json if response else ''
+    logging.debug('Result: %s' % (result))
     return result
 
 
 class CamHandlerRemote(ZmqThread):
-    def __init__(self, bind_addr, on_recv_cb):
+    """
+    JSON-RPC server on a ROUTER socket
+
+    Requests of many clients (REQ or DEALER) can be in flight at the same
+    time. Requests calling a slow method are handled in a pool of workers,
+    all others directly in the event loop. The reply carries the envelope
+    (routing id and delimiter) of its request.
+    """
+    def __init__(self, bind_addr, on_recv_cb, workers=4, slow=is_slow, pub_addr=None, events=None):
         super().__init__()
         self.bind_addr = bind_addr
+        # events of the EventBus are published on pub_addr
+        self.pub_addr = pub_addr
+        self._events = events
+        self.pub_stream = None
+        self._pub_port = None
         #print('Address: %s' % self.bind_addr)
         self._port = None
         self.recv_cb = on_recv_cb
-        self.rep_stream = None
+        self.router_stream = None
+        self._is_slow = slow
+        self._workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rpc')
 
     @property
     def port(self):
@@ -70,8 +161,43 @@ class CamHandlerRemote(ZmqThread):
         super().setup()
 
         # Create the stream and add the message handler
-        self.rep_stream, self._port = self.stream(zmq.REP, self.bind_addr, bind=True)
-        self.rep_stream.on_recv(lambda msg: self.rep_stream.send_string(self.recv_cb(msg)))
+        self.router_stream, self._port = self.stream(zmq.ROUTER, self.bind_addr, bind=True)
+        self.router_stream.on_recv(self._on_request)
+        if self.pub_addr and self._events:
+            self.pub_stream, self._pub_port = self.stream(zmq.PUB, self.pub_addr, bind=True)
+            self._events.attach(self._publish)
+
+    @property
+    def pub_port(self):
+        return self._pub_port
+
+    def _publish(self, topic, event):
+        # called from any thread, the socket belongs to the event loop thread
+        self.loop.add_callback(self.pub_stream.send_multipart,
+                [ topic.encode('utf-8'), json.dumps(event) ])
+
+    def _on_request(self, msg):
+        envelope, message = msg[:-1], msg[-1:]
+        if self._is_slow(message):
+            self._workers.submit(self._handle_in_worker, envelope, message)
+        else:
+            self._reply(envelope, self._handle(message))
+
+    def _handle(self, message):
+        try:
+            return self.recv_cb(message)
+        except Exception:
+            logging.exception('RPC handler failed')
+            return json.dumps(dict(jsonrpc='2.0', id=None,
+                    error=dict(code=-32603, message='Internal error'))).decode('utf-8')
+
+    def _handle_in_worker(self, envelope, message):
+        result = self._handle(message)
+        # the socket belongs to the event loop thread
+        self.loop.add_callback(self._reply, envelope, result)
+
+    def _reply(self, envelope, result):
+        self.router_stream.send_multipart(envelope + [ result.encode('utf-8') ])
 
     def run(self):
         """Sets up everything and starts the event loop."""
@@ -80,12 +206,17 @@ class CamHandlerRemote(ZmqThread):
 
     def stop(self):
         """Stops the event loop."""
+        if self.pub_stream:
+            self._events.detach(self._publish)
         self.loop.stop()
+        self._workers.shutdown(wait=False)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', type=str, help="Specify the yaml configuration file")
     parser.add_argument('-p', '--port', type=int, help="Specify the port to listen to")
+    parser.add_argument('-e', '--events-port', type=int, help="Specify the port to publish events on")
+    parser.add_argument('-w', '--workers', type=int, default=4, help="Number of workers for slow requests")
     parser.add_argument('-v', '--verbosity', type=int, default=50, help="10: DEBUG, ..., 50: Critical")
     args = parser.parse_args()
 
@@ -102,7 +233,9 @@ if __name__ == '__main__':
     try:
         manager = JSONRPCResponseManager()
         CamManager().loadConfig(args.config, ffmpeg_proc_factory_gen)
-        a = CamHandlerRemote(uri, lambda msg : handle_json(manager, msg))
+        pub_uri = 'tcp://*:' + str(args.events_port) if args.events_port else None
+        a = CamHandlerRemote(uri, lambda msg : handle_json(manager, msg), args.workers,
+                             pub_addr=pub_uri, events=CamManager().events)
     except (AttributeError, TypeError) as e:
         sys.stderr.write('Missing commandline argument\n')
         sys.stderr.write('Error: %s\n' % (str(e)))
@@ -115,6 +248,13 @@ if __name__ == '__main__':
     cap_img.setDaemon(True)
     cap_img.start()
 
+    def on_sighup(signum, frame):
+        try:
+            CamManager().reload_config()
+        except Exception:
+            logging.exception('Reloading the configuration failed')
+    signal.signal(signal.SIGHUP, on_sighup)
+
     a.setDaemon(True)
     a.start()
 
@@ -1,27 +1,141 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import os
+import time
+import random
 import logging
 import threading
+import subprocess
+import collections
 
-class CamHandlerThread (threading.Thread):
+from file_watcher import create_watcher
+from ffmpeg_progress import ProgressReader
+from command_executor import BACKGROUND
+
+class RestartBackoff(object):
+    """Restart accounting of 1 process
+
+    Consecutive failures are delayed exponentially (with jitter) up to
+    max_delay. A process that failed degraded_failures times within window
+    seconds is considered degraded. A process that ran for stable_after
+    seconds resets the backoff.
+    """
+    def __init__(self, base_delay=1, max_delay=300, jitter=0.2,
+                 degraded_failures=5, window=300, stable_after=60):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.degraded_failures = degraded_failures
+        self.window = window
+        self.stable_after = stable_after
+        self.restarts = 0
+        self.consecutive_failures = 0
+        self._failures = collections.deque()
+        self.started_at = None
+        self.next_retry = None
+
+    def started(self):
+        self.started_at = time.monotonic()
+        self.next_retry = None
+
+    def failed(self):
+        """Records a process exit and returns the delay until the restart"""
+        now = time.monotonic()
+        if self.started_at is not None and now - self.started_at >= self.stable_after:
+            self.consecutive_failures = 0
+        self.consecutive_failures += 1
+        self._failures.append(now)
+        while self._failures and now - self._failures[0] > self.window:
+            self._failures.popleft()
+        delay = min(self.max_delay, self.base_delay * 2 ** (self.consecutive_failures - 1))
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.next_retry = time.time() + delay
+        self.restarts += 1
+        return delay
+
+    @property
+    def degraded(self):
+        now = time.monotonic()
+        return len([t for t in self._failures if now - t <= self.window]) >= self.degraded_failures
+
+    def status(self):
+        return dict(restarts=self.restarts,
+                    consecutive_failures=self.consecutive_failures,
+                    degraded=self.degraded,
+                    next_retry=self.next_retry)
+
+
+class CamHandlerThread(object):
     """CamHandlerThread controls 1 camera
 
     One instance of CamHandlerThread controls 1 camera, which might provide
     multiple streams via 1 or multiple transcoding processes
 
+    The handler has no thread of its own: process exits and timers are
+    dispatched by the shared ProcessSupervisor. The observers may block
+    (file I/O, ffprobe), with a CommandExecutor they are updated in the lane
+    of the camera at BACKGROUND priority, a pending update absorbs later ones.
+
+    With watch_mode 'inotify' or 'poll' (instead of 'timer') the observers are notified when
+    ffmpeg writes a variant playlist instead of on a timer. Writes within
+    DEBOUNCE seconds (e.g. all renditions of the camera) result in a single
+    notification.
+
     Observers:
      * are interested in dead processes to discard to playlist file??
     """
-    def __init__(self, process_descriptors, cam_id):
-        super().__init__()
+    def __init__(self, process_descriptors, cam_id, supervisor, restart_cfg=None, watch_mode=None,
+                 scheduler=None, monitor=None, stall_factor=4, events=None, state=None, adopted=None,
+                 executor=None):
         self._cam_id    = cam_id
         self._observers = list()
+        self._supervisor = supervisor
         # list of factory methods to start processes
         self.process_descriptors = process_descriptors
         self.process_factory_active = list()
         # list of processes to keep track of
-        self._stop_event = threading.Event()
+        self._procs = list()
+        self._progress = list()
+        self._backoff = list()
+        self._restart_timers = dict()
+        self._restart_cfg = restart_cfg or dict()
+        # indexes of processes that are replaced on purpose (no backoff), see respawn()
+        self._respawning = set()
+        self.RESPAWN_KILL = 5 # seconds
+        self._lock = threading.Lock()
+        self._running = False
+        # processes terminated by terminate(), reaped by wait()
+        self._stopping = list()
+        self._stopped_event = threading.Event()
+        self._stopped_event.set()
+        self._timer = None
+        self._event_timeout = None
+        self._watch_mode = watch_mode
+        self._watcher = None
+        self._debounce_timer = None
+        self.DEBOUNCE = 0.25 # seconds
+        # optional CpuScheduler, assigns cores/threads/nice level to the processes
+        self._scheduler = scheduler
+        # optional ResourceMonitor, samples cpu/memory/io of the processes
+        self._monitor = monitor
+        # a process below this speed (media time / wall time) is overloaded
+        self.OVERLOAD_SPEED = 0.9
+        # stall watchdog: a process without a new segment for stall_factor * hls_time is restarted
+        self._stall_factor = stall_factor
+        self._watchdog_timer = None
+        # playlist name -> wall clock time of the last write
+        self._last_write = dict()
+        self._started_at = list()
+        # optional EventBus, gets the state changes of the camera and its processes
+        self._events = events
+        # optional StateStore: processes are started detached and recorded to be adopted
+        # by the next backend; adopted[idx] is a running process of the previous backend
+        self._state = state
+        self._adopted = adopted or list()
+        # optional CommandExecutor, runs the observer updates off the supervisor thread
+        self._executor = executor
+        self.EVENT_TIMEOUT_BASE = 2 # seconds
         self.EVENT_TIMEOUT_MAX = 10 # seconds
 
     def __exit__(self):
@@ -44,57 +158,336 @@ class CamHandlerThread (threading.Thread):
         self._observers.remove(o)
 
     def notify(self):
+        """Updates the observers, in the command executor if there is one"""
+        if self._executor is None:
+            return self._notify_observers()
+        # a replaced handler of the camera (reload) must not absorb the update of this one
+        self._executor.submit(self._cam_id, 'notify', self._notify_observers, BACKGROUND, owner=self)
+
+    def _notify_observers(self):
+        if not self._running:
+            return
         for o in self._observers:
             logging.info('Observer notifed: %s' % (type(o).__name__))
-            o.update(self)
-
-    def stop(self):
-        self._stop_event.set()
-
-    def run(self):
-        playlists = list()
-        proc_context = list()
-        event_timeout_base = 2
-        process_factories = [ p.factoryMethods() for p in self.process_descriptors ]
-        # start all processes
-        ffmpeg_procs      = [ proc() for proc in process_factories ]
-        logging.info('Entering control loop for cam %d' % (self._cam_id))
-        event_timeout = event_timeout_base
-        while not (self._stop_event.wait(timeout=event_timeout)):
-            # check if subprocesses are alive
-            self.process_factory_active = list() 
-            for idx,proc in enumerate(ffmpeg_procs):
+            try:
+                o.update(self)
+            except Exception:
+                # a failing observer must not starve the others (e.g. budget eviction)
+                logging.exception('Observer %s failed' % (type(o).__name__))
+
+    def notifyProgress(self, idx, sample):
+        for o in self._observers:
+            if hasattr(o, 'progress'):
+                o.progress(self, idx, sample)
+
+    def _publish(self, event, **data):
+        if self._events:
+            self._events.publish(self._cam_id, event, **data)
+
+    def progress(self):
+        """Returns the recent progress telemetry of all processes"""
+        with self._lock:
+            readers = list(self._progress)
+        result = list()
+        for idx,reader in enumerate(readers):
+            if reader is None:
+                result.append(dict(index=idx, overloaded=None))
+                continue
+            summary = reader.summary()
+            summary['index'] = idx
+            summary['overloaded'] = summary['speed'] is not None and summary['speed'] < self.OVERLOAD_SPEED
+            result.append(summary)
+        return dict(cam_id=self._cam_id, processes=result)
+
+    def is_alive(self):
+        return not self._stopped_event.is_set()
+
+    def status(self):
+        """Returns the state and the restart accounting of all processes"""
+        with self._lock:
+            procs = list()
+            for idx,proc in enumerate(self._procs):
+                backoff = self._backoff[idx]
                 if proc.poll() == None:
-                    # process is still running
-                    self.process_factory_active.append(self.process_descriptors[idx])
+                    state = 'running'
+                elif backoff.degraded:
+                    state = 'degraded'
+                else:
+                    state = 'restarting'
+                procs.append(dict(backoff.status(), pid=proc.pid, state=state))
+        return dict(cam_id=self._cam_id, running=self._running, processes=procs)
+
+    def start(self):
+        """Starts all processes of the camera"""
+        if self._scheduler:
+            self._scheduler.add(self._cam_id,
+                    [ r for p in self.process_descriptors for r in p.renditions ])
+        with self._lock:
+            self._stopped_event.clear()
+            self._running = True
+            # start all processes
+            self._procs = [ None ] * len(self.process_descriptors)
+            self._progress = [ None ] * len(self.process_descriptors)
+            self._started_at = [ None ] * len(self.process_descriptors)
+            self._last_write = dict()
+            self._backoff = [ RestartBackoff(**self._restart_cfg) for _ in self.process_descriptors ]
+            for idx in range(len(self.process_descriptors)):
+                if idx < len(self._adopted) and self._adopted[idx] is not None:
+                    if self._adopted[idx].idle != self.process_descriptors[idx].idle:
+                        # the adopted process runs the idle rendition profile
+                        self.process_descriptors[idx].setActivity(self._adopted[idx].idle)
+                    self._manage(idx, self._adopted[idx])
                 else:
-                    logging.warning('ffmpeg died -> restart')
-                    # process died -> restart
-                    ffmpeg_procs[idx] = process_factories[idx]()
-            # notify all observers
-            self.notify()
-            if event_timeout < self.EVENT_TIMEOUT_MAX:
-                # throttle update rate after process has started
-                event_timeout += 1
+                    self._spawn(idx)
+        logging.info('Entering control loop for cam %d' % (self._cam_id))
+        if any(self._adopted):
+            # rebuild the master playlist from the playlists on disk right away
+            self._supervisor.call_soon(self._debounced_notify)
+        self._adopted = list()
+        self._publish('started', pids=[ p.pid for p in self._procs ])
+        if self._watch_mode in ('inotify', 'poll'):
+            playlists = [ f for p in self.process_descriptors for f in p.fileList() ]
+            self._watcher = create_watcher(self._supervisor, playlists[0].parent,
+                    [ f.name for f in playlists ], self._on_playlist_written, self._watch_mode)
         else:
-            # received request to terminate thread -> also terminate ffmpeg processes
-            for proc in ffmpeg_procs:
-                try:
-                    proc.terminate()
-                except ProcessLookupError:
-                    logging.warning('One process for %s has already terminated' % (self._cam_id))
-            for proc in ffmpeg_procs:
+            self._event_timeout = self.EVENT_TIMEOUT_BASE
+            self._timer = self._supervisor.call_later(self._event_timeout, self._tick)
+        if self._stall_factor:
+            self._watchdog_timer = self._supervisor.call_later(self._watchdog_interval(), self._watchdog)
+
+    def _watchdog_interval(self):
+        return min(p.segmentDuration() for p in self.process_descriptors)
+
+    def _newest_write(self, idx):
+        """Time of the newest playlist write of process idx"""
+        newest = self._started_at[idx]
+        for playlist in self.process_descriptors[idx].fileList():
+            if self._watcher:
+                # kept up to date by the watcher, no stat needed
+                written = self._last_write.get(playlist.name)
+            else:
                 try:
-                    logging.warning('waiting for ffmpeg to terminate')
-                    outs, errs = proc.communicate(timeout=3)
-                    if errs:
-                        logging.error(errs)
-                    if outs:
-                        logging.info(outs)
-                except TimeoutExpired:
-                    logging.warning('ffmpeg refused to terminate')
+                    written = os.stat(str(playlist)).st_mtime
+                except FileNotFoundError:
+                    written = None
+            if written is not None and written > newest:
+                newest = written
+        return newest
+
+    def _watchdog(self):
+        """Kills processes that are alive but stopped producing segments"""
+        if not self._running:
+            return
+        now = time.time()
+        with self._lock:
+            for idx,proc in enumerate(self._procs):
+                if proc.poll() is not None:
+                    continue
+                limit = self._stall_factor * self.process_descriptors[idx].segmentDuration()
+                stalled_for = now - self._newest_write(idx)
+                if stalled_for > limit:
+                    logging.error('ffmpeg %d of cam %d produced no segment for %.0fs -> kill'
+                            % (proc.pid, self._cam_id, stalled_for))
+                    self._publish('stalled', index=idx, pid=proc.pid, stalled_for=stalled_for)
+                    # the exit is handled by _on_exit (restart with backoff)
                     proc.kill()
-            logging.info('Stopped thread for cam %d' % (self._cam_id))
+        self._watchdog_timer = self._supervisor.call_later(self._watchdog_interval(), self._watchdog)
+
+    def _on_playlist_written(self, name):
+        """Called by the watcher whenever ffmpeg has written a variant playlist"""
+        self._last_write[name] = time.time()
+        if self._running and self._debounce_timer is None:
+            self._debounce_timer = self._supervisor.call_later(self.DEBOUNCE, self._debounced_notify)
+
+    def _debounced_notify(self):
+        self._debounce_timer = None
+        if not self._running:
+            return
+        self._update_active()
+        self.notify()
+
+    def _spawn(self, idx):
+        process_factory = self.process_descriptors[idx].factoryMethods()
+        kwargs = dict()
+        if self._scheduler:
+            # the threads of the camera are shared by its processes
+            kwargs['threads'] = max(1, self._scheduler.threads(self._cam_id) // len(self.process_descriptors))
+        if self._state:
+            # must survive a restart of the backend
+            kwargs['detached'] = True
+        self._manage(idx, process_factory(**kwargs))
+
+    def _manage(self, idx, proc):
+        """Takes over a started (or adopted) process"""
+        if self._scheduler:
+            self._scheduler.attach(self._cam_id, proc.pid)
+        if self._state:
+            self._state.set_process(self._cam_id, idx, proc.pid, self.process_descriptors[idx].idle)
+        if self._monitor:
+            self._monitor.track(self._cam_id, proc.pid)
+        self._procs[idx] = proc
+        self._started_at[idx] = time.time()
+        if self._progress[idx]:
+            self._progress[idx].close()
+        self._progress[idx] = None
+        if proc.stdout is not None:
+            self._progress[idx] = ProgressReader(self._supervisor, proc.stdout,
+                    lambda sample: self.notifyProgress(idx, sample))
+        self._backoff[idx].started()
+        self._supervisor.watch(proc, lambda p: self._on_exit(idx, p))
+
+    def _on_exit(self, idx, proc):
+        """Called by the supervisor as soon as a process died"""
+        with self._lock:
+            if not self._running or self._procs[idx] is not proc:
+                return
+            if self._scheduler:
+                self._scheduler.detach(self._cam_id, proc.pid)
+            if self._monitor:
+                self._monitor.untrack(self._cam_id, proc.pid)
+            if idx in self._respawning:
+                self._respawning.discard(idx)
+                try:
+                    self._spawn(idx)
+                except OSError as e:
+                    # handled like a failed process below
+                    logging.error('Could not start ffmpeg: %s' % (e))
+                else:
+                    logging.info('ffmpeg %d of cam %d replaced by %d'
+                            % (proc.pid, self._cam_id, self._procs[idx].pid))
+                    self._publish('respawned', index=idx, pid=self._procs[idx].pid)
+                    return
+            backoff = self._backoff[idx]
+            delay = backoff.failed()
+            if backoff.degraded:
+                logging.error('ffmpeg of cam %d is crash-looping (%d restarts) -> degraded, retry in %.1fs'
+                        % (self._cam_id, backoff.restarts, delay))
+            else:
+                logging.warning('ffmpeg died -> restart in %.1fs' % (delay))
+            self._publish('process_exited', index=idx, pid=proc.pid, returncode=proc.returncode,
+                          restart_in=delay, restarts=backoff.restarts, degraded=backoff.degraded)
+            # process died -> restart after backoff
+            self._restart_timers[idx] = self._supervisor.call_later(delay, self._restart, idx)
+        self._update_active()
+        self.notify()
+
+    def _restart(self, idx):
+        with self._lock:
+            self._restart_timers.pop(idx, None)
+            if not self._running:
+                return
+            try:
+                self._spawn(idx)
+                self._publish('restarted', index=idx, pid=self._procs[idx].pid,
+                              restarts=self._backoff[idx].restarts)
+            except OSError as e:
+                delay = self._backoff[idx].failed()
+                logging.error('Could not start ffmpeg: %s -> retry in %.1fs' % (e, delay))
+                self._restart_timers[idx] = self._supervisor.call_later(delay, self._restart, idx)
+
+    def respawn(self, idx):
+        """Replaces process idx by a new one of its (changed) process factory
+
+        The process is terminated and started again as soon as it exited, this
+        is not a failure (no backoff). Returns False if it is not running.
+        """
+        with self._lock:
+            proc = self._procs[idx] if self._running and idx < len(self._procs) else None
+            if proc is None or proc.poll() is not None or idx in self._respawning:
+                return False
+            self._respawning.add(idx)
+        proc.terminate()
+        self._supervisor.call_later(self.RESPAWN_KILL, self._respawn_kill, idx, proc)
+        return True
+
+    def _respawn_kill(self, idx, proc):
+        if proc.poll() is None and idx in self._respawning:
+            logging.warning('ffmpeg %d of cam %d ignores SIGTERM -> kill' % (proc.pid, self._cam_id))
+            proc.kill()
+
+    def _update_active(self):
+        with self._lock:
+            self.process_factory_active = [ self.process_descriptors[idx]
+                    for idx,proc in enumerate(self._procs) if proc.poll() == None ]
+
+    def _tick(self):
+        if not self._running:
+            return
+        self._update_active()
+        # notify all observers
+        self.notify()
+        if self._event_timeout < self.EVENT_TIMEOUT_MAX:
+            # throttle update rate after process has started
+            self._event_timeout += 1
+        self._timer = self._supervisor.call_later(self._event_timeout, self._tick)
+
+    def terminate(self):
+        """Sends SIGTERM to all processes of the camera without waiting for them"""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            self._stopping = list(self._procs)
+            self._respawning = set()
+            readers = [ r for r in self._progress if r ]
+            for timer in self._restart_timers.values():
+                timer.cancel()
+            self._restart_timers = dict()
+        if self._timer:
+            self._timer.cancel()
+        if self._watchdog_timer:
+            self._watchdog_timer.cancel()
+        if self._watcher:
+            self._watcher.close()
+            self._watcher = None
+        if self._debounce_timer:
+            self._debounce_timer.cancel()
+            self._debounce_timer = None
+        for reader in readers:
+            reader.close()
+        for proc in self._stopping:
+            if proc is None:
+                continue
+            self._supervisor.unwatch(proc)
+            try:
+                proc.terminate()
+            except ProcessLookupError:
+                logging.warning('One process for %s has already terminated' % (self._cam_id))
+
+    def wait(self, deadline):
+        """Waits for the terminated processes until deadline (time.monotonic()), kills the rest"""
+        with self._lock:
+            procs, self._stopping = self._stopping, list()
+        for proc in procs:
+            if proc is None:
+                continue
+            try:
+                proc.wait(timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logging.warning('ffmpeg %d of cam %d refused to terminate -> kill' % (proc.pid, self._cam_id))
+                proc.kill()
+                proc.wait()
+        if not procs:
+            return
+        if self._scheduler:
+            self._scheduler.remove(self._cam_id)
+        if self._monitor:
+            self._monitor.untrack(self._cam_id)
+        if self._state:
+            self._state.remove(self._cam_id)
+        self.process_factory_active = list()
+        logging.info('Stopped thread for cam %d' % (self._cam_id))
+        self._stopped_event.set()
+        self._publish('stopped')
+
+    def stop(self, timeout=3):
+        """Terminates all processes of the camera, blocks until they are gone"""
+        self.terminate()
+        self.wait(time.monotonic() + timeout)
+
+    def join(self, timeout=None):
+        """Waits until stop() has terminated all processes"""
+        return self._stopped_event.wait(timeout)
 
 
 if __name__ == '__main__':
@@ -102,6 +495,8 @@ if __name__ == '__main__':
     import signal
     import yaml
     import pathlib
+    from process_supervisor import ProcessSupervisor
+    from ffmpeg_process_factory import ffmpeg_proc_factory_gen
 
     cfg_obj = None
     os.setpgrp()
@@ -120,7 +515,9 @@ if __name__ == '__main__':
     root_dir = pathlib.PurePath(cfg_obj['hls_dir'])
     cam = cfg_obj['cameras'][0]
 
-    cam_thread1 = CamHandlerThread( cfg_obj['cameras'][0], root_dir )
+    supervisor = ProcessSupervisor()
+    supervisor.start()
+    cam_thread1 = CamHandlerThread( ffmpeg_proc_factory_gen(cam, root_dir), cam['cam_no'], supervisor )
     cam_thread1.start()
     cam_thread1.join()
 
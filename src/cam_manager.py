@@ -3,28 +3,27 @@
 
 from contextlib import suppress
 
+import os
+import time
 import yaml
 import pathlib
-import shutil
 import threading
-import queue
 import logging
-import requests
-import traceback
 
 from cam_handler_thread import CamHandlerThread
 from playlist_manager import PlaylistManager
-
-def invocer(*queue, **kwargs):
-    while(True):
-        f = queue[0].get()
-        try:
-            f()
-        except Exception as e:
-            # catch all exceptions if submitted command fails
-            print("Command execution failed", e)
-            traceback.print_exc()
-
+from process_supervisor import ProcessSupervisor
+from snapshot_engine import SnapshotEngine
+from cpu_scheduler import CpuScheduler
+from proc_stats import ResourceMonitor
+from command_executor import CommandExecutor
+from event_bus import EventBus
+from process_state import StateStore, cfg_hash
+from hls_origin import HLSOrigin
+from segment_store import create_segment_store, WriteBehind, SegmentTracker
+from ffmpeg_cmd_builder import latency_profile
+from dvr_archive import DvrArchive, parse_time
+from activity_monitor import ActivityMonitor
 
 class Borg(object):
     """
@@ -44,7 +43,8 @@ class CamManager(Borg):
     """
     CamManager loads configuration files and starts/stops camera threads
     
-    It loads config files (with possibly multiple cameras) and creates one command queue per camera.
+    It loads config files (with possibly multiple cameras) and submits the commands of each
+    camera to its lane of the shared CommandExecutor.
     """
     def __init__(self):
         """
@@ -54,126 +54,445 @@ class CamManager(Borg):
         Borg.__init__(self)
         if not hasattr(self,'_cfg_obj'):
             self._cfg_obj = None
+        if not hasattr(self,'_cfg_filename'):
+            self._cfg_filename = None
         if not hasattr(self,'_cam_obj'):
             self._cam_obj = dict()
         if not hasattr(self,'_proc_factory_generator'):
             self._proc_factory_generator = None
         if not hasattr(self,'_cam_list'):
             self._cam_list = None
+        if not hasattr(self,'_supervisor'):
+            self._supervisor = None
+        if not hasattr(self,'_snapshots'):
+            self._snapshots = None
+        if not hasattr(self,'_scheduler'):
+            self._scheduler = None
+        if not hasattr(self,'_monitor'):
+            self._monitor = None
+        if not hasattr(self,'_executor'):
+            self._executor = None
+        if not hasattr(self,'_state'):
+            # optional StateStore, processes survive a restart of the backend
+            self._state = None
+        if not hasattr(self,'_segments'):
+            # SegmentStore, owns the output directories of the cameras
+            self._segments = None
+        if not hasattr(self,'_write_behind'):
+            self._write_behind = None
+        if not hasattr(self,'_archive'):
+            self._archive = None
+        if not hasattr(self,'_origin'):
+            self._origin = None
+        if not hasattr(self,'_events'):
+            # events of all cameras, sinks are attached by the frontends (e.g. PUB socket)
+            self._events = EventBus()
 
-    def loadConfig(self, filename, proc_factory_generator):
-        self._proc_factory_generator = proc_factory_generator
+    # global keys that change the processes of every camera
+    CAMERA_KEYS = ('hls_dir', 'playlist_watch', 'stall_factor')
+
+    def _read_config(self, filename):
         try:
             with open(filename, 'r') as f:
                 try:
                     logging.info('Loading config %s' % (filename))
-                    self._cfg_obj = yaml.load(f, Loader=yaml.Loader)
+                    cfg = yaml.load(f, Loader=yaml.Loader)
                 except yaml.scanner.ScannerError:
                     logging.error('Bad yaml syntax')
                     raise
         except EnvironmentError:
             logging.error('Could not open configuration file')
             raise
+        if not isinstance(cfg, dict):
+            logging.error('Empty or invalid configuration %s' % (filename))
+            raise ValueError('No configuration in %s' % (filename))
+        # the sources get their complete latency profile, so a changed
+        # profile (e.g. in latency_profiles) is a changed camera on reload
+        for cam in cfg.get('cameras', list()):
+            for src in cam.get('sources', list()):
+                if 'latency' in src:
+                    src['latency'] = latency_profile(src['latency'], cfg.get('latency_profiles'))
+        return cfg
+
+    def loadConfig(self, filename, proc_factory_generator):
+        self._proc_factory_generator = proc_factory_generator
+        self._cfg_filename = filename
+        self._cfg_obj = self._read_config(filename)
+
+        if not self._supervisor:
+            # one supervisor for the processes of all cameras
+            self._supervisor = ProcessSupervisor()
+            self._supervisor.start()
+            self._monitor = ResourceMonitor(self._supervisor, self._cfg_obj.get('stats_interval', 5))
+        if not self._snapshots:
+            # snapshots are captured outside of the command queues
+            snapshot_cfg = self._cfg_obj.get('snapshot', dict())
+            self._snapshots = SnapshotEngine(snapshot_cfg.get('workers', 4), snapshot_cfg.get('timeout', 10))
+        if not self._scheduler and 'cpu_scheduler' in self._cfg_obj:
+            self._scheduler = CpuScheduler(self._cfg_obj['cpu_scheduler'])
+        if not self._executor:
+            # one executor for the commands of all cameras
+            self._executor = CommandExecutor(self._cfg_obj.get('command_workers', 8))
 
         self._cam_list = list()
         for cam in self._cfg_obj['cameras']:
-            # start a command thread for each camera-thread
-            q = queue.Queue()
-            t = threading.Thread(target=invocer, args=(q,))
-            t.setDaemon(True)
-            t.start()
-            # each cam has a: (command-thread, command-queue, thread that controlls all video processing processes of 1 cam)
-            self._cam_obj[cam['cam_no']] = dict(invocer=t, cmd_queue=q, cam_thread=None)
+            # each cam has a: (thread that controlls all video processing processes of 1 cam)
+            self._cam_obj[cam['cam_no']] = dict(cam_thread=None)
             # add cam-number to cam_list
             self._cam_list.append(cam['cam_no'])
 
+        if not self._segments:
+            store_cfg = self._cfg_obj.get('segment_store') or dict()
+            self._segments = create_segment_store(self._cfg_obj['hls_dir'], store_cfg)
+            if store_cfg.get('retain_dir'):
+                # segments of cameras with 'retain: true' are archived on persistent disk
+                retain_days = store_cfg.get('retain_days')
+                retain_gb = store_cfg.get('retain_gb')
+                self._archive = DvrArchive(store_cfg['retain_dir'],
+                        retain_days * 86400 if retain_days else None,
+                        int(retain_gb * 1024 ** 3) if retain_gb else None)
+                self._write_behind = WriteBehind(self._archive, store_cfg.get('retain_queue', 64))
+
+        if not self._origin and 'http_origin' in self._cfg_obj:
+            # serves hls_dir in the event loop of the executor
+            origin_cfg = self._cfg_obj['http_origin'] or dict()
+            self._origin = HLSOrigin(self._executor.loop, self._cfg_obj['hls_dir'], self.master_playlist,
+                    origin_cfg.get('host', '0.0.0.0'), origin_cfg.get('port', 8080),
+                    origin_cfg.get('playlist_max_age', 1), archive=self._archive)
+            self._origin.start()
+
+        if not self._state and self._cfg_obj.get('reattach'):
+            self._state = StateStore(self._cfg_obj.get('state_file',
+                    pathlib.PurePath(self._cfg_obj['hls_dir'], '.backend_state.json')))
+            self._resume()
+
+    def _resume(self):
+        """
+        Resume the cameras that were running in the previous backend, their
+        running processes are adopted.
+        """
+        for cam_id in self._state.cameras():
+            if cam_id in self._cam_obj:
+                self.start(cam_id)
+            else:
+                self._state.discard(cam_id)
+
+    def _cam_hash(self, cam_cfg):
+        return cfg_hash([ cam_cfg ] + [ self._cfg_obj.get(k) for k in self.CAMERA_KEYS ])
+
+    def reload_config(self, filename=None):
+        """
+        Re-read the configuration and apply the differences per camera.
+
+        Running cameras whose configuration changed are restarted, removed cameras
+        are stopped and their command lanes dropped, added cameras become available.
+        Unchanged cameras keep streaming.
+        """
+        with self._lock:
+            filename = filename or self._cfg_filename
+            cfg = self._read_config(filename)
+            old = dict((cam['cam_no'], cam) for cam in self._cfg_obj['cameras'])
+            new = dict((cam['cam_no'], cam) for cam in cfg['cameras'])
+            if any(self._cfg_obj.get(k) != cfg.get(k) for k in self.CAMERA_KEYS):
+                changed = [ c for c in new if c in old ]
+            else:
+                changed = [ c for c in new if c in old and old[c] != new[c] ]
+            added   = [ c for c in new if c not in old ]
+            removed = [ c for c in old if c not in new ]
+            # a camera that is being started counts as running, stop() cancels its pending start
+            running = [ c for c in changed
+                        if self._cam_obj[c]['cam_thread'] or self._executor.pending(c, 'start') ]
+
+            # stop with the old configuration
+            for cam_id in removed + running:
+                self.stop(cam_id)
+            for cam_id in removed:
+                self._executor.submit(cam_id, 'remove', lambda cam_id=cam_id: self._cam_obj.pop(cam_id, None))
+                self._executor.retire(cam_id)
+
+            self._cfg_filename = filename
+            self._cfg_obj = cfg
+            for cam_id in added:
+                self._cam_obj[cam_id] = dict(cam_thread=None)
+            self._cam_list = [ cam['cam_no'] for cam in cfg['cameras'] ]
+
+            # start with the new configuration
+            for cam_id in running:
+                self.start(cam_id)
+
+        logging.info('Reloaded %s: added %s, removed %s, changed %s, restarted %s'
+                % (filename, added, removed, changed, running))
+        for cam_id in added:
+            self._events.publish(cam_id, 'added')
+        for cam_id in removed:
+            self._events.publish(cam_id, 'removed')
+        for cam_id in changed:
+            self._events.publish(cam_id, 'reconfigured', restarted=cam_id in running)
+        return dict(added=added, removed=removed, changed=changed, restarted=running)
+
+    def master_playlist(self, cam_dir):
+        """
+        Return the current master playlist of the camera with output directory cam_dir or None.
+        """
+        try:
+            playlist = self._cam_obj.get(int(cam_dir), dict()).get('playlist')
+        except ValueError:
+            return None
+        return playlist.master() if playlist else None
+
+    def _cam_cfg(self, cam_id):
+        cam_cfg = [ cam for cam in self._cfg_obj['cameras'] if cam['cam_no'] == cam_id ]
+        if not cam_cfg or cam_id not in self._cam_obj:
+            logging.warning('Invalid cam-id specified: %d' % cam_id)
+            return None
+        return cam_cfg[0]
+
+    @property
+    def events(self):
+        return self._events
+
     @property
     def cam_list(self):
         return self._cam_list
 
+    def status(self, cam_id):
+        """
+        Return state and restart accounting of the processes of a camera.
+        """
+        try:
+            cam_thread = self._cam_obj[cam_id]['cam_thread']
+        except KeyError:
+            logging.warning('Invalid cam-id specified: %d' % cam_id)
+            return None
+        if not cam_thread:
+            return dict(cam_id=cam_id, running=False, processes=list())
+        return cam_thread.status()
+
+    def activity(self, cam_id):
+        """
+        Return the activity state (active/idle), the last activity score and the
+        number of profile switches of a camera, None without activity detection.
+        """
+        monitor = self._cam_obj.get(cam_id, dict()).get('activity')
+        if not monitor:
+            return None
+        return dict(cam_id=cam_id, processes=monitor.report(), switches=monitor.switches)
+
+    def progress(self, cam_id):
+        """
+        Return the progress telemetry (fps, speed, bitrate, ...) of the processes of a camera.
+        """
+        try:
+            cam_thread = self._cam_obj[cam_id]['cam_thread']
+        except KeyError:
+            logging.warning('Invalid cam-id specified: %d' % cam_id)
+            return None
+        if not cam_thread:
+            return dict(cam_id=cam_id, processes=list())
+        return cam_thread.progress()
+
+    def schedule(self):
+        """
+        Return the cpu assignment of the running cameras.
+        """
+        if not self._scheduler:
+            return dict()
+        return self._scheduler.report()
+
+    def stats(self, cam_id=None):
+        """
+        Return cpu, memory and io statistics per camera and per process.
+        """
+        return self._monitor.report(cam_id)
+
     def capture_image(self, cam_id):
         """
-        Submit capture image command to queue and return command queue.
+        Submit capture image command to the snapshot engine and return its future.
         """
         if not self._cfg_obj:
             raise Exception('No yaml configuration loaded')
 
         root_dir = pathlib.PurePath(self._cfg_obj['hls_dir'])
-        cam_cfg = [ cam for cam in self._cfg_obj['cameras'] if cam['cam_no'] == cam_id ]
+        cam_cfg = self._cam_cfg(cam_id)
         if not cam_cfg:
             return None
 
-        def cmd():
-            r = requests.get(cam_cfg[0]['screen_capture'])
-            output_file = pathlib.PurePath(root_dir, str(cam_cfg[0]['cam_no']) + '.jpg')
-            with open(str(output_file), 'wb') as f:
-                f.write(r.content)
-        try:
-            self._cam_obj[cam_id]['cmd_queue'].put(cmd)
-            return self._cam_obj[cam_id]['cmd_queue']
-        except IndexError:
-            logging.warning('Invalid cam-id specified: %d' % cam_id)
+        output_file = pathlib.PurePath(root_dir, str(cam_cfg['cam_no']) + '.jpg')
+        image_file = self._live_snapshot(cam_id)
+        if image_file:
+            future = self._snapshots.copy(image_file, output_file)
+        else:
+            future = self._snapshots.capture(cam_cfg['screen_capture'], output_file)
+        future.add_done_callback(lambda f: self._publish_snapshot(cam_id, output_file, f))
+        return future
+
+    def _publish_snapshot(self, cam_id, output_file, future):
+        if future.cancelled():
+            return
+        if future.exception():
+            self._events.publish(cam_id, 'snapshot_failed', error=str(future.exception()))
+        elif future.result():
+            self._events.publish(cam_id, 'snapshot', image=str(output_file))
+
+    def _live_snapshot(self, cam_id):
+        """
+        Return the snapshot file of a running ffmpeg of the camera if it is up to date.
+        """
+        cam_thread = self._cam_obj.get(cam_id, dict()).get('cam_thread')
+        if not cam_thread or not cam_thread.is_alive():
             return None
+        for proc_desc in cam_thread.processFactories:
+            image_file = proc_desc.snapshotFile()
+            if not image_file:
+                continue
+            try:
+                age = time.time() - os.stat(str(image_file)).st_mtime
+            except FileNotFoundError:
+                continue
+            if age < 3 * proc_desc.snapshot_interval:
+                return image_file
+        return None
 
+    def commands(self, cam_id=None):
+        """
+        Return the state of the recently submitted commands.
+        """
+        return self._executor.commands(cam_id)
+
+    def storage(self):
+        """
+        Return memory/disk usage of the segments per camera and the write-behind state.
+        """
+        retained = [ cam['cam_no'] for cam in self._cfg_obj['cameras'] if cam.get('retain') ]
+        return dict(cameras=self._segments.report(self._cam_list),
+                    write_behind=self._write_behind.report() if self._write_behind else None,
+                    dvr=self._archive.report(retained) if self._archive else None)
+
+    def recording(self, cam_id, start, end):
+        """
+        Return the VOD playlist of the DVR archive of a camera between start and end
+        (seconds since the epoch or local 'YYYY-MM-DD HH:MM[:SS]'), its URIs are
+        relative to /dvr/<cam_id>/ of the HTTP origin.
+        """
+        if not self._archive:
+            raise ValueError('No DVR archive configured (segment_store: retain_dir)')
+        return self._archive.playlist(cam_id, parse_time(start), parse_time(end)).decode()
+
+    def queues(self, cam_id=None):
+        """
+        Return depth and wait times of the command queues and the pending snapshots.
+        """
+        return dict(commands=self._executor.metrics(cam_id),
+                    snapshots=dict(pending=self._snapshots.pending(), coalesced=self._snapshots.coalesced))
 
     def start(self, cam_id):
         """
-        Submit start-stream command to queue and return command queue.
+        Submit start-stream command to the executor and return its CommandHandle.
         """
         if not self._cfg_obj:
             raise Exception('No yaml configuration loaded')
 
-        root_dir = pathlib.PurePath(self._cfg_obj['hls_dir'])
-        cam_cfg = [ cam for cam in self._cfg_obj['cameras'] if cam['cam_no'] == cam_id ][0]
+        if not self._cam_cfg(cam_id):
+            return None
         def cmd():
+            # the configuration at execution time, it may have been reloaded meanwhile
+            cam_cfg = self._cam_cfg(cam_id)
+            if not cam_cfg:
+                return
             try:
-                if self._cam_obj[cam_id]['cam_thread'].isAlive():
+                if self._cam_obj[cam_id]['cam_thread'].is_alive():
                     return
             except AttributeError:
                 # no cam-thread is running
-                output_dir = pathlib.PurePath(root_dir, str(cam_cfg['cam_no']))
-                with suppress(Exception):
-                    shutil.rmtree(str(output_dir))
-                pathlib.Path(output_dir).mkdir()
+                adopted = None
+                if self._state:
+                    adopted = self._state.adopt(cam_id, self._cam_hash(cam_cfg))
+                    self._state.set_camera(cam_id, self._cam_hash(cam_cfg))
+                # keep the segments and playlists of adopted processes
+                output_dir = self._segments.prepare(cam_cfg['cam_no'], keep=adopted is not None)
                 logging.debug('Starting thread for cam %d' % (cam_id))
 
                 process_factory = self._proc_factory_generator(cam_cfg, output_dir)
                 print('process_factory: ', process_factory)
-                self._cam_obj[cam_id]['cam_thread'] = CamHandlerThread( process_factory, cam_id )
-                self._cam_obj[cam_id]['cam_thread'].attachObserver(PlaylistManager(output_dir))
+                self._cam_obj[cam_id]['cam_thread'] = CamHandlerThread( process_factory, cam_id,
+                        self._supervisor, cam_cfg.get('restart'),
+                        cam_cfg.get('playlist_watch', self._cfg_obj.get('playlist_watch', 'inotify')),
+                        self._scheduler, self._monitor,
+                        cam_cfg.get('stall_factor', self._cfg_obj.get('stall_factor', 4)),
+                        self._events, self._state, adopted, self._executor )
+                self._cam_obj[cam_id]['playlist'] = PlaylistManager(output_dir, cam_id, self._events)
+                self._cam_obj[cam_id]['cam_thread'].attachObserver(self._cam_obj[cam_id]['playlist'])
+                write_behind = self._write_behind if cam_cfg.get('retain') else None
+                self._cam_obj[cam_id]['cam_thread'].attachObserver(
+                        SegmentTracker(self._segments, cam_cfg['cam_no'], write_behind))
+                self._cam_obj[cam_id]['activity'] = None
+                if any(p.activityFile() for p in process_factory):
+                    # idle/active rendition profiles
+                    self._cam_obj[cam_id]['activity'] = ActivityMonitor(cam_id, self._events)
+                    self._cam_obj[cam_id]['cam_thread'].attachObserver(self._cam_obj[cam_id]['activity'])
                 self._cam_obj[cam_id]['cam_thread'].start()
-       
-        try:
-            self._cam_obj[cam_id]['cmd_queue'].put(cmd)
-            return self._cam_obj[cam_id]['cmd_queue']
-        except IndexError:
-            logging.warning('Invalid cam-id specified: %d' % cam_id)
-            return
 
+        return self._executor.submit(cam_id, 'start', cmd)
 
-    def stop(self, cam_id):
+
+    def stop(self, cam_id, deadline=None):
         """
-        Submit stop-stream command to queue and return command queue.
+        Submit stop-stream command to the executor and return its CommandHandle.
+        The processes get until deadline (time.monotonic()) to terminate, then they are killed.
         """
-        
-        root_dir = pathlib.PurePath(self._cfg_obj['hls_dir'])
-        cam_cfg = [ cam for cam in self._cfg_obj['cameras'] if cam['cam_no'] == cam_id ][0]
-        
+        if not self._cfg_obj:
+            raise Exception('No yaml configuration loaded')
+
+        cam_cfg = self._cam_cfg(cam_id)
+        if not cam_cfg:
+            return None
+        if deadline is None:
+            deadline = time.monotonic() + self._cfg_obj.get('stop_timeout', 3)
+
         def cmd():
             if self._cam_obj[cam_id]['cam_thread']:
-                self._cam_obj[cam_id]['cam_thread'].stop()
-                self._cam_obj[cam_id]['cam_thread'].join()
+                self._cam_obj[cam_id]['cam_thread'].terminate()
+                self._cam_obj[cam_id]['cam_thread'].wait(deadline)
                 self._cam_obj[cam_id]['cam_thread'] = None
+                self._cam_obj[cam_id]['playlist'] = None
+                self._cam_obj[cam_id]['activity'] = None
             # cleanup output dir
-            output_dir = pathlib.PurePath(root_dir, str(cam_cfg['cam_no']))
+            self._segments.release(cam_cfg['cam_no'])
+
+        # a pending start of the camera is pointless once stop is requested
+        return self._executor.submit(cam_id, 'stop', cmd, supersedes=('start',))
+
+    def start_many(self, cam_ids):
+        """
+        Submit start-stream commands of several cameras, they are started concurrently.
+        """
+        return [ self.start(cam_id) for cam_id in cam_ids ]
+
+    def stop_many(self, cam_ids, timeout=None):
+        """
+        Stop several cameras with one deadline for all of them and wait for the result.
+
+        SIGTERM is sent to the processes of all running cameras at once, the
+        commands in the lanes then only wait for the shared deadline and kill
+        the stragglers. The total time is bounded by timeout, not by the number
+        of cameras.
+        """
+        if timeout is None:
+            timeout = self._cfg_obj.get('stop_timeout', 3)
+        deadline = time.monotonic() + timeout
+        for cam_id in cam_ids:
+            cam_thread = self._cam_obj.get(cam_id, dict()).get('cam_thread')
+            if cam_thread:
+                cam_thread.terminate()
+        handles = [ h for h in (self.stop(cam_id, deadline) for cam_id in cam_ids) if h ]
+        for handle in handles:
             with suppress(Exception):
-                logging.debug('Removing output directory: %s' % output_dir)
-                shutil.rmtree(str(output_dir))
-        
-        # try to submit the command
-        try:
-            self._cam_obj[cam_id]['cmd_queue'].put(cmd)
-            return self._cam_obj[cam_id]['cmd_queue']
-        except IndexError:
-            logging.warning('Invalid cam-id specified: %d' % cam_id)
-            return
+                # kill() + reaping the killed processes after the deadline
+                handle.result(max(0, deadline - time.monotonic()) + 5)
+        return dict((h.cam_id, h.state) for h in handles)
+
+    def stop_all(self, timeout=None):
+        """
+        Stop all configured cameras, see stop_many().
+        """
+        return self.stop_many(list(self._cam_list), timeout)
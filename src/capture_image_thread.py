@@ -5,8 +5,19 @@ import logging
 import threading
 import time
 
+def _log_capture_result(c_id):
+    def done(future):
+        try:
+            if future.result():
+                logging.debug('Captured image for cam %d' % c_id)
+        except Exception as e:
+            logging.warning('Capturing image for cam %d failed: %s' % (c_id, e))
+    return done
+
 class CaptureImageThread (threading.Thread):
     """CaptureImageThread periodically captures a picture from each cam
+
+    The captures of all cams are submitted at once and run concurrently.
     """
  
     def __init__(self, cam_manager, time_period):
@@ -18,7 +29,9 @@ class CaptureImageThread (threading.Thread):
         while True:
             cam_list = self._cam_manager.cam_list
             for c_id in cam_list:
-                self._cam_manager.capture_image(c_id)
+                future = self._cam_manager.capture_image(c_id)
                 logging.debug('Capturing image for cam %d' % c_id)
+                if future:
+                    future.add_done_callback(_log_capture_result(c_id))
             time.sleep(self._time_period)
  
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Executes the control commands of all cameras
+ * one asyncio event loop thread instead of one thread + queue per camera
+ * commands of one camera are executed in order, cameras run concurrently
+ * blocking commands run in a bounded thread pool
+ * control commands (start/stop...) have priority over background work (the observer
+   updates of the camera handlers), superseded pending commands are coalesced
+"""
+
+import time
+import asyncio
+import logging
+import itertools
+import threading
+import collections
+import concurrent.futures
+
+_command_ids = itertools.count(1)
+
+
+class CommandHandle(object):
+    """
+    Trackable handle of a submitted command
+
+    Wraps a concurrent.futures.Future: result() blocks, 'await handle' works
+    in any asyncio event loop.
+    """
+    def __init__(self, cam_id, name, owner=None):
+        self.id = next(_command_ids)
+        self.cam_id = cam_id
+        self.name = name
+        # submitter of the command, commands of different owners are never coalesced
+        self.owner = owner
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.future = concurrent.futures.Future()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def exception(self, timeout=None):
+        return self.future.exception(timeout)
+
+    def cancel(self):
+        return self.future.cancel()
+
+    def add_done_callback(self, fn):
+        self.future.add_done_callback(lambda f: fn(self))
+
+    def __await__(self):
+        return asyncio.wrap_future(self.future).__await__()
+
+    @property
+    def state(self):
+        if self.future.cancelled():
+            return 'cancelled'
+        if self.future.done():
+            return 'failed' if self.future.exception() else 'done'
+        if self.future.running():
+            return 'running'
+        return 'pending'
+
+    def report(self):
+        return dict(id=self.id, cam_id=self.cam_id, name=self.name, state=self.state,
+                    submitted=self.submitted, started=self.started, finished=self.finished)
+
+
+# priorities of the commands in a lane, background commands are not kept in the history
+CONTROL    = 0
+BACKGROUND = 1
+
+
+class Lane(object):
+    """
+    Pending commands of 1 camera
+
+    Control commands are executed before background commands. Wait times
+    (submission to start of execution) are accounted per lane.
+    """
+    def __init__(self):
+        self.queues = (collections.deque(), collections.deque())
+        self.active = False
+        # handle of the command being executed
+        self.current = None
+        # the camera was removed, the lane is dropped once it is drained
+        self.retired = False
+        self.executed = 0
+        self.coalesced = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues)
+
+    def pop(self):
+        for q in self.queues:
+            if q:
+                return q.popleft()
+        return None
+
+    def report(self):
+        return dict(depth=[ len(q) for q in self.queues ], active=self.active,
+                    executed=self.executed, coalesced=self.coalesced,
+                    wait_avg=self.wait_total / self.executed if self.executed else None,
+                    wait_max=self.wait_max)
+
+
+class CommandExecutor(object):
+    """
+    CommandExecutor runs one lane per camera in a single asyncio event loop
+
+    A lane is only drained while the camera has pending commands, so idle
+    cameras cost nothing. The commands themselves are blocking callables and
+    are run in a thread pool of max_workers threads.
+
+    Pending commands are coalesced on submission:
+     * a command cancels the pending commands it supersedes (e.g. stop -> start)
+     * a command equal to the last pending one of its priority (same name and owner)
+   collapses into it
+    """
+    def __init__(self, max_workers=8, history=256):
+        self._loop = asyncio.new_event_loop()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                           thread_name_prefix='command')
+        self._lock = threading.Lock()
+        # cam_id -> Lane
+        self._lanes = dict()
+        self._history = collections.deque(maxlen=history)
+        self._thread = threading.Thread(target=self._run, name='CommandExecutor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def loop(self):
+        return self._loop
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    def submit(self, cam_id, name, fn, priority=CONTROL, supersedes=(), owner=None):
+        """Appends fn to the lane of cam_id and returns a CommandHandle
+
+        Pending commands of the lane named in supersedes are cancelled. If the
+        last pending command of the same priority has the same name and owner
+        (e.g. the handler of the camera that submitted it), its handle is
+        returned instead and fn is dropped.
+        """
+        with self._lock:
+            lane = self._lanes.setdefault(cam_id, Lane())
+            lane.retired = False
+            for q in lane.queues:
+                for pending in [ p for p in q if p[0].name in supersedes ]:
+                    q.remove(pending)
+                    pending[0].cancel()
+                    lane.coalesced += 1
+            q = lane.queues[priority]
+            if q and q[-1][0].name == name and q[-1][0].owner is owner:
+                lane.coalesced += 1
+                return q[-1][0]
+            handle = CommandHandle(cam_id, name, owner)
+            if priority == CONTROL:
+                self._history.append(handle)
+            q.append((handle, fn))
+            if not lane.active:
+                lane.active = True
+                self._loop.call_soon_threadsafe(self._loop.create_task, self._drain(cam_id, lane))
+        return handle
+
+    async def _drain(self, cam_id, lane):
+        while True:
+            with self._lock:
+                item = lane.pop()
+                if item is None:
+                    lane.active = False
+                    if lane.retired and self._lanes.get(cam_id) is lane:
+                        del self._lanes[cam_id]
+                    return
+            handle, fn = item
+            if not handle.future.set_running_or_notify_cancel():
+                continue
+            lane.current = handle
+            handle.started = time.time()
+            wait = handle.started - handle.submitted
+            lane.executed += 1
+            lane.wait_total += wait
+            lane.wait_max = max(lane.wait_max, wait)
+            try:
+                result = await self._loop.run_in_executor(self._pool, fn)
+            except Exception as e:
+                # catch all exceptions if submitted command fails
+                logging.exception('Command %s for cam %s failed' % (handle.name, cam_id))
+                handle.finished = time.time()
+                handle.future.set_exception(e)
+            else:
+                handle.finished = time.time()
+                handle.future.set_result(result)
+            lane.current = None
+
+    def pending(self, cam_id, name):
+        """True if a command of the name is queued or being executed in the lane of cam_id"""
+        with self._lock:
+            lane = self._lanes.get(cam_id)
+            if lane is None:
+                return False
+            if lane.current is not None and lane.current.name == name:
+                return True
+            return any(h.name == name for q in lane.queues for h,_ in q)
+
+    def retire(self, cam_id):
+        """Drops the lane of a removed camera after its pending commands"""
+        with self._lock:
+            lane = self._lanes.get(cam_id)
+            if lane is None:
+                return
+            lane.retired = True
+            if not lane.active:
+                del self._lanes[cam_id]
+
+    def commands(self, cam_id=None):
+        """Reports the recently submitted commands"""
+        return [ h.report() for h in list(self._history) if cam_id is None or h.cam_id == cam_id ]
+
+    def metrics(self, cam_id=None):
+        """Reports queue depth (per priority) and wait times per camera"""
+        with self._lock:
+            return dict((c, lane.report()) for c,lane in self._lanes.items()
+                        if cam_id is None or c == cam_id)
+
+    def shutdown(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._pool.shutdown(wait=True)
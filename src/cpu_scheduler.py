@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Distributes the cpu cores among the transcoding processes of the cameras
+ * cost of a camera = sum of the costs of its renditions
+ * core set (sched_setaffinity), encoder thread count and nice level per camera
+ * a new process gets core set and nice level right after it was started, applied to all
+   of its threads (a fork in the threaded backend must not run python code before exec)
+ * rebalances whenever a camera is started or stopped
+"""
+
+import os
+import logging
+import threading
+
+
+class CpuScheduler(object):
+    """
+    CpuScheduler assigns a core set to every running camera
+
+    Configuration (all keys optional):
+        reserved_cores: cores that are never assigned (e.g. for the RPC thread)
+        cost:           cost per encoder, e.g. {libx264: 1.0, copy: 0.05}
+        default_cost:   cost of encoders missing in 'cost'
+        nice:           nice level of the transcoding processes
+    A rendition may override its cost with the key 'cost'.
+
+    Every camera gets a number of cores proportional to its share of the total
+    cost (at least 1), taken from the least loaded cores.
+    """
+    DEFAULT_COST = {'copy': 0.05, 'mjpeg': 0.1}
+
+    def __init__(self, cfg=None):
+        cfg = cfg or dict()
+        reserved = set(cfg.get('reserved_cores', [0]))
+        available = sorted(os.sched_getaffinity(0))
+        self._cores = [ c for c in available if c not in reserved ] or available
+        self._cost = dict(self.DEFAULT_COST, **cfg.get('cost', dict()))
+        self._default_cost = cfg.get('default_cost', 1.0)
+        self._nice = cfg.get('nice', 5)
+        self._lock = threading.Lock()
+        # cam_id -> cost
+        self._cameras = dict()
+        # cam_id -> set of pids
+        self._pids = dict()
+        # cam_id -> list of cores
+        self._assignment = dict()
+
+    def rendition_cost(self, rendition):
+        if 'cost' in rendition:
+            return float(rendition['cost'])
+        return float(self._cost.get(rendition.get('encoder'), self._default_cost))
+
+    def add(self, cam_id, renditions):
+        """Registers a starting camera and rebalances"""
+        with self._lock:
+            self._cameras[cam_id] = sum(self.rendition_cost(r) for r in renditions) or self._default_cost
+            self._pids.setdefault(cam_id, set())
+            self._rebalance()
+
+    def remove(self, cam_id):
+        """Unregisters a stopped camera and rebalances"""
+        with self._lock:
+            self._cameras.pop(cam_id, None)
+            self._pids.pop(cam_id, None)
+            self._assignment.pop(cam_id, None)
+            self._rebalance()
+
+    def threads(self, cam_id):
+        """Number of encoder threads of the camera, shared by its processes and outputs"""
+        with self._lock:
+            return len(self._assignment.get(cam_id, self._cores))
+
+    def attach(self, cam_id, pid):
+        """Applies the assignment of the camera to a new or adopted process"""
+        with self._lock:
+            self._pids.setdefault(cam_id, set()).add(pid)
+            cores = self._assignment.get(cam_id)
+        if cores:
+            self._apply(pid, cores)
+
+    def detach(self, cam_id, pid):
+        with self._lock:
+            self._pids.get(cam_id, set()).discard(pid)
+
+    def report(self):
+        with self._lock:
+            return dict((cam_id, dict(cores=cores, threads=len(cores), nice=self._nice,
+                                      cost=self._cameras[cam_id], pids=sorted(self._pids[cam_id])))
+                        for cam_id,cores in self._assignment.items())
+
+    def _rebalance(self):
+        costs = self._cameras
+        total = sum(costs.values())
+        if costs and total <= 0:
+            # all cameras configured without cost: equal shares
+            costs = dict((cam_id, 1.0) for cam_id in costs)
+            total = len(costs)
+        load = dict((c, 0.0) for c in self._cores)
+        assignment = dict()
+        for cam_id,cost in sorted(costs.items(), key=lambda i: (-i[1], i[0])):
+            n = max(1, min(len(self._cores), int(round(cost / total * len(self._cores)))))
+            cores = sorted(sorted(self._cores, key=lambda c: (load[c], c))[:n])
+            for c in cores:
+                load[c] += cost / n
+            assignment[cam_id] = cores
+        changed = [ cam_id for cam_id,cores in assignment.items() if self._assignment.get(cam_id) != cores ]
+        self._assignment = assignment
+        for cam_id in changed:
+            logging.info('Cam %s assigned to cores %s' % (cam_id, assignment[cam_id]))
+            for pid in self._pids.get(cam_id, ()):
+                self._apply(pid, assignment[cam_id])
+
+    def _apply(self, pid, cores):
+        # affinity and nice level are per thread on Linux, threads created
+        # later inherit them from their creator
+        try:
+            tids = [ int(t) for t in os.listdir('/proc/%d/task' % (pid)) ]
+        except FileNotFoundError:
+            return
+        for tid in tids:
+            try:
+                if cores:
+                    os.sched_setaffinity(tid, cores)
+                os.setpriority(os.PRIO_PROCESS, tid, self._nice)
+            except (ProcessLookupError, PermissionError) as e:
+                logging.debug('Could not schedule task %d: %s' % (tid, e))
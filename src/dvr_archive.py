@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+DVR archive of the retained cameras
+ * segments are appended to hourly data files <root>/<cam_no>/<YYYY-MM-DD>/<HH>.ts|.m4s (UTC)
+ * every data file has an append-only index of fixed size records
+   (wall clock, duration, start pts, byte offset, size) and one of its fmp4 init segments
+ * time range queries bisect the partitions and their indexes, O(log n)
+ * a VOD playlist spans at most MAX_WINDOW seconds
+ * VOD playlists address the segments with #EXT-X-BYTERANGE
+ * retention by age and total size deletes whole partitions, no directory walks
+"""
+
+import os
+import math
+import time
+import mmap
+import bisect
+import struct
+import logging
+import pathlib
+import threading
+
+from segment_analyser import segment_start_pts
+
+# wall clock (start), duration, pts (-1 if unknown), offset, size, kind
+RECORD = struct.Struct('<dfqQIB3x')
+MEDIA = 0
+INIT  = 1
+# a gap in wall clock larger than this starts a new discontinuity
+MAX_GAP = 1.0
+# longest time window of a playlist in seconds
+MAX_WINDOW = 6 * 3600
+# suffixes of the index of all records and of the index of the init records
+INDEX = '.idx'
+INIT_INDEX = '.init.idx'
+
+
+class Record(object):
+    __slots__ = ('partition', 'wall', 'duration', 'pts', 'offset', 'size', 'kind')
+
+    def __init__(self, partition, wall, duration, pts, offset, size, kind):
+        self.partition = partition
+        self.wall = wall
+        self.duration = duration
+        self.pts = pts
+        self.offset = offset
+        self.size = size
+        self.kind = kind
+
+
+class Index(object):
+    """
+    Read-only view of the index of a partition
+
+    Records that are appended while the view is used are not seen. As a
+    sequence of wall clock times it can be searched with bisect.
+    """
+    def __init__(self, filename):
+        self._map = None
+        self._count = 0
+        try:
+            with open(str(filename), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                # a record that is being appended is ignored
+                self._count = size // RECORD.size
+                if self._count:
+                    self._map = mmap.mmap(f.fileno(), self._count * RECORD.size, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i):
+        return RECORD.unpack_from(self._map, i * RECORD.size)[0]
+
+    def record(self, partition, i):
+        return Record(partition, *RECORD.unpack_from(self._map, i * RECORD.size))
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+
+
+class Partition(object):
+    """Hourly data file of a camera"""
+    __slots__ = ('name', 'start', 'size')
+
+    def __init__(self, name, start, size):
+        # data file relative to the camera, e.g. 2024-05-01/02.ts
+        self.name = name
+        self.start = start
+        self.size = size
+
+
+class DvrArchive(object):
+    """
+    DvrArchive keeps the segments of the retained cameras
+
+    append() is called by a single writer (the write-behind thread), queries
+    may run concurrently in any thread. The partitions of every camera are
+    kept in memory (ordered by start) along with their sizes, so retention
+    never has to walk the directories.
+    """
+    def __init__(self, root, max_age=None, max_bytes=None):
+        self._root = pathlib.Path(root)
+        self._max_age = max_age
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # cam_no -> ordered list of Partition
+        self._partitions = dict()
+        # cam_no -> init segment (bytes) of the current fmp4 stream
+        self._init = dict()
+        # cam_no -> (partition name, init segment) last written to the archive
+        self._written_init = dict()
+        # cam_no -> wall clock of the newest segment, the indexes stay sorted
+        self._newest = dict()
+        self.appended = 0
+        self.deleted = 0
+
+    @property
+    def root(self):
+        return self._root
+
+    def _load(self, cam_no):
+        """Returns the partitions of a camera, read from disk once"""
+        partitions = self._partitions.get(cam_no)
+        if partitions is not None:
+            return partitions
+        partitions = list()
+        cam_dir = self._root / str(cam_no)
+        for day in sorted(os.listdir(str(cam_dir))) if cam_dir.is_dir() else list():
+            for name in sorted(os.listdir(str(cam_dir / day))):
+                if name.endswith(INDEX):
+                    continue
+                index = Index(cam_dir / day / (name + INDEX))
+                if len(index):
+                    partitions.append(Partition('%s/%s' % (day, name), index[0],
+                                                (cam_dir / day / name).stat().st_size))
+                index.close()
+        partitions.sort(key=lambda p: p.start)
+        if partitions:
+            index = Index(cam_dir / (partitions[-1].name + INDEX))
+            self._newest[cam_no] = index[len(index) - 1]
+            index.close()
+        self._partitions[cam_no] = partitions
+        return partitions
+
+    def append(self, cam_no, segment_file, duration, init=False):
+        """Appends a finished segment (or a fmp4 init segment) to the archive"""
+        segment_file = pathlib.Path(segment_file)
+        with segment_file.open('rb') as f:
+            data = f.read()
+            finished = os.fstat(f.fileno()).st_mtime
+        if init:
+            # written ahead of the next segment, in every partition that needs it
+            self._init[cam_no] = data
+            return
+        pts = segment_start_pts(segment_file)
+        duration = duration or 0.0
+        wall = finished - duration
+        suffix = segment_file.suffix
+        name = time.strftime('%Y-%m-%d/%H', time.gmtime(wall)) + suffix
+        with self._lock:
+            partitions = self._load(cam_no)
+            if wall <= self._newest.get(cam_no, 0):
+                # already archived, e.g. listed again after the backend was restarted
+                return
+            self._newest[cam_no] = wall
+            partition = next((p for p in reversed(partitions[-2:]) if p.name == name), None)
+            if partition is None:
+                partition = Partition(name, wall, 0)
+                partitions.append(partition)
+                partitions.sort(key=lambda p: p.start)
+        data_file = self._root / str(cam_no) / name
+        data_file.parent.mkdir(parents=True, exist_ok=True)
+        records = list()
+        init_data = self._init.get(cam_no) if suffix != '.ts' else None
+        if init_data is not None:
+            written = self._written_init.get(cam_no)
+            if written is None or written[0] != partition.name:
+                written = (partition.name, self._last_init(cam_no, partition))
+            if written[1] != init_data:
+                records.append((init_data, wall, 0.0, -1, INIT))
+            self._written_init[cam_no] = (partition.name, init_data)
+        records.append((data, wall, duration, -1 if pts is None else pts, MEDIA))
+        # the data is written before its index records (init index first), readers never
+        # see missing data
+        with data_file.open('ab') as f:
+            offset = f.tell()
+            entries = list()
+            for payload, r_wall, r_duration, r_pts, kind in records:
+                f.write(payload)
+                entries.append(RECORD.pack(r_wall, r_duration, r_pts, offset, len(payload), kind))
+                offset += len(payload)
+        if len(entries) > 1:
+            with open(str(data_file) + INIT_INDEX, 'ab') as f:
+                f.write(entries[0])
+        with open(str(data_file) + INDEX, 'ab') as f:
+            f.write(b''.join(entries))
+        with self._lock:
+            partition.size = offset
+            self.appended += 1
+        self._enforce(cam_no)
+
+    def _last_init(self, cam_no, partition):
+        """Init segment in effect at the end of a partition (bytes) or None"""
+        inits = Index(self._root / str(cam_no) / (partition.name + INIT_INDEX))
+        try:
+            if not len(inits):
+                return None
+            r = inits.record(partition.name, len(inits) - 1)
+            with (self._root / str(cam_no) / partition.name).open('rb') as f:
+                f.seek(r.offset)
+                return f.read(r.size)
+        finally:
+            inits.close()
+
+    def _enforce(self, cam_no):
+        """Deletes the oldest partitions of the camera while over age or size"""
+        while True:
+            with self._lock:
+                partitions = self._partitions[cam_no]
+                if len(partitions) < 2:
+                    # the partition being written is never deleted
+                    return
+                total = sum(p.size for p in partitions)
+                oldest = partitions[0]
+                expired = self._max_age and partitions[1].start < time.time() - self._max_age
+                if not expired and not (self._max_bytes and total > self._max_bytes):
+                    return
+                del partitions[0]
+                self.deleted += 1
+            logging.info('DVR of cam %s: deleting %s' % (cam_no, oldest.name))
+            data_file = self._root / str(cam_no) / oldest.name
+            for filename in (str(data_file) + INDEX, str(data_file) + INIT_INDEX, str(data_file)):
+                try:
+                    os.unlink(filename)
+                except FileNotFoundError:
+                    pass
+            try:
+                data_file.parent.rmdir()
+            except OSError:
+                # other partitions of the day
+                pass
+
+    def query(self, cam_no, start, end):
+        """Returns the records of the segments that overlap [start, end)
+
+        Every fmp4 segment is preceded by the init record it needs.
+        """
+        with self._lock:
+            partitions = list(self._load(cam_no))
+        starts = [ p.start for p in partitions ]
+        # the partition that contains start may begin before it
+        first = max(0, bisect.bisect_right(starts, start) - 1)
+        result = list()
+        for partition in partitions[first:]:
+            if partition.start >= end:
+                break
+            index = Index(self._root / str(cam_no) / (partition.name + INDEX))
+            inits = Index(self._root / str(cam_no) / (partition.name + INIT_INDEX))
+            try:
+                # the segment that contains start begins at most 1 segment before it
+                i = max(0, bisect.bisect_right(index, start) - 1)
+                init = None
+                if len(index) and len(inits):
+                    # init segment in effect at i, it has the wall clock of its first segment
+                    k = bisect.bisect_right(inits, index[i]) - 1
+                    init = inits.record(partition.name, k) if k >= 0 else None
+                for j in range(i, len(index)):
+                    r = index.record(partition.name, j)
+                    if r.wall >= end:
+                        break
+                    if r.kind == INIT:
+                        init = r
+                    elif r.wall + r.duration > start:
+                        if init is not None:
+                            result.append(init)
+                            init = None
+                        result.append(r)
+            finally:
+                index.close()
+                inits.close()
+        return result
+
+    def playlist(self, cam_no, start, end):
+        """Returns the VOD playlist (bytes) of the time window, URIs relative to <root>/<cam_no>
+
+        The window ends at most MAX_WINDOW seconds after start.
+        """
+        records = self.query(cam_no, start, min(end, start + MAX_WINDOW))
+        media = [ r for r in records if r.kind == MEDIA ]
+        version = 7 if any(r.kind == INIT for r in records) else 4
+        lines = [ '#EXTM3U', '#EXT-X-VERSION:%d' % (version), '#EXT-X-PLAYLIST-TYPE:VOD',
+                  '#EXT-X-TARGETDURATION:%d' % (math.ceil(max([ r.duration for r in media ] or [ 1 ]))),
+                  '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-INDEPENDENT-SEGMENTS' ]
+        previous = None
+        for r in records:
+            if r.kind == INIT:
+                # every partition has its own copy, a changed stream shows up as a gap below
+                lines.append('#EXT-X-MAP:URI="%s",BYTERANGE="%d@%d"' % (r.partition, r.size, r.offset))
+                continue
+            gap = previous is not None and (abs(r.wall - (previous.wall + previous.duration)) > MAX_GAP
+                                            or (r.pts >= 0 and 0 <= previous.pts and r.pts < previous.pts))
+            if gap:
+                lines.append('#EXT-X-DISCONTINUITY')
+            if previous is None or gap:
+                lines.append('#EXT-X-PROGRAM-DATE-TIME:%s.%03dZ'
+                             % (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(r.wall)),
+                                int(r.wall * 1000) % 1000))
+            lines.append('#EXTINF:%.3f,' % (r.duration))
+            lines.append('#EXT-X-BYTERANGE:%d@%d' % (r.size, r.offset))
+            lines.append(r.partition)
+            previous = r
+        lines.append('#EXT-X-ENDLIST')
+        return ('\n'.join(lines) + '\n').encode()
+
+    def report(self, cam_nos):
+        with self._lock:
+            cameras = dict()
+            for cam_no in cam_nos:
+                partitions = self._load(cam_no)
+                cameras[cam_no] = dict(partitions=len(partitions),
+                                       bytes=sum(p.size for p in partitions),
+                                       oldest=partitions[0].start if partitions else None)
+            return dict(cameras=cameras, appended=self.appended, deleted=self.deleted)
+
+
+def parse_time(value):
+    """Seconds since the epoch of a number or of a local 'YYYY-MM-DD HH:MM[:SS]' (also with T)"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value).replace('T', ' ')
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M'):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    return float(value)
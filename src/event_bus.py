@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Events of the backend for clients that should not have to poll
+ * topics: cam.<cam_id>.<event>, subscribe to 'cam.<cam_id>.' for one camera
+ * every event carries a sequence number (gaps = missed events) and a timestamp
+"""
+
+import time
+import logging
+import itertools
+import threading
+
+
+def topic(cam_id, event):
+    return 'cam.%s.%s' % (cam_id, event)
+
+
+class EventBus(object):
+    """
+    EventBus forwards the published events to the attached sinks
+
+    publish() may be called from any thread, a sink is called as
+    sink(topic, event) and must not block (e.g. hand over to an event loop).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sinks = list()
+        self._seq = itertools.count(1)
+
+    def attach(self, sink):
+        with self._lock:
+            self._sinks.append(sink)
+
+    def detach(self, sink):
+        with self._lock:
+            self._sinks.remove(sink)
+
+    def publish(self, cam_id, event, **data):
+        with self._lock:
+            sinks = list(self._sinks)
+            seq = next(self._seq)
+        if not sinks:
+            return
+        message = dict(data, cam_id=cam_id, event=event, seq=seq, time=time.time())
+        for sink in sinks:
+            try:
+                sink(topic(cam_id, event), message)
+            except Exception:
+                # a broken sink must not break the publisher
+                logging.exception('Event sink %s failed' % (sink))
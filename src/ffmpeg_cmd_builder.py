@@ -5,8 +5,51 @@ import pathlib
 import subprocess
 import shlex
 import json
+import itertools
 from abc import ABC
 
+# default target duration of HLS segments in seconds
+HLS_TIME = 5
+# number of segments in the live playlist (and on disk) per rendition
+HLS_RING_SIZE = 10
+
+# built-in latency profiles of a source (latency: <name> or {hls_time: ..., ...})
+#  * hls_time: target segment duration in seconds
+#  * container: ts or fmp4 (CMAF segments + init segment)
+#  * keyframe_interval: forced keyframes every N seconds at the same timestamps in all
+#    renditions (None: encoder default GOP), segments are cut at these keyframes
+#  * program_date_time: wall clock of every segment in the variant playlist
+LATENCY_PROFILES = {
+    'standard': dict(hls_time=HLS_TIME, container='ts', keyframe_interval=None,
+                     program_date_time=False, ring_size=HLS_RING_SIZE),
+    'low':      dict(hls_time=2, container='fmp4', keyframe_interval=2,
+                     program_date_time=True, ring_size=8),
+    'lowest':   dict(hls_time=1, container='fmp4', keyframe_interval=1,
+                     program_date_time=True, ring_size=8),
+}
+
+def latency_profile(latency=None, profiles=None):
+    """Returns the complete latency profile of a source
+
+    latency is the name of a profile (of profiles or the built-in ones) or a
+    dict that overrides the keys of the profile named by its 'profile' key
+    (default 'standard').
+    """
+    profiles = dict(LATENCY_PROFILES, **(profiles or dict()))
+    overrides = dict()
+    if isinstance(latency, dict):
+        overrides = dict(latency)
+        latency = overrides.pop('profile', 'standard')
+    if latency is None:
+        latency = 'standard'
+    if latency not in profiles:
+        raise ValueError('Unknown latency profile: %s' % (latency))
+    profile = dict(LATENCY_PROFILES['standard'], **profiles[latency])
+    profile.update(overrides)
+    if profile['container'] not in ('ts', 'fmp4'):
+        raise ValueError('Unknown segment container: %s' % (profile['container']))
+    return profile
+
 def analyse_input_format(uri):
     ffprobe_cmd = "ffprobe -v quiet -show_entries stream=width,height -print_format json -show_format %s" % (uri)
     try:
@@ -20,32 +63,96 @@ def analyse_input_format(uri):
 class FFMPEGCmdBuilder(object):
     """
     Builder that implementes the construction of a ffmpeg command line
+
+    The input is decoded once and scaled once per distinct output width: a
+    single filter_complex splits the decoded video and scales the rendition
+    ladder in cascade (each width is scaled from the next larger one).
+    Outputs with the encoder 'copy' remux the source without decoding.
     """
-    def __init__(self, uri_input, decoder_str):
-        self.ffmpeg_cmd = "ffmpeg -loglevel warning -vcodec %s -i \"%s\" " % (decoder_str, uri_input)
+    def __init__(self, uri_input, decoder_str, progress_url = None):
+        self.ffmpeg_cmd = "ffmpeg -loglevel warning "
+        if progress_url:
+            # machine readable progress instead of the status line
+            self.ffmpeg_cmd += "-nostats -progress %s " % (progress_url)
+        self.ffmpeg_cmd += "-vcodec %s -i \"%s\" " % (decoder_str, uri_input)
+        self.output_streams = list()
 
     def addOutputStream(self, output_stream):
-        self.ffmpeg_cmd += str(output_stream) + " "
+        self.output_streams.append(output_stream)
+
+    def _filter_graph(self):
+        """Assigns the map labels of the output streams and returns the filter graph"""
+        graph  = list()
+        labels = itertools.count()
+
+        def fanout(src, chain, n):
+            # returns n labels that carry src filtered by chain
+            if not chain and n == 1:
+                return [src]
+            out = [ 'v%d' % next(labels) for _ in range(n) ]
+            node = ','.join(([chain] if chain else []) + (['split=%d' % n] if n > 1 else []))
+            graph.append('[%s]%s%s' % (src, node, ''.join('[%s]' % l for l in out)))
+            return out
+
+        decoded = [ s for s in self.output_streams if not s.is_copy ]
+        widths  = sorted(set(s['video_width'] for s in decoded if s['video_width']), reverse=True)
+        levels  = [ (None, '') ] + [ (w, 'scale=%d:-2' % (w)) for w in widths ]
+        src = '0:v'
+        for idx,(width,chain) in enumerate(levels):
+            consumers = [ s for s in decoded if s['video_width'] == width ]
+            cascade = 1 if idx + 1 < len(levels) else 0
+            if not consumers and not cascade:
+                continue
+            out = fanout(src, chain, len(consumers) + cascade)
+            for stream,label in zip(consumers, out):
+                if stream['video_filter']:
+                    label = fanout(label, stream['video_filter'], 1)[0]
+                stream.map_label = label if label == '0:v' else '[%s]' % (label)
+            if cascade:
+                src = out[-1]
+
+        for stream in self.output_streams:
+            if stream.is_copy:
+                stream.map_label = '0:v'
+        return ';'.join(graph)
 
     def getCmd(self):
-        return self.ffmpeg_cmd
+        cmd = self.ffmpeg_cmd
+        graph = self._filter_graph()
+        if graph:
+            cmd += '-filter_complex "%s" ' % (graph)
+        for output_stream in self.output_streams:
+            cmd += str(output_stream) + " "
+        return cmd
 
 class FFMPEGOutputStream(ABC):
     """
     Base class for ffmpeg output streams
+
+    video_width and video_filter are applied by the filter graph of the
+    FFMPEGCmdBuilder, which also sets the map_label of the stream.
     """
     cmd_mapping = {
-            'video_width'    : '-vf scale=%d:-1',
             'video_framerate': '-r %d',
-            'encoder_str'    : '-vcodec %s'
+            'encoder_str'    : '-vcodec %s',
+            'video_bitrate'  : '-b:v %s',
+            'threads'        : '-threads %d'
     }
 
     def __init__(self, encoder_str):
         self.cmd_args = dict()
         self.cmd_args['video_width']     = None
+        self.cmd_args['video_filter']    = None
         self.cmd_args['video_framerate'] = None
         self.cmd_args['encoder_str']     = encoder_str
+        self.cmd_args['video_bitrate']   = None
+        self.cmd_args['threads']         = None
         self.extra_args = ''
+        self.map_label = '0'
+
+    @property
+    def is_copy(self):
+        return self.cmd_args['encoder_str'] == 'copy'
 
     def __getitem__(self, key):
         return self.cmd_args[key]
@@ -54,9 +161,12 @@ class FFMPEGOutputStream(ABC):
         self.cmd_args[key] = value
 
     def __str__(self):
-        args = '-map 0 '
+        args = '-map %s ' % (self.map_label)
         for key in self.cmd_args.keys():
-            if self.cmd_args[key]:
+            if self.cmd_args[key] and key in self.cmd_mapping:
+                if key in ('video_framerate', 'video_bitrate', 'threads') and self.is_copy:
+                    # a remuxed stream keeps the framerate of the source
+                    continue
                 args += (self.cmd_mapping[key] % (self.cmd_args[key])) + " "
 
         return (args + self.extra_args) 
@@ -65,25 +175,95 @@ class FFMPEGOutputStream(ABC):
 class FFMPEGHlsStream(FFMPEGOutputStream):
     """
     Specialization of FFMPEGOutputStream to HLS stream
+
+    With a keyframe_interval, all renditions of a camera get keyframes at the
+    same timestamps, so their segments are aligned (seamless ABR switches).
+    A remuxed ('copy') stream keeps the GOP of the camera.
     """
-    def __init__(self, playlist_file, encoder_str = 'libx264'):
+    def __init__(self, playlist_file, encoder_str = 'libx264', hls_time = HLS_TIME, ring_size = HLS_RING_SIZE,
+                 container = 'ts', keyframe_interval = None, program_date_time = False, append = False):
         super().__init__(encoder_str)
         self.playlist_file = playlist_file
-        self.extra_args = ' '.join("-an -f hls -preset ultrafast -hls_wrap 10 -hls_flags delete_segments \
-                          -segment_list_size 10 -segment_list_flags +live -hls_time 5 ".split())
+        self.hls_time = hls_time
+        self.container = container
+        self.cmd_mapping = dict(self.cmd_mapping, hls_segment_filename = '-hls_segment_filename %s')
+        # ring of ring_size segments: ffmpeg deletes the segments that left the playlist,
+        # segments are written to .tmp and renamed, so they are never served half-written
+        flags = [ 'delete_segments', 'temp_file', 'independent_segments' ]
+        if program_date_time:
+            flags.append('program_date_time')
+        if append:
+            # a replaced process continues the playlist and the segment numbers, the stopped
+            # process must not end the playlist for the players
+            flags += [ 'append_list', 'omit_endlist' ]
+        # segments are numbered from the start time of the process, a replaced process never
+        # reuses the names of its predecessor (the origin caches segments as immutable)
+        args = [ '-an', '-f hls -hls_list_size %d -hls_delete_threshold 1' % (ring_size),
+                 '-hls_flags %s -hls_time %g' % ('+'.join(flags), hls_time),
+                 '-hls_start_number_source epoch' ]
+        if container == 'fmp4':
+            args.append('-hls_segment_type fmp4 -hls_fmp4_init_filename %s' % (self.init_file.name))
+        if not self.is_copy:
+            args.insert(0, '-preset ultrafast')
+            if keyframe_interval:
+                args.append('-force_key_frames expr:gte(t,n_forced*%g)' % (keyframe_interval))
+        self.extra_args = ' '.join(args)
+
+    @property
+    def init_file(self):
+        """Initialization segment of fmp4 renditions"""
+        return self.playlist_file.with_name(self.playlist_file.stem + '_init.mp4')
 
     def __str__(self):
-        self.cmd_args['hls_segment_filename'] = self.playlist_file.with_suffix('.%03d.ts')
-        self.cmd_mapping['hls_segment_filename'] = '-hls_segment_filename %s'
+        suffix = '.%03d.m4s' if self.container == 'fmp4' else '.%03d.ts'
+        self.cmd_args['hls_segment_filename'] = self.playlist_file.with_suffix(suffix)
         return super(FFMPEGHlsStream, self).__str__() + ' ' + str(self.playlist_file)
 
 
-if __name__ == '__main__':
-    s = FFMPEGHlsStream('/path/to/playlist', 'enc_xx', 'dec_xx')
-    s['video_width'] = 960
-    s['video_framerate'] = 10
+class FFMPEGSnapshotStream(FFMPEGOutputStream):
+    """
+    Specialization of FFMPEGOutputStream to a downscaled JPEG, that is updated
+    in place every interval seconds from the already decoded frames
+    """
+    def __init__(self, image_file, interval = 10, width = 320):
+        super().__init__('mjpeg')
+        self.image_file = image_file
+        self.cmd_args['video_width']  = width
+        self.cmd_args['video_filter'] = 'fps=1/%d' % (interval)
+        self.extra_args = '-an -f image2 -update 1 -q:v 5'
 
-    ffmpeg_obj = FFMPEGCmdBuilder('/path/to/media/source')
-    ffmpeg_obj.addOutputStream(s)
+    def __str__(self):
+        return super(FFMPEGSnapshotStream, self).__str__() + ' ' + str(self.image_file)
+
+
+class FFMPEGActivityStream(FFMPEGOutputStream):
+    """
+    Specialization of FFMPEGOutputStream to a tiny grayscale PGM image for the
+    activity detection, updated in place every interval seconds
+    """
+    def __init__(self, image_file, interval = 2, width = 64):
+        super().__init__('pgm')
+        self.image_file = image_file
+        self.cmd_args['video_width']  = width
+        self.cmd_args['video_filter'] = 'fps=1/%g,format=gray' % (interval)
+        self.extra_args = '-an -f image2 -update 1'
+
+    def __str__(self):
+        return super(FFMPEGActivityStream, self).__str__() + ' ' + str(self.image_file)
+
+
+if __name__ == '__main__':
+    ffmpeg_obj = FFMPEGCmdBuilder('/path/to/media/source', 'h264')
+    for width in (None, 1280, 640, 640):
+        s = FFMPEGHlsStream(pathlib.Path('/path/to/playlist_%s.m3u' % (width)))
+        s['video_width'] = width
+        s['video_framerate'] = 10
+        ffmpeg_obj.addOutputStream(s)
+    ffmpeg_obj.addOutputStream(FFMPEGHlsStream(pathlib.Path('/path/to/playlist_copy.m3u'), 'copy'))
+    low = latency_profile('low')
+    ffmpeg_obj.addOutputStream(FFMPEGHlsStream(pathlib.Path('/path/to/playlist_low.m3u'), 'libx264',
+        low['hls_time'], low['ring_size'], low['container'], low['keyframe_interval'], low['program_date_time']))
+    ffmpeg_obj.addOutputStream(FFMPEGSnapshotStream(pathlib.Path('/path/to/snapshot.jpg')))
+    ffmpeg_obj.addOutputStream(FFMPEGActivityStream(pathlib.Path('/path/to/activity.pgm')))
 
     print(ffmpeg_obj.getCmd())
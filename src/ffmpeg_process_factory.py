@@ -2,7 +2,8 @@
 # -*- coding: utf8 -*-
 
 from process_factory import ProcessFactory
-from ffmpeg_cmd_builder import FFMPEGCmdBuilder, FFMPEGHlsStream
+from ffmpeg_cmd_builder import FFMPEGCmdBuilder, FFMPEGHlsStream, FFMPEGSnapshotStream, FFMPEGActivityStream, \
+                               latency_profile
 
 import hashlib
 import logging
@@ -25,16 +26,64 @@ class FfmpegProcessFactory(ProcessFactory):
 
     def __init__(self, src, target_dir):
         super().__init__()
-        self._process_descriptor, self.files = FfmpegProcessFactory._ffmpeg_context_creator(src, target_dir)
+        self._process_descriptor, self.files, self.snapshot_file, self._streams, self.activity_file = \
+                FfmpegProcessFactory._ffmpeg_context_creator(src, target_dir)
+        self.snapshot_interval = src.get('snapshot', dict()).get('interval', 10)
+        # activity: {interval, threshold, idle_after, min_dwell, idle: {framerate, bitrate}}, see activity_monitor
+        self.activity = src.get('activity')
+        self.latency = FfmpegProcessFactory._latency(src)
+        self.hls_time = self.latency['hls_time']
+        self.renditions = list(src['streams'])
+        if src.get('snapshot'):
+            self.renditions.append(dict(src['snapshot'], encoder='mjpeg'))
 
     def factoryMethods(self):
         """A callable process closure
+
+        The closure takes the optional number of encoder threads of the process
+        (split among its encoded outputs) and detached, which starts ffmpeg in its own
+        session so that it survives the backend.
         """
         return self._process_descriptor
 
     def fileList(self):
         return self.files
 
+    def segmentDuration(self):
+        """Target duration (hls_time) of the segments in seconds
+        """
+        return self.hls_time
+
+    def snapshotFile(self):
+        """JPEG that ffmpeg updates every snapshot_interval seconds or None
+        """
+        return self.snapshot_file
+
+    def activityFile(self):
+        """Grayscale PGM that ffmpeg updates for the activity detection or None
+        """
+        return self.activity_file
+
+    def setActivity(self, idle):
+        """Selects the active or idle rendition profile for the next process
+
+        While idle, the encoded streams use the framerate/bitrate of activity['idle'].
+        """
+        self.idle = idle
+        overrides = self.activity.get('idle', dict()) if idle else dict()
+        for stream, cfg in self._streams:
+            framerate = overrides.get('framerate', cfg['framerate'])
+            stream['video_framerate'] = int(framerate) if framerate != 'default' else None
+            stream['video_bitrate'] = overrides.get('bitrate', cfg.get('bitrate'))
+
+    def _latency(stream_src):
+        """Latency profile of a source, hls_time/ring_size of the source take precedence"""
+        profile = latency_profile(stream_src.get('latency'))
+        for key in ('hls_time', 'ring_size'):
+            if key in stream_src:
+                profile[key] = stream_src[key]
+        return profile
+
     def _ffmpeg_context_creator(stream_src, target_dir):
         """ffmpeg_context_creator returns a function that can be executed to create a ffmpeg instance
     
@@ -43,24 +92,56 @@ class FfmpegProcessFactory(ProcessFactory):
 
         uri         = stream_src['uri']
         decoder_str = stream_src['decoder']
-        ffmpeg_obj  = FFMPEGCmdBuilder(uri, decoder_str)
+        # progress is reported on stdout, see ffmpeg_progress
+        ffmpeg_obj  = FFMPEGCmdBuilder(uri, decoder_str, 'pipe:1')
+        latency = FfmpegProcessFactory._latency(stream_src)
         playlist_files = list()
+        streams = list()
         playlist_file_template = 'playlist_%s_%%d.m3u' % hashlib.sha1(uri.encode()).hexdigest()
         for idx,s in enumerate(stream_src['streams']):
             playlist = target_dir / (playlist_file_template % (idx))
-            stream = FFMPEGHlsStream(playlist, s['encoder'])
+            stream = FFMPEGHlsStream(playlist, s['encoder'], latency['hls_time'], latency['ring_size'],
+                                     latency['container'], latency['keyframe_interval'],
+                                     latency['program_date_time'], bool(stream_src.get('activity')))
             if s['width'] != 'default':
                 stream['video_width'] = int(s['width'])
             if s['framerate'] != 'default':
                 stream['video_framerate'] = int(s['framerate'])
+            stream['video_bitrate'] = s.get('bitrate')
             ffmpeg_obj.addOutputStream(stream)
             playlist_files.append(playlist)
+            streams.append((stream, s))
+
+        snapshot_file = None
+        if stream_src.get('snapshot'):
+            # periodic snapshot from the decoded frames, no extra camera connection
+            snapshot_cfg  = stream_src['snapshot']
+            snapshot_file = target_dir / ('snapshot_%s.jpg' % hashlib.sha1(uri.encode()).hexdigest())
+            ffmpeg_obj.addOutputStream(FFMPEGSnapshotStream(snapshot_file,
+                snapshot_cfg.get('interval', 10), snapshot_cfg.get('width', 320)))
+
+        activity_file = None
+        if stream_src.get('activity'):
+            # tiny grayscale frames for activity_monitor
+            activity_cfg  = stream_src['activity']
+            activity_file = target_dir / ('activity_%s.pgm' % hashlib.sha1(uri.encode()).hexdigest())
+            ffmpeg_obj.addOutputStream(FFMPEGActivityStream(activity_file,
+                activity_cfg.get('interval', 2), activity_cfg.get('width', 64)))
 
-        ffmpeg_cmd = ffmpeg_obj.getCmd()
-        logging.info('Composing ffmpeg command: %s' % (ffmpeg_cmd))
+        logging.info('Composing ffmpeg command: %s' % (ffmpeg_obj.getCmd()))
 
-        def ffmpeg_process():
+        def ffmpeg_process(threads=None, detached=False):
+            # -threads is per output, the renditions share the threads of the process,
+            # snapshot and activity images need a single thread
+            encoded = [ s for s,_ in streams if not s.is_copy ]
+            for output_stream in ffmpeg_obj.output_streams:
+                output_stream['threads'] = threads and 1
+            for output_stream in encoded:
+                output_stream['threads'] = threads and max(1, threads // len(encoded))
+            ffmpeg_cmd = ffmpeg_obj.getCmd()
             logging.info('starting ffmpeg')
-            return subprocess.Popen(shlex.split(ffmpeg_cmd))
+            # ffmpeg ignores SIGPIPE, a detached ffmpeg keeps running when the progress pipe breaks
+            return subprocess.Popen(shlex.split(ffmpeg_cmd), stdout=subprocess.PIPE,
+                                    start_new_session=detached)
 
-        return ffmpeg_process, playlist_files
+        return ffmpeg_process, playlist_files, snapshot_file, streams, activity_file
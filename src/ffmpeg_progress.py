@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Live telemetry of ffmpeg processes from their -progress channel
+ * non-blocking reader driven by the event loop of the ProcessSupervisor
+ * parses the key=value blocks into samples kept in a ring buffer
+"""
+
+import os
+import time
+import logging
+import collections
+
+
+def _number(value, suffix=''):
+    if value.endswith(suffix):
+        value = value[:len(value) - len(suffix)]
+    try:
+        return float(value)
+    except ValueError:
+        # e.g. N/A
+        return None
+
+def parse_progress_block(fields):
+    """Converts the fields of one progress block to a sample"""
+    sample = dict(time=time.time(),
+                  frame=_number(fields.get('frame', '')),
+                  fps=_number(fields.get('fps', '')),
+                  bitrate_kbps=_number(fields.get('bitrate', ''), 'kbits/s'),
+                  total_size=_number(fields.get('total_size', '')),
+                  out_time_us=_number(fields.get('out_time_us', fields.get('out_time_ms', ''))),
+                  out_time=fields.get('out_time'),
+                  dup_frames=_number(fields.get('dup_frames', '')),
+                  drop_frames=_number(fields.get('drop_frames', '')),
+                  speed=_number(fields.get('speed', '').strip(), 'x'),
+                  end=fields.get('progress') == 'end')
+    # encoder quality per output stream: stream_<output>_<stream>_q
+    sample['q'] = dict((k[len('stream_'):-len('_q')], _number(v))
+                       for k,v in fields.items() if k.startswith('stream_') and k.endswith('_q'))
+    return sample
+
+
+class ProgressParser(object):
+    """Incremental parser of the -progress output, feed() returns complete samples"""
+    def __init__(self):
+        self._buf = b''
+        self._fields = dict()
+
+    def feed(self, data):
+        samples = list()
+        lines = (self._buf + data).split(b'\n')
+        self._buf = lines.pop()
+        for line in lines:
+            key, sep, value = line.decode(errors='replace').strip().partition('=')
+            if not sep:
+                continue
+            self._fields[key] = value
+            if key == 'progress':
+                samples.append(parse_progress_block(self._fields))
+                self._fields = dict()
+        return samples
+
+
+class ProgressReader(object):
+    """
+    Reads the progress pipe of 1 process without blocking
+
+    Every sample is appended to the ring buffer samples and passed to
+    callback(sample) in the supervisor thread.
+    """
+    def __init__(self, supervisor, pipe, callback=None, size=120):
+        self._supervisor = supervisor
+        self._pipe = pipe
+        self._fd = pipe.fileno()
+        self._callback = callback
+        self._parser = ProgressParser()
+        self._closed = False
+        self.samples = collections.deque(maxlen=size)
+        os.set_blocking(self._fd, False)
+        self._supervisor.add_reader(self._fd, self._read)
+
+    @property
+    def last(self):
+        return self.samples[-1] if self.samples else None
+
+    def _read(self):
+        while not self._closed:
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logging.debug('Progress pipe failed: %s' % (e))
+                data = b''
+            if not data:
+                # process exited
+                self.close()
+                return
+            for sample in self._parser.feed(data):
+                self.samples.append(sample)
+                if self._callback:
+                    self._callback(sample)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._supervisor.remove_reader(self._fd)
+        self._supervisor.call_soon(self._pipe.close)
+
+    def summary(self, window=10):
+        """Averages of the last window samples and the overall last sample"""
+        samples = list(self.samples)[-window:]
+        def average(key):
+            values = [ s[key] for s in samples if s[key] is not None ]
+            return sum(values) / len(values) if values else None
+        return dict(last=self.last, fps=average('fps'), speed=average('speed'),
+                    bitrate_kbps=average('bitrate_kbps'), samples=len(samples))
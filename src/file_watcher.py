@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Watches output directories for written playlist files
+ * inotify (via libc) integrated into the event loop of the ProcessSupervisor
+ * polling of the file modification times as fallback
+"""
+
+import os
+import ctypes
+import ctypes.util
+import struct
+import logging
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_Q_OVERFLOW  = 0x00004000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+_libc = None
+
+def _inotify_libc():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library('c')
+        if not name:
+            raise OSError('libc not found')
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify not supported')
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        _libc = libc
+    return _libc
+
+
+class InotifyWatcher(object):
+    """
+    Calls callback(name) whenever one of the files in a directory is written
+
+    ffmpeg writes live playlists to a temporary file and renames it, so both
+    IN_CLOSE_WRITE and IN_MOVED_TO are of interest.
+    """
+    def __init__(self, supervisor, directory, names, callback):
+        libc = _inotify_libc()
+        self._supervisor = supervisor
+        self._names = set(names)
+        self._callback = callback
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        wd = libc.inotify_add_watch(self._fd, os.fsencode(str(directory)), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, 'inotify_add_watch failed for %s' % (directory))
+        self._supervisor.add_reader(self._fd, self._read)
+
+    def _read(self):
+        changed = set()
+        overflow = False
+        while True:
+            try:
+                buf = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            if not buf:
+                break
+            pos = 0
+            while pos + _EVENT_HEADER.size <= len(buf):
+                wd, mask, cookie, length = _EVENT_HEADER.unpack_from(buf, pos)
+                pos += _EVENT_HEADER.size
+                name = buf[pos:pos + length].rstrip(b'\0').decode(errors='replace')
+                pos += length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                elif name in self._names:
+                    changed.add(name)
+        if overflow:
+            changed = set(self._names)
+        for name in changed:
+            self._callback(name)
+
+    def close(self):
+        self._supervisor.remove_reader(self._fd)
+        self._supervisor.call_soon(os.close, self._fd)
+
+
+class PollingWatcher(object):
+    """
+    Fallback of InotifyWatcher: compares the modification times of the files
+    every interval seconds
+    """
+    def __init__(self, supervisor, directory, names, callback, interval=1):
+        self._supervisor = supervisor
+        self._files = dict((name, None) for name in names)
+        self._directory = directory
+        self._callback = callback
+        self._interval = interval
+        self._closed = False
+        self._timer = self._supervisor.call_later(self._interval, self._poll)
+
+    def _poll(self):
+        if self._closed:
+            return
+        for name, mtime in self._files.items():
+            try:
+                current = os.stat(os.path.join(str(self._directory), name)).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if current != mtime:
+                self._files[name] = current
+                self._callback(name)
+        self._timer = self._supervisor.call_later(self._interval, self._poll)
+
+    def close(self):
+        self._closed = True
+        self._timer.cancel()
+
+
+def create_watcher(supervisor, directory, names, callback, mode='inotify'):
+    """Returns an InotifyWatcher or, if inotify is unavailable, a PollingWatcher
+    """
+    if mode == 'inotify':
+        try:
+            return InotifyWatcher(supervisor, directory, names, callback)
+        except OSError as e:
+            logging.warning('inotify unavailable (%s) -> polling %s' % (e, directory))
+    return PollingWatcher(supervisor, directory, names, callback)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+HTTP origin for the HLS output of the backend
+ * runs in an asyncio event loop of the backend (no extra web server needed)
+ * master playlists are served from memory, files are sent with sendfile (zero-copy)
+ * immutable caching for segments (unique names), short caching for playlists and every
+   file that is rewritten in place (init segments, snapshots), single range requests
+ * /dvr/<cam>/playlist.m3u8?start=..&end=.. serves a time window of the DVR archive (dvr_archive)
+"""
+
+import os
+import time
+import asyncio
+import logging
+import pathlib
+import urllib.parse
+
+from dvr_archive import parse_time, INDEX
+
+CONTENT_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.m3u':  'application/vnd.apple.mpegurl',
+    '.ts':   'video/mp2t',
+    '.m4s':  'video/iso.segment',
+    '.mp4':  'video/mp4',
+    '.jpg':  'image/jpeg',
+}
+
+REASONS = {200: 'OK', 206: 'Partial Content', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 416: 'Range Not Satisfiable'}
+
+# media segments are never rewritten under the same name, see FFMPEGHlsStream
+IMMUTABLE_SUFFIXES = ('.ts', '.m4s')
+MASTER_PLAYLIST = 'playlist.m3u8'
+DVR_PREFIX = 'dvr'
+
+
+def parse_range(value, size):
+    """Returns (start, end) of a single 'bytes=' range, None if invalid"""
+    unit, _, spec = value.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if not first:
+            # suffix range: the last N bytes
+            start, end = max(0, size - int(last)), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+class HLSOrigin(object):
+    """
+    HLSOrigin serves <hls_dir>/<cam>/... over HTTP/1.1 with keep-alive
+
+    master(cam) returns the current master playlist of a camera as bytes
+    or None, then the file on disk is served. Requests outside of hls_dir
+    are rejected. With a DvrArchive, /dvr/<cam>/... is served from the
+    archive; its data files grow, so they are cached like playlists.
+    """
+    def __init__(self, loop, hls_dir, master=None, host='0.0.0.0', port=8080,
+                 playlist_max_age=1, segment_max_age=31536000, archive=None):
+        self._loop = loop
+        self._root = pathlib.Path(hls_dir).resolve()
+        self._master = master
+        self._archive = archive
+        self._host = host
+        self._port = port
+        self._playlist_cache = 'max-age=%d' % (playlist_max_age)
+        self._segment_cache = 'public, max-age=%d, immutable' % (segment_max_age)
+        self._server = None
+        self.requests = 0
+        self.bytes_sent = 0
+
+    @property
+    def port(self):
+        return self._port
+
+    def start(self):
+        """Starts listening, thread-safe, blocks until the socket is bound"""
+        future = asyncio.run_coroutine_threadsafe(self._start(), self._loop)
+        future.result()
+
+    async def _start(self):
+        self._server = await asyncio.start_server(self._serve, self._host, self._port)
+        self._port = self._server.sockets[0].getsockname()[1]
+        logging.info('HLS origin listening on %s:%d' % (self._host, self._port))
+
+    def stop(self):
+        if self._server:
+            self._loop.call_soon_threadsafe(self._server.close)
+
+    def report(self):
+        return dict(port=self._port, requests=self.requests, bytes_sent=self.bytes_sent)
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                try:
+                    method, target, version = lines[0].split(' ')
+                except ValueError:
+                    await self._send_status(writer, 400, False)
+                    break
+                headers = dict()
+                for line in lines[1:]:
+                    key, sep, value = line.partition(':')
+                    if sep:
+                        headers[key.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                self.requests += 1
+                path, _, query = target.partition('?')
+                await self._handle(writer, method, path, query, headers, keep_alive)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        except Exception:
+            logging.exception('HLS origin request failed')
+        finally:
+            writer.close()
+
+    async def _handle(self, writer, method, path, query, headers, keep_alive):
+        if method not in ('GET', 'HEAD'):
+            return await self._send_status(writer, 405, keep_alive)
+        parts = [ p for p in path.split('/') if p ]
+        if not parts or any(p in ('.', '..') or p.startswith('.') for p in parts):
+            return await self._send_status(writer, 404, keep_alive)
+
+        suffix = os.path.splitext(parts[-1])[1]
+        cache = self._segment_cache if suffix in IMMUTABLE_SUFFIXES else self._playlist_cache
+        content_type = CONTENT_TYPES.get(suffix, 'application/octet-stream')
+
+        if parts[0] == DVR_PREFIX and self._archive:
+            return await self._handle_dvr(writer, method, parts[1:], query, headers, keep_alive,
+                                          content_type)
+
+        if len(parts) == 2 and parts[1] == MASTER_PLAYLIST and self._master:
+            data = self._master(parts[0])
+            if data is not None:
+                return await self._send(writer, 200, content_type, cache, data, method, keep_alive)
+
+        await self._send_file(writer, self._root.joinpath(*parts), method, headers, keep_alive,
+                              content_type, cache)
+
+    async def _handle_dvr(self, writer, method, parts, query, headers, keep_alive, content_type):
+        if len(parts) == 2 and parts[1] == MASTER_PLAYLIST:
+            params = urllib.parse.parse_qs(query)
+            try:
+                cam_no = int(parts[0])
+                start, end = parse_time(params['start'][0]), parse_time(params['end'][0])
+            except (KeyError, ValueError):
+                return await self._send_status(writer, 400, keep_alive)
+            # reads the partitions from disk on the first request of a camera
+            data = await self._loop.run_in_executor(None, self._archive.playlist, cam_no, start, end)
+            return await self._send(writer, 200, content_type, self._playlist_cache, data,
+                                    method, keep_alive)
+        if parts and parts[-1].endswith(INDEX):
+            return await self._send_status(writer, 404, keep_alive)
+        await self._send_file(writer, self._archive.root.joinpath(*parts), method, headers,
+                              keep_alive, content_type, self._playlist_cache)
+
+    async def _send_file(self, writer, filename, method, headers, keep_alive, content_type, cache):
+        try:
+            f = open(str(filename), 'rb')
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return await self._send_status(writer, 404, keep_alive)
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            status, start, end = 200, 0, size - 1
+            if 'range' in headers:
+                byte_range = parse_range(headers['range'], size)
+                if byte_range is None:
+                    return await self._send_status(writer, 416, keep_alive,
+                                                   [ 'Content-Range: bytes */%d' % (size) ])
+                status, (start, end) = 206, byte_range
+            extra = [ 'Accept-Ranges: bytes' ]
+            if status == 206:
+                extra.append('Content-Range: bytes %d-%d/%d' % (start, end, size))
+            writer.write(self._head(status, content_type, cache, end - start + 1, keep_alive, extra))
+            if method == 'HEAD' or end < start:
+                return await writer.drain()
+            await writer.drain()
+            # os.sendfile() for plain sockets, read/write fallback otherwise
+            self.bytes_sent += await self._loop.sendfile(writer.transport, f, start, end - start + 1)
+
+    def _head(self, status, content_type, cache, length, keep_alive, extra=()):
+        lines = [ 'HTTP/1.1 %d %s' % (status, REASONS[status]),
+                  'Content-Type: %s' % (content_type),
+                  'Content-Length: %d' % (length),
+                  'Cache-Control: %s' % (cache),
+                  'Access-Control-Allow-Origin: *',
+                  'Date: %s' % (time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())),
+                  'Connection: %s' % ('keep-alive' if keep_alive else 'close') ]
+        lines.extend(extra)
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def _send(self, writer, status, content_type, cache, data, method, keep_alive):
+        writer.write(self._head(status, content_type, cache, len(data), keep_alive))
+        if method != 'HEAD':
+            writer.write(data)
+            self.bytes_sent += len(data)
+        await writer.drain()
+
+    async def _send_status(self, writer, status, keep_alive, extra=()):
+        body = ('%d %s\n' % (status, REASONS[status])).encode()
+        writer.write(self._head(status, 'text/plain', 'no-cache', len(body), keep_alive, extra) + body)
+        await writer.drain()
@@ -11,140 +11,160 @@
 
 #http://cdn.flowplayer.org/202777/84049-bauhaus/420p/pl.m3u8
 
-from ffmpeg_cmd_builder import *
+import os
+import bisect
 import pathlib
-import collections.abc
+import contextlib
 
 from functools import total_ordering
 
 # HLS Playlist handling
 @total_ordering
-class PlaylistItem(collections.abc.MutableMapping):
+class PlaylistItem(object):
     """
+    One rendition (variant playlist) of the master playlist
+
     if total ordering decorator is used, not all 6 comparison methods need to be
     implemented for the class
     """
-    def __init__(self, playlist_name, stream_details):
-        self._data = dict((('name', playlist_name),
-                           ('bandwidth', int(stream_details['format']['bit_rate'])),
-                           ('width', int(stream_details['streams'][0]['width'])), 
-                           ('height', int(stream_details['streams'][0]['height']))))
+    __slots__ = ('name', 'bandwidth', 'average_bandwidth', 'width', 'height')
 
-    def keys(self):
-        return self._data.keys()
+    def __init__(self, playlist_name, stream_details):
+        self.name      = playlist_name
+        self.bandwidth = int(stream_details['format']['bit_rate'])
+        self.width     = int(stream_details['streams'][0]['width'])
+        self.height    = int(stream_details['streams'][0]['height'])
+        self.average_bandwidth = None
+        if stream_details['format'].get('avg_bit_rate'):
+            self.average_bandwidth = int(stream_details['format']['avg_bit_rate'])
 
-    def __getitem__(self, key):
-        return self._data[key]
+    def _key(self):
+        return (self.name, self.bandwidth, self.average_bandwidth, self.width, self.height)
 
     def __eq__(self, other):
-        for key in set().union(self.keys(), other.keys()):
-            try:
-                if not self[key] == other[key]:
-                    return False
-            except KeyError:
-                return False
-        return True
+        return self._key() == other._key()
 
     def __ne__(self, other):
         return not (self == other)
 
     def __lt__(self, other):
-        return (self['bandwidth'] < other['bandwidth'])
-
-    def __delitem__(self, key):
-        del self._data[key]
-
-    def __iter__(self):
-        return iter(self._data)
-
-    def __len__(self):
-        return len(self._data)
-
-    def __setitem__(self, key, value):
-        self._data[key] = value
+        return (self.bandwidth < other.bandwidth)
+
+def render_master_playlist(playlist):
+    """Returns the master playlist of the items (ordered by bandwidth) as bytes"""
+    # every variant starts its segments with a keyframe (hls_flags independent_segments)
+    lines = ['#EXTM3U', '#EXT-X-INDEPENDENT-SEGMENTS']
+    for item in playlist:
+        average = ''
+        if item.average_bandwidth is not None:
+            average = ',AVERAGE-BANDWIDTH=%d' % (item.average_bandwidth)
+        lines.append('#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=%d%s,RESOLUTION=%dx%d' %
+                     (item.bandwidth,average,item.width,item.height))
+        lines.append(item.name)
+    return ('\n'.join(lines) + '\n').encode()
+
+def atomic_write(filename, data):
+    """Replaces filename with data, readers never see a half-written file"""
+    path = pathlib.Path(filename)
+    tmp = path.with_name('.%s.tmp' % (path.name))
+    with tmp.open('wb') as f:
+        f.write(data)
+    os.replace(str(tmp), str(path))
 
 def export_to_file(filename):
+    """Returns a callback that writes the master playlist, it returns True if the file changed"""
+    last_written = [None]
     def func(playlist):
-        with pathlib.Path(filename).open('w') as f:
-            f.write('#EXTM3U\n')
-            for item in playlist:
-                f.write('#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=%d,RESOLUTION=%dx%d\n' %
-                        (item['bandwidth'],item['width'],item['height']))
-                f.write('%s\n' % (item['name']))
+        data = render_master_playlist(playlist)
+        if data == last_written[0]:
+            return False
+        atomic_write(filename, data)
+        last_written[0] = data
+        return True
     return func
 
-def list_changed_callback(f):
-    def deco(*args, **kwargs):
-        ret_val = f(*args, **kwargs)
-        args[0]._callback()
-        return ret_val
-    return deco
-  
-class HLSPlaylist(collections.abc.MutableSequence):
+class HLSPlaylist(object):
+    """
+    Registry of the renditions of a single input stream
 
+     * renditions are indexed by name
+     * the ordering by BANDWIDTH is maintained incrementally
+     * changes within transaction() result in a single callback
+    """
     def __init__(self, list_changed_callback = None):
-        self.list = list()
+        self._items = dict()
+        # sorted list of (bandwidth, name)
+        self._order = list()
         self.callback_fnc = list_changed_callback
+        self._transaction_depth = 0
+        self._dirty = False
+
+    def _changed(self):
+        self._dirty = True
+        if not self._transaction_depth:
+            self._commit()
+
+    def _commit(self):
+        self._dirty = False
+        if self.callback_fnc:
+            self.callback_fnc(list(self))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self._transaction_depth += 1
+        try:
+            yield self
+        finally:
+            self._transaction_depth -= 1
+            if not self._transaction_depth and self._dirty:
+                self._commit()
+
+    def _unlink(self, item):
+        idx = bisect.bisect_left(self._order, (item.bandwidth, item.name))
+        del self._order[idx]
+
+    def update(self, item):
+        """Inserts or replaces the rendition item.name"""
+        current = self._items.get(item.name)
+        if current is not None:
+            if current == item:
+                return
+            self._unlink(current)
+        self._items[item.name] = item
+        bisect.insort(self._order, (item.bandwidth, item.name))
+        self._changed()
+
+    def remove(self, name):
+        item = self._items.pop(name)
+        self._unlink(item)
+        self._changed()
+
+    def __getitem__(self, name):
+        return self._items[name]
+
+    def __contains__(self, name):
+        return name in self._items
 
-    def _callback(self):
-        self.callback_fnc(sorted(self.list))
-
-    def __getitem__(self, idx):
-        return self.list[idx]
-   
-    @list_changed_callback
-    def _setitem(self, idx, value):
-        self.list[idx] = value
-
-    def __setitem__(self, idx, value):
-        if not self.list[idx] == value:
-            self._setitem(idx, value)
-    
-    @list_changed_callback
-    def insert(self, idx, value):
-        self.list.insert(idx, value)
-    
-    @list_changed_callback
-    def __delitem__(self, idx):
-        del self.list[idx]
-  
-    def getPlaylistIndex(self, playlist):
-        for idx,item in enumerate(self.list):
-            if item['name'] == playlist:
-                return idx
-        return None
+    def __iter__(self):
+        """Iterates the renditions ordered by bandwidth"""
+        return (self._items[name] for _, name in self._order)
 
     def __len__(self):
-        return len(self.list)
+        return len(self._items)
 
 
 if __name__ == '__main__':
     playlists = HLSPlaylist(list_changed_callback =
             export_to_file('das_ist_ein_test.m3u'))
 
-    a = PlaylistItem(
-                    (('name', 'playlista'),
-                    ('bandwidth', 300)))
-    playlists.append(a)
-    b = PlaylistItem(
-                    (('name', 'playlistb'),
-                    ('bandwidth', 100)))
-    playlists.append(b)
-    c = PlaylistItem(
-                    (('name', 'playlistc'),
-                    ('bandwidth', 600)))
-    playlists.append(c)
-    d = PlaylistItem(
-                    (('name', 'playlistc'),
-                    ('bandwidth', 600), ('asdf',400)))
-    c_idx = playlists.getPlaylistIndex(c['name'])
-    playlists[c_idx] = d
-    playlists[c_idx] = d
-    playlists[c_idx] = d
-    d2 = PlaylistItem(
-                    (('name', 'playlistc'),
-                    ('bandwidth', 680), ('asdf',400)))
-
-    if c in playlists:
-        print('hallo')
+    def details(bandwidth):
+        return {'format': {'bit_rate': bandwidth}, 'streams': [{'width': 640, 'height': 360}]}
+
+    with playlists.transaction():
+        playlists.update(PlaylistItem('playlista', details(300)))
+        playlists.update(PlaylistItem('playlistb', details(100)))
+        playlists.update(PlaylistItem('playlistc', details(600)))
+    playlists.update(PlaylistItem('playlistc', details(680)))
 
+    if 'playlistc' in playlists:
+        print([ item.name for item in playlists ])
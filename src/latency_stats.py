@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Statistics shared by the benchmark and measurement tools
+ * percentile of a list of samples (nearest rank), no dependencies
+"""
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
@@ -4,95 +4,42 @@
 """
 hierarchical prompt usage example
 """
-from PyInquirer import style_from_dict, prompt
-
-from examples import custom_style_2
+from PyInquirer import prompt
 
+import sys
 import argparse
-import zmq
-import json
-import time
-
-import logging
 
-from jsonrpc import JSONRPCResponseManager, Dispatcher
+from cam_client import CamClient, RpcError
 
 class CameraManagerProxy(object):
+    """Proxy of the camera backend, all calls share one persistent CamClient"""
     def __init__(self):
         super().__init__()
         self._port = None
-        self.req_stream = None
-        self.context = None
+        self.client = None
         self.SERVER_ENDPOINT = None
 
     @property
     def port(self):
         return self._port
 
-    def zmq_socket_creator(f, *args):
-        def new_f(*args):
-            self = args[0]
-            logging.debug("Entering %s" % (f.__name__))
-            self.client = self.context.socket(zmq.REQ)
-            self.client.connect(self.SERVER_ENDPOINT)
-            result = f(*args)
-            self.client.close()
-            return result
-        return new_f
-
     def setup(self, addr):
-        """Sets up PyZMQ and creates all streams."""
+        """Connects the client to the backend."""
         self.SERVER_ENDPOINT = addr
-        self.context = zmq.Context()
         print("I: Connecting to server ...")
+        self.client = CamClient(addr)
 
-    @zmq_socket_creator
     def start_cam(self, cam_id):
-        print('start stream abcde')
-        payload = {
-            "method": "start",
-            "params": [cam_id],
-            "id": 2,
-            "jsonrpc": "2.0"
-        }
-        request = json.dumps(payload)
-        self.client.send_unicode(request)
-
-
-    @zmq_socket_creator
+        return self.client.call('start', cam_id)
+
     def stop_cam(self, cam_id):
-        payload = {
-            "method": "stop",
-            "params": [cam_id],
-            "id": 2,
-            "jsonrpc": "2.0"
-        }
-        request = json.dumps(payload)
-        self.client.send_unicode(request)
-
-    @zmq_socket_creator
+        return self.client.call('stop', cam_id)
+
     def capture_image(self, cam_id):
-        payload = {
-            "method": "capture_image",
-            "params": [cam_id],
-            "id": 2,
-            "jsonrpc": "2.0"
-        }
-        request = json.dumps(payload)
-        self.client.send_unicode(request)
-
-    @zmq_socket_creator
+        return self.client.call('capture_image', cam_id)
+
     def list(self):
-        payload = {
-            "method": "list",
-            "id": 2,
-            "jsonrpc": "2.0"
-        }
-        request = json.dumps(payload)
-        self.client.send_unicode(request)
-        msg = self.client.recv_unicode()
-        msg_dict = json.loads(msg)
-        return msg_dict['result']
+        return self.client.call('list')
 
 def query_cam_id(cam_list_numeric):
     cam_prompt = {
@@ -135,7 +82,10 @@ def main_loop(cam_manager):
         }]
         action_idx = ask_operation([o['choice'] for o in actions])
         if action_idx is not None:
-            actions[action_idx]['fnc'](int(cam_id))
+            try:
+                print(actions[action_idx]['fnc'](int(cam_id)))
+            except (RpcError, TimeoutError) as e:
+                print('Failed: %s' % (e))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -145,7 +95,6 @@ if __name__ == '__main__':
     cam_manager = CameraManagerProxy()
     try:
         cam_manager.setup(args.cam_mgr)
-        manager = JSONRPCResponseManager()
     except (AttributeError, TypeError) as e:
         sys.stderr.write('Missing commandline argument\n')
         sys.stderr.write('Error: %s\n' % (str(e)))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Measures the latency of live HLS streams, e.g. one camera per latency profile
+ * polls master or variant playlists (http URL of the origin or a file path)
+ * availability: time from the end of a segment (#EXT-X-PROGRAM-DATE-TIME + duration)
+   until it is listed in the playlist
+ * estimated player latency: availability + hold-back of a player (3 target durations)
+
+#EXT-X-PROGRAM-DATE-TIME is taken from the clock of the backend when the
+frames are encoded, run the tool on the backend host (or a NTP synced one).
+The delay of the camera itself is not included.
+"""
+
+import time
+import pathlib
+import argparse
+import datetime
+import urllib.parse
+import urllib.request
+
+from latency_stats import percentile
+
+# a player starts 3 target durations behind the end of the playlist (HLS spec)
+HOLD_BACK_TARGETS = 3
+
+
+def fetch(url):
+    if urllib.parse.urlparse(url).scheme in ('http', 'https'):
+        with urllib.request.urlopen(url, timeout=5) as r:
+            return r.read().decode('utf-8')
+    with open(url, 'r') as f:
+        return f.read()
+
+def resolve(base, uri):
+    if urllib.parse.urlparse(base).scheme in ('http', 'https'):
+        return urllib.parse.urljoin(base, uri)
+    return str(pathlib.Path(base).parent / uri)
+
+def parse_date_time(value):
+    # ffmpeg writes e.g. 2024-05-01T12:00:00.000+0200
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f%z').timestamp()
+
+def parse_playlist(text):
+    """Returns (variants, target_duration, init, segments) of a playlist
+
+    variants is the list of variant URIs of a master playlist, segments the
+    list of (uri, duration, program_date_time) of a media playlist.
+    """
+    variants = list()
+    segments = list()
+    target = init = None
+    duration = date_time = None
+    stream_inf = False
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            stream_inf = True
+        elif line.startswith('#EXT-X-TARGETDURATION:'):
+            target = float(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-MAP:'):
+            init = line.split('URI=', 1)[1].split(',')[0].strip('"')
+        elif line.startswith('#EXT-X-PROGRAM-DATE-TIME:'):
+            date_time = parse_date_time(line.split(':', 1)[1])
+        elif line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',')[0])
+        elif line and not line.startswith('#'):
+            if stream_inf:
+                variants.append(line)
+                stream_inf = False
+                continue
+            if date_time is None and segments and segments[-1][2] is not None:
+                # the date time of the following segments is implied
+                date_time = segments[-1][2] + segments[-1][1]
+            segments.append((line, duration, date_time))
+            duration = date_time = None
+    return variants, target, init, segments
+
+
+class VariantProbe(object):
+    """
+    Follows 1 variant playlist and records when its segments appear
+    """
+    def __init__(self, url):
+        self.url = url
+        self.target = None
+        self.container = None
+        self.segments = 0
+        self.durations = list()
+        self.availability = list()
+        self._seen = None
+
+    def poll(self):
+        now = time.time()
+        _, self.target, init, segments = parse_playlist(fetch(self.url))
+        self.container = 'fmp4' if init else 'ts'
+        if self._seen is None:
+            # the segments of the first playlist appeared before the measurement
+            self._seen = set(uri for uri, _, _ in segments)
+            return
+        for uri, duration, date_time in segments:
+            if uri in self._seen:
+                continue
+            self._seen.add(uri)
+            self.segments += 1
+            self.durations.append(duration)
+            if date_time is not None:
+                self.availability.append(now - (date_time + duration))
+
+    def report(self):
+        target = self.target or 0
+        available = percentile(self.availability, 50)
+        # without date time a segment is listed at the earliest after its duration
+        estimate = (available if available is not None else target) + HOLD_BACK_TARGETS * target
+        return dict(url=self.url, container=self.container, target=self.target,
+                    segments=self.segments,
+                    segment_avg=sum(self.durations) / len(self.durations) if self.durations else None,
+                    available_p50=available, available_p95=percentile(self.availability, 95),
+                    latency_estimate=estimate, measured=bool(self.availability))
+
+
+def run(urls, duration, interval):
+    probes = list()
+    for url in urls:
+        variants, _, _, _ = parse_playlist(fetch(url))
+        probes.extend(VariantProbe(resolve(url, v)) for v in variants or [ url ])
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        for probe in probes:
+            try:
+                probe.poll()
+            except OSError as e:
+                print('Could not fetch %s: %s' % (probe.url, e))
+        time.sleep(interval)
+    return [ probe.report() for probe in probes ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('urls', nargs='+',
+            help="Master/variant playlists, e.g. http://127.0.0.1:8080/1/playlist.m3u8")
+    parser.add_argument('-d', '--duration', type=float, default=30, help="Duration in seconds")
+    parser.add_argument('-i', '--interval', type=float, default=0.1, help="Poll interval in seconds")
+    args = parser.parse_args()
+
+    def ms(value):
+        return '-' if value is None else '%.0fms' % (value * 1000)
+
+    for r in run(args.urls, args.duration, args.interval):
+        print('%s\n  %s, target %ss, %d segments (avg %s), available p50 %s p95 %s, latency %s%s'
+              % (r['url'], r['container'], r['target'], r['segments'], ms(r['segment_avg']),
+                 ms(r['available_p50']), ms(r['available_p95']), ms(r['latency_estimate']),
+                 '' if r['measured'] else ' (no program date time, lower bound)'))
@@ -1,32 +1,40 @@
 #!/usr/bin/env python3
 # -*- coding: utf8 -*-
 
-import pathlib
 import itertools
 
 from transcoding_observer import *
-from hls_playlist import analyse_input_format, HLSPlaylist, PlaylistItem, export_to_file
-
-def m3u_get_items(filename):
-    items = list()
-    try:
-        with pathlib.Path(filename).open('r') as f:
-            for line in f:
-                if line.strip().startswith('#'):
-                    continue
-                items.append(line)
-    except FileNotFoundError:
-        return None
-    return items
-
+from hls_playlist import HLSPlaylist, PlaylistItem, export_to_file, render_master_playlist
+from segment_analyser import SegmentProbeCache
 
 class PlaylistManager(TranscodingObserver):
 
-    def __init__(self, d):
+    def __init__(self, d, cam_id=None, events=None):
         self.global_playlist = None
         self.playlist_file = d / 'playlist.m3u8'
-        self.global_playlist = HLSPlaylist(list_changed_callback =
-                export_to_file(self.playlist_file))
+        self._cam_id = cam_id
+        # optional EventBus, gets 'playlist_ready' and 'playlist_updated'
+        self._events = events
+        self._export = export_to_file(self.playlist_file)
+        self._published = False
+        # current master playlist (bytes), e.g. for the HLS origin
+        self._master = None
+        self.global_playlist = HLSPlaylist(list_changed_callback = self._playlist_changed)
+        # one probe cache per rendition (variant playlist)
+        self._probes = dict()
+
+    def master(self):
+        return self._master
+
+    def _playlist_changed(self, playlist):
+        self._master = render_master_playlist(playlist)
+        if not self._export(playlist) or not self._events:
+            return
+        renditions = [ dict(name=i.name, bandwidth=i.bandwidth, width=i.width, height=i.height)
+                       for i in playlist ]
+        self._events.publish(self._cam_id, 'playlist_updated' if self._published else 'playlist_ready',
+                             playlist=str(self.playlist_file), renditions=renditions)
+        self._published = True
 
     def update(self, s):
         proc_desc = s.processFactories
@@ -36,15 +44,10 @@ class PlaylistManager(TranscodingObserver):
             self._update_playlists(combined)
         
     def _update_playlists(self, files):
-        # update playlists
-        for playlist in files:
-            hls_file_segment = m3u_get_items(playlist)
-            if hls_file_segment is not None:
-                print(hls_file_segment)
-                stream_details = analyse_input_format(playlist.parent / hls_file_segment[0])
-                item = PlaylistItem( playlist.name, stream_details )
-                idx = self.global_playlist.getPlaylistIndex(item['name'])
-                if idx == None:
-                    self.global_playlist.append(item)
-                else:
-                    self.global_playlist[idx] = item
+        # update playlists, the master playlist is written once per cycle
+        with self.global_playlist.transaction():
+            for playlist in files:
+                probe = self._probes.setdefault(playlist.name, SegmentProbeCache())
+                stream_details = probe.probe(playlist)
+                if stream_details is not None:
+                    self.global_playlist.update(PlaylistItem( playlist.name, stream_details ))
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Resource accounting of the transcoding processes from /proc
+ * samples /proc/<pid>/stat, status and io on a timer of the ProcessSupervisor
+ * keeps rolling averages (EWMA) and peaks of cpu%, rss and bytes written
+"""
+
+import os
+import time
+import logging
+import threading
+
+CLK_TCK   = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def read_proc(pid):
+    """Returns the raw counters of a process or None if it is gone"""
+    try:
+        with open('/proc/%d/stat' % (pid), 'rb') as f:
+            stat = f.read()
+        with open('/proc/%d/status' % (pid), 'rb') as f:
+            status = f.read()
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    # comm may contain spaces, the fields start after the last ')'
+    fields = stat[stat.rindex(b')') + 2:].split()
+    sample = dict(cpu_ticks=int(fields[11]) + int(fields[12]),
+                  rss=int(fields[21]) * PAGE_SIZE)
+    for line in status.splitlines():
+        if line.startswith(b'Threads:'):
+            sample['threads'] = int(line.split()[1])
+        elif line.startswith(b'VmHWM:'):
+            sample['rss_hwm'] = int(line.split()[1]) * 1024
+    try:
+        with open('/proc/%d/io' % (pid), 'rb') as f:
+            for line in f:
+                if line.startswith(b'write_bytes:'):
+                    sample['write_bytes'] = int(line.split()[1])
+                elif line.startswith(b'wchar:'):
+                    sample['wchar'] = int(line.split()[1])
+    except (FileNotFoundError, PermissionError):
+        pass
+    return sample
+
+
+class RollingStat(object):
+    """Exponentially weighted average, peak and last value of a metric"""
+    __slots__ = ('alpha', 'average', 'peak', 'last')
+
+    def __init__(self, alpha):
+        self.alpha   = alpha
+        self.average = None
+        self.peak    = None
+        self.last    = None
+
+    def add(self, value):
+        self.last = value
+        self.average = value if self.average is None else self.average + self.alpha * (value - self.average)
+        self.peak = value if self.peak is None else max(self.peak, value)
+
+    def report(self):
+        return dict(last=self.last, average=self.average, peak=self.peak)
+
+
+class ProcessStats(object):
+    """Rolling statistics of 1 process"""
+    def __init__(self, pid, alpha):
+        self.pid = pid
+        self.cpu_percent = RollingStat(alpha)
+        self.rss = RollingStat(alpha)
+        self.write_rate = RollingStat(alpha)
+        self.bytes_written = 0
+        self.threads = None
+        self.rss_hwm = None
+        self._last = None
+
+    def sample(self, now):
+        counters = read_proc(self.pid)
+        if counters is None:
+            return False
+        # write_bytes is what reaches the storage, wchar also counts pipes and sockets
+        # (e.g. the -progress pipe), it is only the fallback
+        written = counters.get('write_bytes', counters.get('wchar'))
+        if self._last is not None:
+            last_time, last_ticks, last_written = self._last
+            elapsed = now - last_time
+            if elapsed > 0:
+                self.cpu_percent.add(100.0 * (counters['cpu_ticks'] - last_ticks) / CLK_TCK / elapsed)
+                if written is not None and last_written is not None:
+                    self.write_rate.add((written - last_written) / elapsed)
+        self.rss.add(counters['rss'])
+        self.bytes_written = written
+        self.threads = counters.get('threads')
+        self.rss_hwm = counters.get('rss_hwm')
+        self._last = (now, counters['cpu_ticks'], written)
+        return True
+
+    def report(self):
+        return dict(pid=self.pid, threads=self.threads, bytes_written=self.bytes_written, rss_hwm=self.rss_hwm,
+                    cpu_percent=self.cpu_percent.report(), rss=self.rss.report(),
+                    write_rate=self.write_rate.report())
+
+
+class ResourceMonitor(object):
+    """
+    ResourceMonitor samples all tracked processes every interval seconds
+
+    Bytes written are taken from write_bytes (what reaches the storage) and
+    fall back to wchar (also counts pipes and sockets) when it is not available.
+    """
+    def __init__(self, supervisor, interval=5, alpha=0.2):
+        self._supervisor = supervisor
+        self._interval = interval
+        self._alpha = alpha
+        self._lock = threading.Lock()
+        # cam_id -> {pid: ProcessStats}
+        self._cameras = dict()
+        self._supervisor.call_later(self._interval, self._sample)
+
+    def track(self, cam_id, pid):
+        with self._lock:
+            self._cameras.setdefault(cam_id, dict())[pid] = ProcessStats(pid, self._alpha)
+
+    def untrack(self, cam_id, pid=None):
+        """Stops sampling pid or, without pid, all processes of the camera"""
+        with self._lock:
+            if pid is None:
+                self._cameras.pop(cam_id, None)
+            else:
+                self._cameras.get(cam_id, dict()).pop(pid, None)
+
+    def _sample(self):
+        now = time.monotonic()
+        with self._lock:
+            procs = [ (cam_id, p) for cam_id,pids in self._cameras.items() for p in pids.values() ]
+        for cam_id, proc_stats in procs:
+            if not proc_stats.sample(now):
+                logging.debug('Process %d of cam %s is gone' % (proc_stats.pid, cam_id))
+                self.untrack(cam_id, proc_stats.pid)
+        self._supervisor.call_later(self._interval, self._sample)
+
+    def report(self, cam_id=None):
+        """Returns per camera totals and per process statistics"""
+        with self._lock:
+            cameras = dict((c, list(p.values())) for c,p in self._cameras.items()
+                           if cam_id is None or c == cam_id)
+        result = dict()
+        for c, procs in cameras.items():
+            reports = [ p.report() for p in procs ]
+            result[c] = dict(
+                    cpu_percent=sum(r['cpu_percent']['average'] or 0 for r in reports),
+                    rss=sum(r['rss']['last'] or 0 for r in reports),
+                    write_rate=sum(r['write_rate']['average'] or 0 for r in reports),
+                    processes=reports)
+        return result
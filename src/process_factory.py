@@ -12,7 +12,17 @@ class ProcessFactory(object, metaclass=abc.ABCMeta):
     def __init__(self):
         # list of factory methods for process creation
         self.processFactories = list()
+        # the idle rendition profile is selected (see activity_monitor)
+        self.idle = False
     
     @abc.abstractmethod
     def factoryMethods(self):
         ...
+
+    def activityFile(self):
+        """Frame for the activity detection (see activity_monitor) or None"""
+        return None
+
+    def setActivity(self, idle):
+        """Selects the active or idle rendition profile for the next process"""
+        self.idle = idle
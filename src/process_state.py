@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Survives restarts of the backend without interrupting the streams
+ * a state file records camera, pid, command hash and start time of every process
+ * a restarted backend adopts the processes that still run the same command
+ * AdoptedProcess gives a foreign process the interface of subprocess.Popen
+"""
+
+import os
+import json
+import time
+import signal
+import hashlib
+import logging
+import threading
+import subprocess
+
+from hls_playlist import atomic_write
+
+
+def cfg_hash(cam_cfg):
+    """Hash of the configuration of a camera"""
+    return hashlib.sha1(json.dumps(cam_cfg, sort_keys=True, default=str).encode()).hexdigest()
+
+# a process that was just started may still be in exec, its command line is empty until
+# the new program is loaded
+EXEC_TIMEOUT = 1.0
+
+def proc_identity(pid):
+    """Returns (starttime, cmd_hash, state) of a process or None if it is gone
+
+    starttime (in clock ticks since boot) tells a process apart from a later
+    one that got the same pid.
+    """
+    deadline = time.monotonic() + EXEC_TIMEOUT
+    while True:
+        try:
+            with open('/proc/%d/stat' % (pid), 'rb') as f:
+                stat = f.read()
+            with open('/proc/%d/cmdline' % (pid), 'rb') as f:
+                cmdline = f.read()
+        except (FileNotFoundError, ProcessLookupError):
+            return None
+        # comm may contain spaces, the fields start after the last ')'
+        fields = stat[stat.rindex(b')') + 2:].split()
+        state = fields[0].decode()
+        if cmdline or state in ('Z', 'X') or time.monotonic() >= deadline:
+            return int(fields[19]), hashlib.sha1(cmdline).hexdigest(), state
+        time.sleep(0.005)
+
+
+class AdoptedProcess(object):
+    """
+    Process started by a previous instance of the backend
+
+    It is not a child of this process, so its exit status is unknown:
+    returncode is -1 once the process is gone. idle tells whether it was
+    started with the idle rendition profile (see activity_monitor).
+    """
+    def __init__(self, pid, starttime, idle=False):
+        self.pid = pid
+        self.starttime = starttime
+        self.idle = idle
+        self.returncode = None
+        self.stdout = None
+        self.args = None
+
+    def poll(self):
+        if self.returncode is None:
+            identity = proc_identity(self.pid)
+            if identity is None or identity[0] != self.starttime or identity[2] in ('Z', 'X'):
+                self.returncode = -1
+        return self.returncode
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(self.pid, timeout)
+            time.sleep(0.05)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.poll() is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class StateStore(object):
+    """
+    StateStore persists the processes of the running cameras
+
+    The file left by the previous backend is loaded once; adopt() hands out
+    its processes, the current state replaces the file on every change.
+    Layout: {cam_id: {cfg_hash, processes: {index: {pid, starttime, cmd_hash, started, idle}}}}
+    """
+    def __init__(self, filename):
+        self._filename = str(filename)
+        self._lock = threading.Lock()
+        self._state = dict()
+        try:
+            with open(self._filename, 'r') as f:
+                self._previous = json.load(f)
+        except FileNotFoundError:
+            self._previous = dict()
+        except ValueError:
+            logging.warning('Ignoring corrupt state file %s' % (self._filename))
+            self._previous = dict()
+
+    def cameras(self):
+        """Cameras that were running in the previous backend"""
+        with self._lock:
+            return [ int(c) for c in self._previous ]
+
+    def _take(self, cam_id):
+        """Returns the verified processes {index: AdoptedProcess} of the previous backend"""
+        with self._lock:
+            record = self._previous.pop(str(cam_id), None)
+        if not record:
+            return None, dict()
+        procs = dict()
+        for idx, p in record['processes'].items():
+            identity = proc_identity(p['pid'])
+            if identity is None or identity[0] != p['starttime'] or identity[2] in ('Z', 'X'):
+                logging.info('Process %d of cam %s is gone' % (p['pid'], cam_id))
+            elif identity[1] != p['cmd_hash']:
+                # pid reused by an unrelated process
+                logging.info('Process %d of cam %s runs another command' % (p['pid'], cam_id))
+            else:
+                procs[int(idx)] = AdoptedProcess(p['pid'], p['starttime'], p.get('idle', False))
+        return record['cfg_hash'], procs
+
+    def adopt(self, cam_id, config_hash):
+        """Returns the processes of the camera per index (None if dead) or None
+
+        None means there is nothing to adopt; processes that were started with
+        another configuration are killed.
+        """
+        previous_hash, procs = self._take(cam_id)
+        if previous_hash is None:
+            return None
+        if previous_hash != config_hash:
+            logging.info('Configuration of cam %s changed, not adopting %s'
+                    % (cam_id, [ p.pid for p in procs.values() ]))
+            for proc in procs.values():
+                proc.kill()
+            return None
+        logging.info('Adopting processes %s of cam %s' % ([ p.pid for p in procs.values() ], cam_id))
+        return [ procs.get(idx) for idx in range(max(procs) + 1) ] if procs else list()
+
+    def discard(self, cam_id):
+        """Kills the processes of a camera that was removed from the configuration"""
+        _, procs = self._take(cam_id)
+        for proc in procs.values():
+            logging.info('Killing orphaned process %d of cam %s' % (proc.pid, cam_id))
+            proc.kill()
+
+    def set_camera(self, cam_id, config_hash):
+        with self._lock:
+            self._state[str(cam_id)] = dict(cfg_hash=config_hash, processes=dict())
+            self._write()
+
+    def set_process(self, cam_id, idx, pid, idle=False):
+        identity = proc_identity(pid)
+        with self._lock:
+            camera = self._state.get(str(cam_id))
+            if camera is None:
+                return
+            if identity is None:
+                camera['processes'].pop(str(idx), None)
+            else:
+                camera['processes'][str(idx)] = dict(pid=pid, starttime=identity[0],
+                                                     cmd_hash=identity[1], started=time.time(),
+                                                     idle=idle)
+            self._write()
+
+    def remove(self, cam_id):
+        with self._lock:
+            if self._state.pop(str(cam_id), None) is not None:
+                self._write()
+
+    def _write(self):
+        # the cameras of the previous backend stay recorded until they are adopted
+        state = dict(self._previous, **self._state)
+        try:
+            atomic_write(self._filename, json.dumps(state, indent=1).encode())
+        except OSError as e:
+            logging.warning('Could not write state file %s: %s' % (self._filename, e))
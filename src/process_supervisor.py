@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Single event loop that supervises the transcoding processes of all cameras
+ * process exits are detected via pidfd (selectors) within milliseconds
+ * timers replace the polling loops of the individual camera handlers
+"""
+
+import os
+import time
+import heapq
+import itertools
+import logging
+import selectors
+import threading
+import collections
+
+
+class Timer(object):
+    """Handle of a scheduled callback, returned by ProcessSupervisor.call_later()
+    """
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline  = deadline
+        self.callback  = callback
+        self.args      = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ProcessSupervisor(threading.Thread):
+    """
+    ProcessSupervisor owns the processes of all CamHandlerThreads
+
+    Every watched process is registered with a pidfd in a selector, so an exit
+    wakes up the loop immediately. If pidfds are not supported by the platform
+    the watched processes are polled every POLL_INTERVAL seconds instead.
+
+    All callbacks are executed in the supervisor thread, they must not block:
+    slow work (e.g. the observers of a camera) is handed to the CommandExecutor.
+    """
+    POLL_INTERVAL = 0.1 # seconds, only used without pidfd support
+
+    def __init__(self):
+        super().__init__(name='ProcessSupervisor')
+        self.daemon = True
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._timers = list()
+        self._ready = collections.deque()
+        # proc -> (pidfd, on_exit), pidfd is None if the process is polled
+        self._procs = dict()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        os.set_blocking(self._wakeup_w, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, self._drain_wakeup)
+        self._stop_event = threading.Event()
+
+    def _wakeup(self):
+        if threading.current_thread() is self:
+            return
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except BlockingIOError:
+            # loop is already signalled
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def call_soon(self, callback, *args):
+        """Schedules callback(*args) in the supervisor thread, thread-safe"""
+        with self._lock:
+            self._ready.append((callback, args))
+        self._wakeup()
+
+    def call_later(self, delay, callback, *args):
+        """Schedules callback(*args) after delay seconds, thread-safe"""
+        timer = Timer(time.monotonic() + delay, callback, args)
+        with self._lock:
+            heapq.heappush(self._timers, (timer.deadline, next(self._seq), timer))
+        self._wakeup()
+        return timer
+
+    def watch(self, proc, on_exit):
+        """Calls on_exit(proc) in the supervisor thread as soon as proc exits"""
+        self.call_soon(self._watch, proc, on_exit)
+
+    def unwatch(self, proc):
+        """Stops watching proc, on_exit will not be called"""
+        self.call_soon(self._unwatch, proc)
+
+    def add_reader(self, fd, callback):
+        """Calls callback() in the supervisor thread whenever fd is readable"""
+        self.call_soon(self._selector.register, fd, selectors.EVENT_READ, callback)
+
+    def remove_reader(self, fd):
+        self.call_soon(self._selector.unregister, fd)
+
+    def _watch(self, proc, on_exit):
+        pidfd = None
+        try:
+            pidfd = os.pidfd_open(proc.pid)
+        except ProcessLookupError:
+            # already gone and reaped
+            self._procs[proc] = (None, on_exit)
+            self._reap(proc)
+            return
+        except (AttributeError, OSError):
+            # no pidfd support -> fall back to polling
+            pass
+        self._procs[proc] = (pidfd, on_exit)
+        if pidfd is not None:
+            self._selector.register(pidfd, selectors.EVENT_READ, lambda: self._reap(proc))
+
+    def _unwatch(self, proc):
+        try:
+            pidfd, _ = self._procs.pop(proc)
+        except KeyError:
+            return
+        if pidfd is not None:
+            self._selector.unregister(pidfd)
+            os.close(pidfd)
+
+    def _reap(self, proc):
+        if proc not in self._procs or proc.poll() is None:
+            return
+        _, on_exit = self._procs[proc]
+        self._unwatch(proc)
+        logging.debug('Process %d exited with %s' % (proc.pid, proc.returncode))
+        on_exit(proc)
+
+    def _timeout(self):
+        with self._lock:
+            if self._ready:
+                return 0
+            timeout = None
+            if self._timers:
+                timeout = max(0, self._timers[0][0] - time.monotonic())
+        if any(pidfd is None for pidfd, _ in self._procs.values()):
+            timeout = self.POLL_INTERVAL if timeout is None else min(timeout, self.POLL_INTERVAL)
+        return timeout
+
+    def _run_callback(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception('Supervisor callback %s failed' % (callback))
+
+    def run(self):
+        logging.info('Process supervisor started')
+        while not self._stop_event.is_set():
+            for key, _ in self._selector.select(self._timeout()):
+                self._run_callback(key.data, ())
+
+            for proc in [p for p, (pidfd, _) in self._procs.items() if pidfd is None]:
+                self._run_callback(self._reap, (proc,))
+
+            now = time.monotonic()
+            with self._lock:
+                ready = self._ready
+                self._ready = collections.deque()
+                while self._timers and self._timers[0][0] <= now:
+                    timer = heapq.heappop(self._timers)[2]
+                    if not timer.cancelled:
+                        ready.append((timer.callback, timer.args))
+            for callback, args in ready:
+                self._run_callback(callback, args)
+        logging.info('Process supervisor stopped')
+
+    def stop(self):
+        self._stop_event.set()
+        self._wakeup()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+In-process analysis of HLS variant playlists and their MPEG-TS/fMP4 segments
+ * reads the video resolution from the H.264 SPS of a segment (or of the fMP4 init segment)
+ * measures average/peak bandwidth from segment sizes and #EXTINF durations
+ * caches the results per rendition, keyed by segment name
+"""
+
+import collections
+import logging
+import pathlib
+import subprocess
+
+from ffmpeg_cmd_builder import analyse_input_format
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE   = 0x47
+# stream_type of H.264 video in the PMT
+STREAM_TYPE_H264 = 0x1b
+# only the head of a segment is scanned for a SPS
+SPS_SCAN_LIMIT = 256 * 1024
+
+
+def m3u_get_segments(filename):
+    """Returns a list of (duration, segment name) tuples of a variant playlist
+    """
+    segments = list()
+    duration = None
+    try:
+        with pathlib.Path(filename).open('r') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('#EXTINF:'):
+                    try:
+                        duration = float(line[len('#EXTINF:'):].split(',')[0])
+                    except ValueError:
+                        duration = None
+                elif line and not line.startswith('#'):
+                    segments.append((duration, line))
+                    duration = None
+    except FileNotFoundError:
+        return None
+    return segments
+
+def m3u_get_map(filename):
+    """Returns the URI of the initialization segment (#EXT-X-MAP) of a variant playlist or None
+    """
+    try:
+        with pathlib.Path(filename).open('r') as f:
+            for line in f:
+                if line.startswith('#EXT-X-MAP:'):
+                    for attribute in line.strip()[len('#EXT-X-MAP:'):].split(','):
+                        key, _, value = attribute.partition('=')
+                        if key == 'URI':
+                            return value.strip('"')
+                elif line.startswith('#EXTINF:'):
+                    # the map precedes the first segment
+                    return None
+    except FileNotFoundError:
+        pass
+    return None
+
+
+class BitReader(object):
+    """
+    Reads single bits and Exp-Golomb codes from a RBSP
+    """
+    def __init__(self, data):
+        self._data = data
+        self._pos  = 0
+
+    def u(self, n):
+        val = 0
+        for _ in range(n):
+            byte = self._data[self._pos >> 3]
+            val = (val << 1) | ((byte >> (7 - (self._pos & 7))) & 1)
+            self._pos += 1
+        return val
+
+    def ue(self):
+        leading_zeros = 0
+        while self.u(1) == 0:
+            leading_zeros += 1
+        return (1 << leading_zeros) - 1 + self.u(leading_zeros)
+
+    def se(self):
+        k = self.ue()
+        return (k + 1) // 2 if k & 1 else -(k // 2)
+
+
+def _remove_emulation_prevention(nal):
+    return nal.replace(b'\x00\x00\x03', b'\x00\x00')
+
+def _skip_scaling_list(r, size):
+    last_scale = 8
+    next_scale = 8
+    for _ in range(size):
+        if next_scale != 0:
+            next_scale = (last_scale + r.se() + 256) % 256
+        if next_scale != 0:
+            last_scale = next_scale
+
+def parse_sps(nal):
+    """Returns (width, height) of a H.264 sequence parameter set NAL unit
+    """
+    r = BitReader(_remove_emulation_prevention(nal[1:]))
+    profile_idc = r.u(8)
+    r.u(8) # constraint flags
+    r.u(8) # level_idc
+    r.ue() # seq_parameter_set_id
+    chroma_format_idc = 1
+    separate_colour_plane = 0
+    if profile_idc in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+        chroma_format_idc = r.ue()
+        if chroma_format_idc == 3:
+            separate_colour_plane = r.u(1)
+        r.ue() # bit_depth_luma_minus8
+        r.ue() # bit_depth_chroma_minus8
+        r.u(1) # qpprime_y_zero_transform_bypass_flag
+        if r.u(1): # seq_scaling_matrix_present_flag
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if r.u(1):
+                    _skip_scaling_list(r, 16 if i < 6 else 64)
+    r.ue() # log2_max_frame_num_minus4
+    pic_order_cnt_type = r.ue()
+    if pic_order_cnt_type == 0:
+        r.ue() # log2_max_pic_order_cnt_lsb_minus4
+    elif pic_order_cnt_type == 1:
+        r.u(1)
+        r.se()
+        r.se()
+        for _ in range(r.ue()):
+            r.se()
+    r.ue() # max_num_ref_frames
+    r.u(1) # gaps_in_frame_num_value_allowed_flag
+    pic_width_in_mbs  = r.ue() + 1
+    pic_height_in_map_units = r.ue() + 1
+    frame_mbs_only = r.u(1)
+    if not frame_mbs_only:
+        r.u(1) # mb_adaptive_frame_field_flag
+    r.u(1) # direct_8x8_inference_flag
+    crop_left = crop_right = crop_top = crop_bottom = 0
+    if r.u(1): # frame_cropping_flag
+        crop_left, crop_right, crop_top, crop_bottom = r.ue(), r.ue(), r.ue(), r.ue()
+
+    if chroma_format_idc == 0 or separate_colour_plane:
+        crop_unit_x = 1
+        crop_unit_y = 2 - frame_mbs_only
+    else:
+        crop_unit_x = 1 if chroma_format_idc == 3 else 2
+        crop_unit_y = (2 if chroma_format_idc == 1 else 1) * (2 - frame_mbs_only)
+
+    width  = pic_width_in_mbs * 16 - crop_unit_x * (crop_left + crop_right)
+    height = (2 - frame_mbs_only) * pic_height_in_map_units * 16 - crop_unit_y * (crop_top + crop_bottom)
+    return width, height
+
+
+def _ts_payloads(data):
+    """Yields (pid, payload_unit_start, payload) of all TS packets in data
+    """
+    for off in range(0, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+        pkt = data[off:off + TS_PACKET_SIZE]
+        if pkt[0] != TS_SYNC_BYTE:
+            raise ValueError('Lost MPEG-TS sync at offset %d' % off)
+        pusi = bool(pkt[1] & 0x40)
+        pid  = ((pkt[1] & 0x1f) << 8) | pkt[2]
+        afc  = (pkt[3] >> 4) & 0x3
+        start = 4
+        if afc & 0x2:
+            start += 1 + pkt[4]
+        if not afc & 0x1 or start >= TS_PACKET_SIZE:
+            continue
+        yield pid, pusi, pkt[start:]
+
+def _psi_section(payload):
+    pointer = payload[0]
+    return payload[1 + pointer:]
+
+def _find_sps(es):
+    """Returns the first SPS NAL unit of an Annex B byte stream or None
+    """
+    idx = es.find(b'\x00\x00\x01')
+    while idx >= 0:
+        nal_start = idx + 3
+        if nal_start < len(es) and (es[nal_start] & 0x1f) == 7:
+            end = es.find(b'\x00\x00\x01', nal_start)
+            if end < 0:
+                return None
+            return es[nal_start:end].rstrip(b'\x00')
+        idx = es.find(b'\x00\x00\x01', nal_start)
+    return None
+
+def ts_resolution(filename, limit=SPS_SCAN_LIMIT):
+    """Reads the video resolution from the first SPS of a MPEG-TS file
+
+    Returns (width, height) or None if no H.264 SPS was found.
+    """
+    with pathlib.Path(filename).open('rb') as f:
+        data = f.read(limit)
+
+    pmt_pid = None
+    video_pid = None
+    es = bytearray()
+    for pid, pusi, payload in _ts_payloads(data):
+        if pid == 0 and pmt_pid is None and pusi:
+            # PAT: take the first program
+            section = _psi_section(payload)
+            pmt_pid = ((section[10] & 0x1f) << 8) | section[11]
+        elif pid == pmt_pid and video_pid is None and pusi:
+            section = _psi_section(payload)
+            section_length = ((section[1] & 0x0f) << 8) | section[2]
+            program_info_length = ((section[10] & 0x0f) << 8) | section[11]
+            pos = 12 + program_info_length
+            # exclude CRC32
+            end = 3 + section_length - 4
+            while pos + 5 <= end:
+                stream_type = section[pos]
+                es_pid = ((section[pos + 1] & 0x1f) << 8) | section[pos + 2]
+                es_info_length = ((section[pos + 3] & 0x0f) << 8) | section[pos + 4]
+                if stream_type == STREAM_TYPE_H264:
+                    video_pid = es_pid
+                    break
+                pos += 5 + es_info_length
+        elif pid == video_pid:
+            if pusi:
+                # skip the PES header
+                payload = payload[9 + payload[8]:]
+            es += payload
+            sps = _find_sps(es)
+            if sps is not None:
+                return parse_sps(sps)
+    return None
+
+def mp4_resolution(filename):
+    """Reads the video resolution from the avcC box of a fMP4 initialization segment
+
+    Returns (width, height) or None if the file has no H.264 configuration.
+    """
+    with pathlib.Path(filename).open('rb') as f:
+        data = f.read(SPS_SCAN_LIMIT)
+    idx = data.find(b'avcC')
+    if idx < 0:
+        return None
+    # version, profile, compatibility, level, length size, number of SPS, SPS length
+    record = data[idx + 4:]
+    if len(record) < 8 or not record[5] & 0x1f:
+        return None
+    length = (record[6] << 8) | record[7]
+    return parse_sps(record[8:8 + length])
+
+def segment_start_pts(filename, limit=SPS_SCAN_LIMIT):
+    """Returns the first presentation timestamp of a segment or None
+
+    MPEG-TS: PTS (90 kHz) of the first video PES packet, fMP4: baseMediaDecodeTime
+    (timescale of the track) of the first fragment.
+    """
+    with pathlib.Path(filename).open('rb') as f:
+        data = f.read(limit)
+    idx = data.find(b'tfdt')
+    if data[:1] != bytes([TS_SYNC_BYTE]):
+        if idx < 0 or len(data) < idx + 16:
+            return None
+        if data[idx + 4] == 1:
+            return int.from_bytes(data[idx + 8:idx + 16], 'big')
+        return int.from_bytes(data[idx + 8:idx + 12], 'big')
+    for pid, pusi, payload in _ts_payloads(data):
+        # video PES header with PTS
+        if pusi and payload[:3] == b'\x00\x00\x01' and 0xe0 <= payload[3] <= 0xef and payload[7] & 0x80:
+            p = payload[9:14]
+            return (((p[0] >> 1) & 0x07) << 30) | (p[1] << 22) | ((p[2] >> 1) << 15) | (p[3] << 7) | (p[4] >> 1)
+    return None
+
+
+class BandwidthWindow(object):
+    """
+    Sliding window over the most recent segments of a rendition
+    """
+    def __init__(self, size):
+        self._segments = collections.deque(maxlen=size)
+
+    def add(self, num_bytes, duration):
+        if duration:
+            self._segments.append((num_bytes, duration))
+
+    def __len__(self):
+        return len(self._segments)
+
+    @property
+    def average(self):
+        duration = sum(d for _, d in self._segments)
+        if not duration:
+            return None
+        return int(sum(b for b, _ in self._segments) * 8 / duration)
+
+    @property
+    def peak(self):
+        if not self._segments:
+            return None
+        return int(max(b * 8 / d for b, d in self._segments))
+
+
+class SegmentProbeCache(object):
+    """
+    Per-rendition cache of segment properties keyed by segment name
+
+    Only segments that are new in the variant playlist are analysed, ffprobe is
+    the fallback if a segment cannot be analysed in-process.
+    """
+    def __init__(self, window_size=10):
+        self._segments = dict()
+        self._window = BandwidthWindow(window_size)
+        self._resolution = None
+
+    def probe(self, playlist):
+        """Returns the stream details of a variant playlist
+
+        The result has the layout of analyse_input_format(): bit_rate is the
+        peak bandwidth, avg_bit_rate the average over the window.
+        """
+        segments = m3u_get_segments(playlist)
+        if not segments:
+            return None
+
+        fallback = None
+        init = m3u_get_map(playlist)
+        if init is not None and self._resolution is None:
+            try:
+                self._resolution = mp4_resolution(playlist.parent / init)
+            except (ValueError, IndexError, OSError) as e:
+                logging.debug('Could not analyse init segment %s: %s' % (init, e))
+        for duration, name in segments:
+            if name in self._segments:
+                continue
+            segment_file = playlist.parent / name
+            try:
+                num_bytes = segment_file.stat().st_size
+            except FileNotFoundError:
+                continue
+            resolution = None
+            try:
+                if init is None:
+                    resolution = ts_resolution(segment_file)
+            except (ValueError, IndexError, OSError) as e:
+                logging.debug('Could not analyse segment %s: %s' % (segment_file, e))
+            if resolution is None and self._resolution is None:
+                # a fMP4 fragment cannot be probed without its init segment
+                try:
+                    fallback = analyse_input_format(playlist.parent / init if init else segment_file)
+                    stream = fallback['streams'][0]
+                    resolution = (int(stream['width']), int(stream['height']))
+                except (subprocess.CalledProcessError, OSError, KeyError, IndexError, ValueError) as e:
+                    # e.g. no video stream yet or the segment left the ring, it is not probed again
+                    logging.warning('Could not probe segment %s: %s' % (segment_file, e))
+                    fallback = None
+            if resolution is not None:
+                self._resolution = resolution
+            self._segments[name] = (num_bytes, duration, resolution)
+            self._window.add(num_bytes, duration)
+
+        # forget segments that left the playlist
+        names = set(name for _, name in segments)
+        for name in [n for n in self._segments if n not in names]:
+            del self._segments[name]
+
+        if self._resolution is None:
+            return None
+        peak = self._window.peak
+        average = self._window.average
+        if peak is None:
+            if fallback is None:
+                return None
+            peak = average = int(fallback['format']['bit_rate'])
+
+        return {'format': {'bit_rate': peak, 'avg_bit_rate': average},
+                'streams': [{'width': self._resolution[0], 'height': self._resolution[1]}]}
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Storage of the HLS segments of the cameras
+ * SegmentStore: output directories on disk (one per camera)
+ * RamSegmentStore: output directories on tmpfs with a memory budget per camera,
+   <hls_dir>/<cam_no> is a symlink into it, so nothing is written to the SD-card/eMMC
+ * WriteBehind: appends the segments of retained cameras to the DVR archive (dvr_archive)
+"""
+
+import os
+import time
+import queue
+import shutil
+import logging
+import pathlib
+import threading
+
+from transcoding_observer import TranscodingObserver
+from segment_analyser import m3u_get_segments, m3u_get_map
+
+SEGMENT_SUFFIXES = ('.ts', '.m4s', '.mp4')
+# segments that are not listed for this many target durations were left by a replaced process
+STALE_TARGETS = 3
+
+
+def dir_usage(directory):
+    """Returns (bytes, files) of the regular files in directory"""
+    size = files = 0
+    try:
+        with os.scandir(str(directory)) as it:
+            for entry in it:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                try:
+                    size += entry.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    # deleted by ffmpeg or renamed from .tmp since the listing
+                    continue
+                files += 1
+    except FileNotFoundError:
+        pass
+    return size, files
+
+
+class SegmentStore(object):
+    """
+    SegmentStore keeps the output of every camera in <root>/<cam_no>
+    """
+    def __init__(self, root):
+        self._root = pathlib.Path(root)
+        self._lock = threading.Lock()
+        # cam_no -> number of segments evicted to stay within the budget
+        self._evicted = dict()
+
+    def directory(self, cam_no):
+        return pathlib.PurePath(self._root, str(cam_no))
+
+    def prepare(self, cam_no, keep=False):
+        """Returns the (empty unless keep) output directory of a starting camera"""
+        directory = self.directory(cam_no)
+        if not keep:
+            self.release(cam_no)
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        return directory
+
+    def release(self, cam_no):
+        """Removes the output of a stopped camera"""
+        directory = str(self.directory(cam_no))
+        logging.debug('Removing output directory: %s' % directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def budget(self, cam_no):
+        """Maximum number of bytes of a camera or None"""
+        return None
+
+    def enforce(self, cam_no, live, stale_before=None):
+        """Evicts the oldest segments that are not in the set of live names if over budget
+
+        Segments that are not live and older than stale_before (time.time()) are
+        deleted in any case: ffmpeg only deletes the segments it wrote itself.
+        """
+        budget = self.budget(cam_no)
+        if budget is None and stale_before is None:
+            return
+        directory = pathlib.Path(self.directory(cam_no))
+        try:
+            entries = [ e for e in os.scandir(str(directory)) if e.is_file(follow_symlinks=False) ]
+        except FileNotFoundError:
+            return
+        stats = dict()
+        for e in entries:
+            try:
+                stats[e.name] = e.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                # deleted by ffmpeg or renamed from .tmp since the listing
+                continue
+        used = sum(s.st_size for s in stats.values())
+        candidates = sorted((s.st_mtime, name) for name,s in stats.items()
+                            if name not in live and name.endswith(SEGMENT_SUFFIXES))
+        for mtime, name in candidates:
+            stale = stale_before is not None and mtime < stale_before
+            if not stale and (budget is None or used <= budget):
+                continue
+            try:
+                os.unlink(str(directory / name))
+            except FileNotFoundError:
+                continue
+            used -= stats[name].st_size
+            if stale:
+                continue
+            with self._lock:
+                self._evicted[cam_no] = self._evicted.get(cam_no, 0) + 1
+        if budget is not None and used > budget:
+            logging.warning('Cam %s uses %d bytes, budget is %d' % (cam_no, used, budget))
+
+    def report(self, cam_nos):
+        result = dict()
+        for cam_no in cam_nos:
+            size, files = dir_usage(self.directory(cam_no))
+            with self._lock:
+                evicted = self._evicted.get(cam_no, 0)
+            result[cam_no] = dict(bytes=size, files=files, budget=self.budget(cam_no), evicted=evicted)
+        return result
+
+
+class RamSegmentStore(SegmentStore):
+    """
+    RamSegmentStore keeps the output of every camera in memory (tmpfs)
+
+    <root>/<cam_no> is a symlink to <ram_dir>/<cam_no>, so the web server,
+    the playlist watcher and the origin see the usual layout. A camera may
+    use up to budget bytes; the pages of tmpfs are accounted to the backend.
+    """
+    def __init__(self, root, ram_dir='/dev/shm/cowcam', budget=64 * 1024 * 1024):
+        super().__init__(root)
+        self._ram_dir = pathlib.Path(ram_dir)
+        self._budget = budget
+
+    def budget(self, cam_no):
+        return self._budget
+
+    def prepare(self, cam_no, keep=False):
+        link = pathlib.Path(self.directory(cam_no))
+        target = self._ram_dir / str(cam_no)
+        if not keep:
+            self.release(cam_no)
+        target.mkdir(parents=True, exist_ok=True)
+        if not link.is_symlink():
+            link.parent.mkdir(parents=True, exist_ok=True)
+            # a directory left by SegmentStore
+            shutil.rmtree(str(link), ignore_errors=True)
+            link.symlink_to(target, target_is_directory=True)
+        return link
+
+    def release(self, cam_no):
+        link = pathlib.Path(self.directory(cam_no))
+        shutil.rmtree(str(self._ram_dir / str(cam_no)), ignore_errors=True)
+        if link.is_symlink():
+            link.unlink()
+        else:
+            shutil.rmtree(str(link), ignore_errors=True)
+
+
+def create_segment_store(root, cfg=None):
+    """Creates the store configured by segment_store: {type: disk|ram, ram_dir, budget_mb}"""
+    cfg = cfg or dict()
+    if cfg.get('type', 'disk') == 'ram':
+        return RamSegmentStore(root, cfg.get('ram_dir', '/dev/shm/cowcam'),
+                               int(float(cfg.get('budget_mb', 64)) * 1024 * 1024))
+    return SegmentStore(root)
+
+
+class WriteBehind(object):
+    """
+    WriteBehind appends segments to the DVR archive in a background thread
+
+    The queue is bounded: if the disk cannot keep up, segments are dropped
+    (and counted) instead of growing the memory of the backend.
+    """
+    def __init__(self, archive, max_queue=64):
+        self._archive = archive
+        self._queue = queue.Queue(maxsize=max_queue)
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run, name='WriteBehind')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, cam_no, segment_file, duration=None, init=False):
+        """Queues segment_file (a fmp4 init segment if init) for the archive of cam_no"""
+        try:
+            self._queue.put_nowait((cam_no, pathlib.Path(segment_file), duration, init))
+        except queue.Full:
+            self.dropped += 1
+            logging.warning('Write-behind queue full, dropping %s' % (segment_file))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            cam_no, segment_file, duration, init = item
+            try:
+                self._archive.append(cam_no, segment_file, duration, init)
+                self.written += 1
+            except OSError as e:
+                # e.g. evicted from the ring before it was archived
+                self.failed += 1
+                logging.warning('Write-behind of %s failed: %s' % (segment_file, e))
+
+    def report(self):
+        return dict(queued=self._queue.qsize(), written=self.written,
+                    dropped=self.dropped, failed=self.failed)
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+class SegmentTracker(TranscodingObserver):
+    """
+    Observer that follows the segments listed in the variant playlists
+
+     * keeps the camera within the budget of the store
+     * deletes the segments left by replaced processes (STALE_TARGETS)
+     * hands every new segment of the main rendition (first variant playlist)
+       of a retained camera to the write-behind
+    """
+    def __init__(self, store, cam_no, write_behind=None):
+        self._store = store
+        self._cam_no = cam_no
+        self._write_behind = write_behind
+        # names of the segments of the main rendition already seen
+        self._seen = set()
+        # mtime of the last archived fmp4 init segment
+        self._init_mtime = None
+
+    def update(self, s):
+        live = set()
+        playlists = [ f for p in s.processFactories for f in p.fileList() ]
+        for idx,playlist in enumerate(playlists):
+            segments = m3u_get_segments(playlist) or list()
+            live.update(os.path.basename(name) for _, name in segments)
+            live.add(playlist.name)
+            init = m3u_get_map(playlist)
+            if init:
+                live.add(os.path.basename(init))
+            if idx == 0 and self._write_behind:
+                self._archive(playlist, segments, init)
+        target = max([ p.segmentDuration() or 0 for p in s.processFactories ] or [ 0 ])
+        self._store.enforce(self._cam_no, live, time.time() - STALE_TARGETS * max(target, 1))
+
+    def _archive(self, playlist, segments, init):
+        if init:
+            # ahead of the segments that need it, whenever ffmpeg rewrote it
+            try:
+                mtime = os.stat(str(playlist.parent / init)).st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if mtime is not None and mtime != self._init_mtime:
+                self._init_mtime = mtime
+                self._write_behind.submit(self._cam_no, playlist.parent / init, init=True)
+        names = set()
+        for duration, name in segments:
+            names.add(name)
+            if name not in self._seen:
+                self._write_behind.submit(self._cam_no, playlist.parent / name, duration)
+        self._seen = names
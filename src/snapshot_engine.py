@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+Captures still images from the cameras
+ * bounded worker pool sharing one HTTP connection pool (keep-alive)
+ * every capture has a total deadline
+ * images are written atomically and only if they changed
+ * repeated requests for the same image collapse into the pending capture
+"""
+
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from hls_playlist import atomic_write
+
+
+class SnapshotEngine(object):
+    """
+    SnapshotEngine downloads camera snapshots concurrently
+
+    capture() returns a Future, its result is True if the image file was
+    (re)written and False if the camera delivered an unchanged image.
+    """
+    def __init__(self, max_workers=4, timeout=10, connect_timeout=3):
+        self._timeout = timeout
+        self._connect_timeout = connect_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='snapshot')
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        # url -> ETag of the last image
+        self._etags = dict()
+        # output file -> digest of the last image
+        self._digests = dict()
+        # output file -> Future of the pending or running capture
+        self._pending = dict()
+        self.coalesced = 0
+
+    def capture(self, url, output_file):
+        """Submits the download of url to output_file and returns a Future"""
+        return self._submit(str(output_file), self._capture, url)
+
+    def copy(self, image_file, output_file):
+        """Submits the copy of a JPEG written by ffmpeg to output_file and returns a Future"""
+        return self._submit(str(output_file), self._copy, str(image_file))
+
+    def _submit(self, output_file, fn, source):
+        with self._lock:
+            future = self._pending.get(output_file)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = self._executor.submit(fn, source, output_file)
+            self._pending[output_file] = future
+        future.add_done_callback(lambda f: self._done(output_file, f))
+        return future
+
+    def _done(self, output_file, future):
+        with self._lock:
+            if self._pending.get(output_file) is future:
+                del self._pending[output_file]
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def _copy(self, image_file, output_file):
+        with open(image_file, 'rb') as f:
+            content = f.read()
+        # ffmpeg updates the image in place, do not publish a torn read
+        if not content.endswith(b'\xff\xd9'):
+            raise ValueError('Incomplete JPEG %s' % (image_file))
+        return self._store(output_file, content)
+
+    def _capture(self, url, output_file):
+        deadline = time.monotonic() + self._timeout
+        headers = dict()
+        with self._lock:
+            etag = self._etags.get(url)
+        if etag:
+            headers['If-None-Match'] = etag
+
+        with self._session.get(url, headers=headers, stream=True,
+                               timeout=(self._connect_timeout, self._timeout)) as r:
+            if r.status_code == requests.codes.not_modified:
+                logging.debug('Snapshot %s not modified' % (url))
+                return False
+            r.raise_for_status()
+            chunks = list()
+            for chunk in r.iter_content(chunk_size=65536):
+                if time.monotonic() > deadline:
+                    raise TimeoutError('Snapshot %s exceeded its deadline of %ds' % (url, self._timeout))
+                chunks.append(chunk)
+            content = b''.join(chunks)
+            etag = r.headers.get('ETag')
+
+        if etag:
+            with self._lock:
+                self._etags[url] = etag
+        return self._store(output_file, content)
+
+    def _store(self, output_file, content):
+        digest = hashlib.sha1(content).digest()
+        with self._lock:
+            if self._digests.get(output_file) == digest:
+                logging.debug('Snapshot %s unchanged' % (output_file))
+                return False
+        atomic_write(output_file, content)
+        with self._lock:
+            self._digests[output_file] = digest
+        return True
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+        self._session.close()
@@ -12,3 +12,7 @@ class TranscodingObserver(object, metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def update(self):
         ...
+
+    def progress(self, s, idx, sample):
+        """Called with every progress sample of process idx of the subject s"""
+        pass
@@ -0,0 +1,7 @@
+# -*- coding: utf8 -*-
+
+import sys
+import pathlib
+
+# the modules of the backend are imported flat from src, as by the scripts themselves
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'src'))
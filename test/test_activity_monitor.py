@@ -0,0 +1,76 @@
+# -*- coding: utf8 -*-
+
+import pytest
+
+import activity_monitor
+from activity_monitor import ActivityPolicy, ACTIVE, IDLE, activity_score, read_pgm
+
+
+def run(policy, samples):
+    """Feeds (time, score) samples, returns the state changes as (time, state)"""
+    changes = list()
+    for now, score in samples:
+        changed = policy.update(score, now)
+        if changed:
+            changes.append((now, changed))
+    return changes
+
+def test_policy_idles_after_quiet_period():
+    policy = ActivityPolicy(threshold=0.1, idle_after=30, min_dwell=0, now=0)
+    assert run(policy, [ (t, 0.0) for t in range(0, 40, 2) ]) == [ (30, IDLE) ]
+
+def test_policy_hysteresis():
+    policy = ActivityPolicy(threshold=0.1, idle_after=30, min_dwell=0, now=0)
+    # above idle_threshold (0.05) keeps the camera active
+    assert run(policy, [ (t, 0.06) for t in range(0, 100, 2) ]) == list()
+    policy.state = IDLE
+    # below threshold does not wake it up
+    assert run(policy, [ (t, 0.09) for t in range(100, 200, 2) ]) == list()
+    assert run(policy, [ (200, 0.1) ]) == [ (200, ACTIVE) ]
+
+def test_policy_active_samples():
+    policy = ActivityPolicy(threshold=0.1, active_samples=3, min_dwell=0, state=IDLE, now=0)
+    assert run(policy, [ (1, 0.5), (2, 0.5), (3, 0.0), (4, 0.5), (5, 0.5), (6, 0.5) ]) == [ (6, ACTIVE) ]
+
+def test_policy_min_dwell():
+    policy = ActivityPolicy(threshold=0.1, idle_after=10, min_dwell=60, now=0)
+    # idle only once the active state was kept for min_dwell
+    assert run(policy, [ (t, 0.0) for t in range(0, 70, 2) ]) == [ (60, IDLE) ]
+    # a flicker right after the switch does not wake the camera before min_dwell
+    assert run(policy, [ (62, 1.0), (100, 1.0), (119, 1.0), (120, 1.0) ]) == [ (120, ACTIVE) ]
+
+def test_policy_starts_in_restored_state():
+    policy = ActivityPolicy(threshold=0.1, min_dwell=0, state=IDLE, now=0)
+    assert run(policy, [ (1, 0.5) ]) == [ (1, ACTIVE) ]
+
+
+@pytest.fixture(params=[ 'numpy', 'python' ])
+def differencing(request, monkeypatch):
+    if request.param == 'python':
+        monkeypatch.setattr(activity_monitor, 'numpy', None)
+    elif activity_monitor.numpy is None:
+        pytest.skip('NumPy is not installed')
+
+def test_activity_score(differencing):
+    frame = bytes(range(64)) * 16
+    assert activity_score(frame, frame) == 0.0
+    # brighter scene (lights, IR switch) is no activity
+    assert activity_score(frame, bytes(min(255, p + 40) for p in frame)) == 0.0
+    # 5% of the pixels change, the mean brightness shifts by 5
+    changed = bytearray(frame)
+    changed[:51] = bytes(p + 100 for p in frame[:51])
+    assert activity_score(frame, bytes(changed)) == pytest.approx(51 / 1024.0)
+
+def test_read_pgm(tmp_path):
+    image = tmp_path / 'activity.pgm'
+    image.write_bytes(b'P5\n4 2\n255\n' + bytes(range(8)))
+    assert read_pgm(image) == (4, 2, bytes(range(8)))
+    # pixels with the values of whitespace
+    image.write_bytes(b'P5 4 2 255\n' + b'\n\t \r' * 2)
+    assert read_pgm(image) == (4, 2, b'\n\t \r' * 2)
+    image.write_bytes(b'P5\n4 2\n255\n' + bytes(range(7)))
+    with pytest.raises(ValueError):
+        read_pgm(image)
+    image.write_bytes(b'P6\n4 2\n255\n' + bytes(range(24)))
+    with pytest.raises(ValueError):
+        read_pgm(image)
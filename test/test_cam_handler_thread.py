@@ -0,0 +1,55 @@
+# -*- coding: utf8 -*-
+
+import pytest
+
+import cam_handler_thread
+from cam_handler_thread import RestartBackoff
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cam_handler_thread.time, 'monotonic', clock)
+    return clock
+
+
+def test_backoff_doubles_up_to_max(clock):
+    backoff = RestartBackoff(base_delay=1, max_delay=10, jitter=0)
+    backoff.started()
+    assert [ backoff.failed() for _ in range(6) ] == [ 1, 2, 4, 8, 10, 10 ]
+    assert backoff.restarts == 6
+
+def test_backoff_jitter(clock):
+    backoff = RestartBackoff(base_delay=4, jitter=0.25)
+    for _ in range(20):
+        backoff.consecutive_failures = 0
+        assert 3 <= backoff.failed() <= 5
+
+def test_backoff_reset_after_stable_run(clock):
+    backoff = RestartBackoff(base_delay=1, jitter=0, stable_after=60)
+    backoff.started()
+    backoff.failed()
+    backoff.failed()
+    backoff.started()
+    clock.now += 60
+    assert backoff.failed() == 1
+    assert backoff.consecutive_failures == 1
+
+def test_backoff_degraded_within_window(clock):
+    backoff = RestartBackoff(degraded_failures=3, window=100)
+    for _ in range(2):
+        backoff.failed()
+        clock.now += 10
+    assert not backoff.degraded
+    backoff.failed()
+    assert backoff.degraded
+    assert backoff.status()['degraded']
+    clock.now += 101
+    assert not backoff.degraded
@@ -0,0 +1,109 @@
+# -*- coding: utf8 -*-
+
+import time
+import threading
+
+import yaml
+import pytest
+
+from cam_manager import Borg, CamManager
+
+
+def camera(cam_no, uri, **cfg):
+    return dict(cfg, cam_no=cam_no, sources=[ dict(uri=uri, streams=[ dict(encoder='libx264') ]) ])
+
+def write_config(filename, cameras, **cfg):
+    filename.write_text(yaml.dump(dict(cfg, hls_dir=str(filename.parent / 'hls'), cameras=cameras)))
+    return filename
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    # fresh shared state for every test
+    monkeypatch.setattr(Borg, '_shared_state', { '_lock': threading.Lock() })
+    manager = CamManager()
+    def factory(cam_cfg, output_dir):
+        pytest.fail('no camera is started by a reload test')
+    manager.loadConfig(write_config(tmp_path / 'cams.yaml', [
+        camera(1, 'rtsp://one'), camera(2, 'rtsp://two'), camera(3, 'rtsp://three'), camera(4, 'rtsp://four')
+    ]), factory)
+    yield manager
+    # let the pending commands finish before the event loop stops
+    for _ in range(500):
+        if not any(lane['active'] for lane in manager._executor.metrics().values()):
+            break
+        time.sleep(0.01)
+    manager._executor.shutdown()
+    manager._snapshots.shutdown()
+    manager._supervisor.stop()
+
+@pytest.fixture
+def calls(manager, monkeypatch):
+    """Records stop/start with the uri the camera had at the time of the call"""
+    calls = list()
+    def record(name):
+        def fn(cam_id, deadline=None):
+            calls.append((name, cam_id, manager._cam_cfg(cam_id)['sources'][0]['uri']))
+        return fn
+    monkeypatch.setattr(manager, 'stop', record('stop'))
+    monkeypatch.setattr(manager, 'start', record('start'))
+    return calls
+
+@pytest.fixture
+def events(manager):
+    events = list()
+    manager.events.attach(lambda topic, message: events.append((message['cam_id'], message['event'],
+                                                                 message.get('restarted'))))
+    return events
+
+
+def test_only_changed_cameras_are_restarted(manager, calls, events, tmp_path):
+    # camera 1 is running, camera 2 is being started
+    manager._cam_obj[1]['cam_thread'] = object()
+    release = threading.Event()
+    manager._executor.submit(2, 'block', lambda: release.wait(5))
+    manager._executor.submit(2, 'start', lambda: None)
+    try:
+        result = manager.reload_config(str(write_config(tmp_path / 'cams.yaml', [
+            camera(1, 'rtsp://one.new'), camera(2, 'rtsp://two.new'), camera(3, 'rtsp://three.new'),
+            camera(5, 'rtsp://five') ])))
+    finally:
+        release.set()
+    assert result == dict(added=[ 5 ], removed=[ 4 ], changed=[ 1, 2, 3 ], restarted=[ 1, 2 ])
+    # stopped with the old, started with the new configuration, the stopped camera 3 stays stopped
+    assert calls == [ ('stop', 4, 'rtsp://four'), ('stop', 1, 'rtsp://one'), ('stop', 2, 'rtsp://two'),
+                      ('start', 1, 'rtsp://one.new'), ('start', 2, 'rtsp://two.new') ]
+    assert manager.cam_list == [ 1, 2, 3, 5 ]
+    assert sorted(events) == [ (1, 'reconfigured', True), (2, 'reconfigured', True),
+                               (3, 'reconfigured', False), (4, 'removed', None), (5, 'added', None) ]
+    # the removed camera is dropped after its pending commands
+    for _ in range(500):
+        if 4 not in manager._cam_obj:
+            break
+        time.sleep(0.01)
+    assert 4 not in manager._cam_obj and 5 in manager._cam_obj
+
+def test_unchanged_cameras_keep_running(manager, calls, events, tmp_path):
+    manager._cam_obj[1]['cam_thread'] = object()
+    result = manager.reload_config()
+    assert result == dict(added=[], removed=[], changed=[], restarted=[])
+    assert calls == [] and events == []
+
+def test_global_keys_change_every_camera(manager, calls, tmp_path):
+    manager._cam_obj[3]['cam_thread'] = object()
+    result = manager.reload_config(str(write_config(tmp_path / 'cams.yaml', [
+        camera(1, 'rtsp://one'), camera(2, 'rtsp://two'), camera(3, 'rtsp://three'),
+        camera(4, 'rtsp://four') ], stall_factor=8)))
+    assert result['changed'] == [ 1, 2, 3, 4 ] and result['restarted'] == [ 3 ]
+    assert calls == [ ('stop', 3, 'rtsp://three'), ('start', 3, 'rtsp://three') ]
+
+def test_changed_latency_profile_changes_its_cameras(manager, calls, tmp_path):
+    def cameras():
+        cams = [ camera(1, 'rtsp://one'), camera(2, 'rtsp://two') ]
+        cams[1]['sources'][0]['latency'] = 'custom'
+        return cams
+    filename = write_config(tmp_path / 'cams.yaml', cameras(), latency_profiles=dict(custom=dict(hls_time=3)))
+    manager.reload_config(str(filename))
+    # only the profile definition changes, the cameras refer to it by name
+    filename = write_config(tmp_path / 'cams.yaml', cameras(), latency_profiles=dict(custom=dict(hls_time=4)))
+    result = manager.reload_config(str(filename))
+    assert result['changed'] == [ 2 ]
@@ -0,0 +1,114 @@
+# -*- coding: utf8 -*-
+
+import time
+import threading
+
+import pytest
+
+from command_executor import CommandExecutor, CONTROL, BACKGROUND
+
+
+@pytest.fixture
+def executor():
+    executor = CommandExecutor(max_workers=4)
+    yield executor
+    executor.shutdown()
+
+def block(executor, cam_id=1):
+    """Occupies the lane of cam_id until the returned event is set"""
+    release = threading.Event()
+    started = threading.Event()
+    def wait():
+        started.set()
+        release.wait(5)
+    handle = executor.submit(cam_id, 'block', wait)
+    assert started.wait(5)
+    return release, handle
+
+
+def test_commands_of_a_camera_run_in_order(executor):
+    order = list()
+    handles = [ executor.submit(1, 'cmd%d' % i, lambda i=i: order.append(i) or i) for i in range(5) ]
+    assert [ h.result(5) for h in handles ] == list(range(5))
+    assert order == list(range(5))
+    assert [ h.state for h in handles ] == [ 'done' ] * 5
+
+def test_cameras_run_concurrently(executor):
+    release, handle = block(executor, 1)
+    assert executor.submit(2, 'other', lambda: 'done').result(5) == 'done'
+    release.set()
+    handle.result(5)
+
+def test_control_before_background(executor):
+    order = list()
+    release, _ = block(executor)
+    background = executor.submit(1, 'notify', lambda: order.append('notify'), BACKGROUND)
+    control = executor.submit(1, 'start', lambda: order.append('start'))
+    assert executor.metrics(1)[1]['depth'] == [ 1, 1 ]
+    release.set()
+    background.result(5)
+    control.result(5)
+    assert order == [ 'start', 'notify' ]
+
+def test_coalescing(executor):
+    calls = list()
+    release, _ = block(executor)
+    first = executor.submit(1, 'notify', lambda: calls.append(1), BACKGROUND)
+    second = executor.submit(1, 'notify', lambda: calls.append(2), BACKGROUND)
+    # different priority: not coalesced
+    control = executor.submit(1, 'notify', lambda: calls.append(3), CONTROL)
+    assert second is first and control is not first
+    release.set()
+    first.result(5)
+    control.result(5)
+    assert sorted(calls) == [ 1, 3 ]
+    assert executor.metrics(1)[1]['coalesced'] == 1
+
+def test_owners_are_not_coalesced(executor):
+    calls = list()
+    release, _ = block(executor)
+    old, new = object(), object()
+    stale = executor.submit(1, 'notify', lambda: calls.append('old'), BACKGROUND, owner=old)
+    fresh = executor.submit(1, 'notify', lambda: calls.append('new'), BACKGROUND, owner=new)
+    assert fresh is not stale
+    assert executor.submit(1, 'notify', lambda: calls.append('again'), BACKGROUND, owner=new) is fresh
+    release.set()
+    fresh.result(5)
+    assert calls == [ 'old', 'new' ]
+
+def test_supersedes(executor):
+    calls = list()
+    release, _ = block(executor)
+    start = executor.submit(1, 'start', lambda: calls.append('start'))
+    assert executor.pending(1, 'start')
+    stop = executor.submit(1, 'stop', lambda: calls.append('stop'), supersedes=('start',))
+    assert start.state == 'cancelled'
+    assert not executor.pending(1, 'start')
+    release.set()
+    stop.result(5)
+    assert calls == [ 'stop' ]
+
+def test_failure_is_reported(executor):
+    def fail():
+        raise RuntimeError('broken')
+    handle = executor.submit(1, 'fail', fail)
+    with pytest.raises(RuntimeError):
+        handle.result(5)
+    assert handle.state == 'failed'
+    # the lane keeps working
+    assert executor.submit(1, 'next', lambda: 1).result(5) == 1
+    assert [ c['name'] for c in executor.commands(1) ] == [ 'fail', 'next' ]
+
+def test_retire(executor):
+    release, _ = block(executor)
+    handle = executor.submit(1, 'cmd', lambda: None)
+    executor.retire(1)
+    # the lane is dropped once it is drained
+    assert 1 in executor.metrics()
+    release.set()
+    handle.result(5)
+    for _ in range(500):
+        if 1 not in executor.metrics():
+            break
+        time.sleep(0.01)
+    assert 1 not in executor.metrics()
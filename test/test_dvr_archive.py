@@ -0,0 +1,151 @@
+# -*- coding: utf8 -*-
+
+import os
+import random
+
+import pytest
+
+from dvr_archive import DvrArchive, Index, RECORD, MEDIA, INIT, MAX_WINDOW, parse_time
+
+# 50 minutes into an hour (UTC), 2s segments cross into the next hour after 300 segments
+BASE = 1700000000 - 1700000000 % 3600 + 3000
+DURATION = 2.0
+
+
+def write_segment(directory, name, wall, payload, duration=DURATION):
+    segment = directory / name
+    segment.write_bytes(payload)
+    # the archive takes the end of the segment from its mtime
+    os.utime(str(segment), (wall + duration, wall + duration))
+    return segment
+
+def fill(archive, directory, count, cam_no=1, start=BASE, suffix='.ts', inits=(), gap_after=None):
+    """Appends count segments, returns their (wall, payload)"""
+    segments = list()
+    wall = start
+    for i in range(count):
+        if i in inits:
+            init = directory / 'p_init.mp4'
+            init.write_bytes(b'init%d' % (i) * 8)
+            archive.append(cam_no, init, None, init=True)
+        payload = b'segment %d ' % (i) * (1 + i % 7)
+        archive.append(cam_no, write_segment(directory, 'p.%03d%s' % (i % 1000, suffix), wall, payload), DURATION)
+        segments.append((wall, payload))
+        wall += DURATION
+        if i == gap_after:
+            wall += 60
+    return segments
+
+def read(archive, cam_no, record):
+    with open(str(archive.root / str(cam_no) / record.partition), 'rb') as f:
+        f.seek(record.offset)
+        return f.read(record.size)
+
+
+def test_index_round_trip(tmp_path):
+    records = [ (BASE + i * 2.0, 2.0, i * 180000, i * 100, 100, MEDIA if i else INIT) for i in range(50) ]
+    index_file = tmp_path / '00.ts.idx'
+    index_file.write_bytes(b''.join(RECORD.pack(*r) for r in records) + b'\0' * (RECORD.size - 1))
+    index = Index(index_file)
+    try:
+        # the incomplete record is ignored
+        assert len(index) == 50
+        assert [ index[i] for i in range(len(index)) ] == [ r[0] for r in records ]
+        r = index.record('00.ts', 7)
+        assert (r.partition, r.wall, r.duration, r.pts, r.offset, r.size, r.kind) == ('00.ts',) + records[7]
+    finally:
+        index.close()
+    assert len(Index(tmp_path / 'missing.idx')) == 0
+
+def test_query_matches_scan(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    archive = DvrArchive(tmp_path / 'dvr')
+    segments = fill(archive, src, 600)
+    assert archive.report([1])['cameras'][1]['partitions'] == 2
+    rng = random.Random(1)
+    windows = [ (BASE, BASE + 1200), (BASE + 598.0, BASE + 602.0), (BASE + 599.5, BASE + 600.5),
+                (BASE - 100, BASE + 1), (BASE + 1199, BASE + 5000), (BASE + 2000, BASE + 3000) ]
+    windows += [ sorted((BASE + rng.uniform(-10, 1210), BASE + rng.uniform(-10, 1210))) for _ in range(50) ]
+    for start, end in windows:
+        expected = [ payload for wall, payload in segments if wall < end and wall + DURATION > start ]
+        records = archive.query(1, start, end)
+        assert all(r.kind == MEDIA for r in records)
+        assert [ read(archive, 1, r) for r in records ] == expected, (start - BASE, end - BASE)
+
+def test_reload_and_dedupe(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    archive = DvrArchive(tmp_path / 'dvr')
+    segments = fill(archive, src, 400)
+    reloaded = DvrArchive(tmp_path / 'dvr')
+    # listed again after a restart of the backend
+    reloaded.append(1, write_segment(src, 'p.399.ts', segments[-1][0], segments[-1][1]), DURATION)
+    assert reloaded.appended == 0
+    records = reloaded.query(1, BASE, BASE + 10000)
+    assert [ read(reloaded, 1, r) for r in records ] == [ payload for _, payload in segments ]
+
+def test_fmp4_init_in_effect(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    archive = DvrArchive(tmp_path / 'dvr')
+    # a new ffmpeg process (new init) at segment 200, the next hour starts at segment 300
+    fill(archive, src, 400, suffix='.m4s', inits=(0, 200))
+    for start, init in ((BASE + 10, b'init0'), (BASE + 390, b'init0'), (BASE + 400, b'init200'),
+                        (BASE + 500, b'init200'), (BASE + 700, b'init200')):
+        records = archive.query(1, start, start + 6)
+        assert [ r.kind for r in records ] == [ INIT, MEDIA, MEDIA, MEDIA ]
+        assert read(archive, 1, records[0]) == init * 8
+        assert records[0].partition == records[1].partition
+    # across the change of the init segment
+    records = archive.query(1, BASE + 396, BASE + 404)
+    assert [ r.kind for r in records ] == [ INIT, MEDIA, MEDIA, INIT, MEDIA, MEDIA ]
+
+def test_playlist(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    archive = DvrArchive(tmp_path / 'dvr')
+    segments = fill(archive, src, 20, gap_after=9)
+    lines = archive.playlist(1, BASE, BASE + 1000).decode().splitlines()
+    assert lines[0] == '#EXTM3U' and lines[-1] == '#EXT-X-ENDLIST'
+    assert lines.count('#EXT-X-DISCONTINUITY') == 1
+    assert lines.count('#EXTINF:2.000,') == 20
+    ranges = [ (l.split(':')[1], lines[i + 1]) for i,l in enumerate(lines) if l.startswith('#EXT-X-BYTERANGE:') ]
+    payloads = list()
+    for byte_range, uri in ranges:
+        size, offset = (int(v) for v in byte_range.split('@'))
+        with open(str(archive.root / '1' / uri), 'rb') as f:
+            f.seek(offset)
+            payloads.append(f.read(size))
+    assert payloads == [ payload for _, payload in segments ]
+    # the discontinuity precedes the first segment after the gap
+    assert lines[lines.index('#EXT-X-DISCONTINUITY') + 3] == '#EXT-X-BYTERANGE:%d@%d' % (
+            len(segments[10][1]), sum(len(p) for _, p in segments[:10]))
+
+def test_playlist_window_is_capped(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    archive = DvrArchive(tmp_path / 'dvr')
+    fill(archive, src, 3, start=BASE)
+    fill(archive, src, 3, start=BASE + MAX_WINDOW + 100)
+    playlist = archive.playlist(1, BASE, BASE + 2 * MAX_WINDOW).decode()
+    assert playlist.count('#EXTINF') == 3
+
+def test_retention_by_size(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    archive = DvrArchive(tmp_path / 'dvr', max_bytes=1)
+    fill(archive, src, 600)
+    report = archive.report([1])
+    # the partition being written is never deleted
+    assert report['cameras'][1]['partitions'] == 1 and report['deleted'] == 1
+    assert archive.query(1, BASE, BASE + 599)  == []
+    assert len(archive.query(1, BASE + 600, BASE + 1200)) == 300
+    assert sorted(os.listdir(str(archive.root / '1'))) == [ '2023-11-14' ]
+
+@pytest.mark.parametrize('value, expected', [ (1700000000, 1700000000.0), ('1700000000.5', 1700000000.5) ])
+def test_parse_time(value, expected):
+    assert parse_time(value) == expected
+
+def test_parse_local_time():
+    assert parse_time('2024-05-01 12:30') == parse_time('2024-05-01T12:30:00')
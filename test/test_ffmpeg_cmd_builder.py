@@ -0,0 +1,113 @@
+# -*- coding: utf8 -*-
+
+import pathlib
+
+import pytest
+
+from ffmpeg_cmd_builder import FFMPEGCmdBuilder, FFMPEGHlsStream, FFMPEGSnapshotStream, \
+                               latency_profile, LATENCY_PROFILES
+
+
+def hls(name, width=None, encoder='libx264', framerate=None):
+    stream = FFMPEGHlsStream(pathlib.Path(name), encoder)
+    stream['video_width'] = width
+    stream['video_framerate'] = framerate
+    return stream
+
+def builder(*streams):
+    ffmpeg_obj = FFMPEGCmdBuilder('rtsp://cam', 'h264')
+    for stream in streams:
+        ffmpeg_obj.addOutputStream(stream)
+    return ffmpeg_obj
+
+
+def test_single_source_resolution_needs_no_graph():
+    stream = hls('a.m3u8')
+    assert builder(stream)._filter_graph() == ''
+    assert stream.map_label == '0:v'
+
+def test_ladder_is_scaled_in_cascade():
+    streams = [ hls('full.m3u8'), hls('hd.m3u8', 1280), hls('sd1.m3u8', 640), hls('sd2.m3u8', 640) ]
+    ffmpeg_obj = builder(*streams)
+    # decoded once, every width is scaled once from the next larger one
+    assert ffmpeg_obj._filter_graph().split(';') == [
+        '[0:v]split=2[v0][v1]',
+        '[v1]scale=1280:-2,split=2[v2][v3]',
+        '[v3]scale=640:-2,split=2[v4][v5]',
+    ]
+    assert [ s.map_label for s in streams ] == [ '[v0]', '[v2]', '[v4]', '[v5]' ]
+    assert ffmpeg_obj.getCmd().count('-filter_complex') == 1
+
+def test_stream_filter_follows_scaling():
+    snapshot = FFMPEGSnapshotStream(pathlib.Path('s.jpg'), interval=10, width=320)
+    stream = hls('hd.m3u8', 1280)
+    assert builder(stream, snapshot)._filter_graph().split(';') == [
+        '[0:v]scale=1280:-2,split=2[v0][v1]',
+        '[v1]scale=320:-2[v2]',
+        '[v2]fps=1/10[v3]',
+    ]
+    assert (stream.map_label, snapshot.map_label) == ('[v0]', '[v3]')
+
+def test_copy_is_not_decoded():
+    copy = hls('copy.m3u8', 640, 'copy', framerate=10)
+    scaled = hls('sd.m3u8', 640, framerate=10)
+    ffmpeg_obj = builder(copy, scaled)
+    assert ffmpeg_obj._filter_graph() == '[0:v]scale=640:-2[v0]'
+    assert (copy.map_label, scaled.map_label) == ('0:v', '[v0]')
+    # a remuxed stream keeps the framerate of the source and is not encoded
+    assert str(copy).startswith('-map 0:v -vcodec copy ')
+    assert '-r ' not in str(copy) and '-preset' not in str(copy)
+    assert '-r 10 ' in str(scaled)
+
+def test_copy_only_has_no_graph():
+    copy = hls('copy.m3u8', encoder='copy')
+    assert '-filter_complex' not in builder(copy).getCmd()
+    assert copy.map_label == '0:v'
+
+
+def test_default_profile():
+    assert latency_profile() == LATENCY_PROFILES['standard']
+    assert latency_profile('low') == LATENCY_PROFILES['low']
+
+def test_overrides():
+    profile = latency_profile(dict(profile='low', hls_time=3))
+    assert profile == dict(LATENCY_PROFILES['low'], hls_time=3)
+    # without 'profile' the overrides apply to the standard profile
+    assert latency_profile(dict(ring_size=4)) == dict(LATENCY_PROFILES['standard'], ring_size=4)
+
+def test_own_profiles():
+    profiles = dict(ultra=dict(hls_time=0.5, container='fmp4'))
+    profile = latency_profile('ultra', profiles)
+    # missing keys are taken from the standard profile
+    assert profile == dict(LATENCY_PROFILES['standard'], hls_time=0.5, container='fmp4')
+    # own profiles may replace the built-in ones
+    assert latency_profile('low', dict(low=dict(hls_time=3)))['hls_time'] == 3
+
+@pytest.mark.parametrize('latency', [ 'fastest', dict(profile='fastest'), dict(container='mkv') ])
+def test_invalid_profiles(latency):
+    with pytest.raises(ValueError):
+        latency_profile(latency)
+
+def test_low_latency_stream():
+    low = latency_profile('low')
+    stream = FFMPEGHlsStream(pathlib.Path('/hls/a.m3u8'), 'libx264', low['hls_time'], low['ring_size'],
+                             low['container'], low['keyframe_interval'], low['program_date_time'])
+    args = str(stream)
+    assert '-hls_time 2 ' in args and '-hls_list_size 8 ' in args
+    assert '-hls_flags delete_segments+temp_file+independent_segments+program_date_time ' in args
+    assert '-hls_segment_type fmp4 -hls_fmp4_init_filename a_init.mp4' in args
+    assert '-hls_segment_filename /hls/a.%03d.m4s' in args
+    # keyframes at the same timestamps in all renditions
+    assert '-force_key_frames expr:gte(t,n_forced*2)' in args
+
+def test_copy_stream_keeps_the_gop():
+    stream = FFMPEGHlsStream(pathlib.Path('/hls/a.m3u8'), 'copy', keyframe_interval=2)
+    assert '-force_key_frames' not in str(stream)
+    assert '-hls_segment_filename /hls/a.%03d.ts' in str(stream)
+
+def test_appended_playlist_stays_open():
+    # a process that replaces another one (activity switch) continues its playlist,
+    # the stopped process must not end it
+    stream = FFMPEGHlsStream(pathlib.Path('/hls/a.m3u8'), append=True)
+    assert '+append_list+omit_endlist ' in str(stream)
+    assert 'append_list' not in str(FFMPEGHlsStream(pathlib.Path('/hls/a.m3u8')))
@@ -0,0 +1,71 @@
+# -*- coding: utf8 -*-
+
+import os
+
+from ffmpeg_progress import ProgressParser, ProgressReader
+
+BLOCK = (b'frame=250\nfps=25.00\nstream_0_0_q=28.0\nstream_1_0_q=-1.0\nbitrate= 812.4kbits/s\n'
+         b'total_size=1015552\nout_time_us=10000000\nout_time=00:00:10.000000\n'
+         b'dup_frames=0\ndrop_frames=2\nspeed=1.01x\nprogress=continue\n')
+
+
+def test_block():
+    samples = ProgressParser().feed(BLOCK)
+    assert len(samples) == 1
+    sample = samples[0]
+    assert (sample['frame'], sample['fps'], sample['bitrate_kbps']) == (250, 25.0, 812.4)
+    assert (sample['total_size'], sample['out_time_us'], sample['out_time']) == (1015552, 10000000, '00:00:10.000000')
+    assert (sample['dup_frames'], sample['drop_frames'], sample['speed']) == (0, 2, 1.01)
+    assert sample['q'] == {'0_0': 28.0, '1_0': -1.0}
+    assert not sample['end']
+
+def test_split_reads():
+    parser = ProgressParser()
+    data = BLOCK + BLOCK.replace(b'frame=250', b'frame=275').replace(b'continue', b'end')
+    samples = list()
+    # the pipe delivers arbitrary chunks, lines and blocks are reassembled
+    for i in range(0, len(data), 7):
+        samples += parser.feed(data[i:i + 7])
+    assert [ (s['frame'], s['end']) for s in samples ] == [ (250, False), (275, True) ]
+
+def test_unknown_values():
+    sample = ProgressParser().feed(b'fps=0.00\nbitrate=N/A\nspeed=N/A\nout_time_ms=5\nprogress=continue\n')[0]
+    assert (sample['fps'], sample['bitrate_kbps'], sample['speed']) == (0, None, None)
+    # old ffmpeg versions only report out_time_ms (in microseconds)
+    assert sample['out_time_us'] == 5
+    assert sample['frame'] is None
+
+
+class Supervisor(object):
+    """Runs the readers of the ProgressReader on demand"""
+    def __init__(self):
+        self.readers = dict()
+
+    def add_reader(self, fd, callback):
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        del self.readers[fd]
+
+    def call_soon(self, fn):
+        fn()
+
+def test_reader():
+    supervisor = Supervisor()
+    r, w = os.pipe()
+    received = list()
+    reader = ProgressReader(supervisor, os.fdopen(r, 'rb'), received.append, size=2)
+    # nothing to read yet, the reader does not block
+    supervisor.readers[r]()
+    for fps in (b'20', b'24', b'28'):
+        os.write(w, BLOCK.replace(b'fps=25.00', b'fps=' + fps))
+    supervisor.readers[r]()
+    assert [ s['fps'] for s in received ] == [ 20, 24, 28 ]
+    # ring buffer of size samples
+    assert [ s['fps'] for s in reader.samples ] == [ 24, 28 ]
+    summary = reader.summary()
+    assert (summary['fps'], summary['samples'], summary['last']['fps']) == (26, 2, 28)
+    os.close(w)
+    supervisor.readers[r]()
+    # the exited process closes the pipe
+    assert r not in supervisor.readers
@@ -0,0 +1,24 @@
+# -*- coding: utf8 -*-
+
+import pytest
+
+from hls_origin import parse_range
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('bytes=0-99', (0, 99)),
+    ('bytes=100-', (100, 999)),
+    ('bytes=-100', (900, 999)),
+    ('bytes=-5000', (0, 999)),
+    ('bytes=990-5000', (990, 999)),
+    ('bytes=999-999', (999, 999)),
+    (' bytes = 10-20', (10, 20)),
+])
+def test_parse_range(value, expected):
+    assert parse_range(value, 1000) == expected
+
+@pytest.mark.parametrize('value', [
+    'bytes=1000-', 'bytes=50-10', 'bytes=0-1,5-9', 'items=0-1', 'bytes=a-b', 'bytes=', 'bytes=-',
+])
+def test_parse_range_invalid(value):
+    assert parse_range(value, 1000) is None
@@ -0,0 +1,83 @@
+# -*- coding: utf8 -*-
+
+import pytest
+
+from hls_playlist import HLSPlaylist, PlaylistItem, export_to_file
+
+
+def item(name, bandwidth, average=None, width=640, height=360):
+    return PlaylistItem(name, {'format': {'bit_rate': bandwidth, 'avg_bit_rate': average},
+                               'streams': [{'width': width, 'height': height}]})
+
+@pytest.fixture
+def changes():
+    return list()
+
+@pytest.fixture
+def playlist(changes):
+    return HLSPlaylist(lambda items: changes.append([ i.name for i in items ]))
+
+
+def test_ordered_by_bandwidth(playlist, changes):
+    playlist.update(item('b', 300))
+    playlist.update(item('a', 100))
+    playlist.update(item('c', 200))
+    assert [ i.name for i in playlist ] == [ 'a', 'c', 'b' ]
+    assert changes[-1] == [ 'a', 'c', 'b' ]
+    assert len(playlist) == 3 and 'c' in playlist
+
+def test_update_replaces_by_name(playlist, changes):
+    playlist.update(item('a', 100))
+    playlist.update(item('b', 200))
+    playlist.update(item('a', 300))
+    assert [ (i.name, i.bandwidth) for i in playlist ] == [ ('b', 200), ('a', 300) ]
+    assert changes == [ [ 'a' ], [ 'a', 'b' ], [ 'b', 'a' ] ]
+
+def test_unchanged_update_is_ignored(playlist, changes):
+    playlist.update(item('a', 100, 90))
+    playlist.update(item('a', 100, 90))
+    assert changes == [ [ 'a' ] ]
+
+def test_remove(playlist, changes):
+    playlist.update(item('a', 100))
+    playlist.update(item('b', 100))
+    playlist.remove('a')
+    assert [ i.name for i in playlist ] == [ 'b' ]
+    assert changes[-1] == [ 'b' ]
+    with pytest.raises(KeyError):
+        playlist.remove('a')
+
+def test_transaction_single_callback(playlist, changes):
+    with playlist.transaction():
+        playlist.update(item('a', 300))
+        with playlist.transaction():
+            playlist.update(item('b', 100))
+        playlist.remove('a')
+        playlist.update(item('c', 200))
+        assert changes == []
+    assert changes == [ [ 'b', 'c' ] ]
+    # an empty transaction does not call back
+    with playlist.transaction():
+        pass
+    assert len(changes) == 1
+
+
+def test_export_to_file(tmp_path):
+    master = tmp_path / 'master.m3u8'
+    export = export_to_file(master)
+    items = [ item('low.m3u8', 100000, 90000, 640, 360), item('high.m3u8', 2000000, None, 1920, 1080) ]
+    assert export(items)
+    assert master.read_text().splitlines() == [
+        '#EXTM3U',
+        '#EXT-X-INDEPENDENT-SEGMENTS',
+        '#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=100000,AVERAGE-BANDWIDTH=90000,RESOLUTION=640x360',
+        'low.m3u8',
+        '#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=2000000,RESOLUTION=1920x1080',
+        'high.m3u8',
+    ]
+    # the file is replaced (new inode), no temporary file is left behind
+    inode = master.stat().st_ino
+    assert not export(items)
+    assert export(items[:1])
+    assert master.stat().st_ino != inode
+    assert sorted(p.name for p in tmp_path.iterdir()) == [ 'master.m3u8' ]
@@ -0,0 +1,46 @@
+# -*- coding: utf8 -*-
+
+import pytest
+
+from latency_stats import percentile
+from measure_latency import parse_playlist, parse_date_time
+
+
+@pytest.mark.parametrize('p, expected', [ (0, 1), (50, 3), (95, 5), (100, 5) ])
+def test_percentile(p, expected):
+    assert percentile([ 5, 1, 4, 2, 3 ], p) == expected
+
+def test_percentile_without_samples():
+    assert percentile([], 50) is None
+
+
+def test_parse_master_playlist():
+    variants, _, _, segments = parse_playlist('\n'.join([
+        '#EXTM3U',
+        '#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=100000,RESOLUTION=640x360',
+        'low.m3u8',
+        '#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=900000,RESOLUTION=1280x720',
+        'high.m3u8',
+    ]))
+    assert variants == [ 'low.m3u8', 'high.m3u8' ] and segments == []
+
+def test_parse_media_playlist():
+    start = parse_date_time('2024-05-01T12:00:00.000+0200')
+    assert start == 1714557600.0
+    _, target, init, segments = parse_playlist('\n'.join([
+        '#EXTM3U',
+        '#EXT-X-TARGETDURATION:2',
+        '#EXT-X-MAP:URI="a_init.mp4"',
+        '#EXT-X-PROGRAM-DATE-TIME:2024-05-01T12:00:00.000+0200',
+        '#EXTINF:2.000000,',
+        'a.100.m4s',
+        '#EXTINF:1.500000,',
+        'a.101.m4s',
+        '#EXT-X-PROGRAM-DATE-TIME:2024-05-01T12:00:04.000+0200',
+        '#EXTINF:2.000000,',
+        'a.102.m4s',
+    ]))
+    assert (target, init) == (2, 'a_init.mp4')
+    # the date time of a segment without a tag follows from its predecessor
+    assert segments == [ ('a.100.m4s', 2.0, start), ('a.101.m4s', 1.5, start + 2),
+                         ('a.102.m4s', 2.0, start + 4) ]
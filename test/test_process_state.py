@@ -0,0 +1,111 @@
+# -*- coding: utf8 -*-
+
+import json
+import signal
+import subprocess
+
+import pytest
+
+from process_state import StateStore, AdoptedProcess, cfg_hash, proc_identity
+
+
+@pytest.fixture
+def spawn():
+    """Starts processes that outlive the test unless they are stopped"""
+    procs = list()
+    def spawn():
+        proc = subprocess.Popen([ 'sleep', '60' ])
+        procs.append(proc)
+        return proc
+    yield spawn
+    for proc in procs:
+        proc.kill()
+        proc.wait()
+
+def record(filename, cam_id, config_hash, *procs, idle=False):
+    """State file of a previous backend that ran procs for cam_id"""
+    store = StateStore(filename)
+    store.set_camera(cam_id, config_hash)
+    for idx, proc in enumerate(procs):
+        store.set_process(cam_id, idx, proc.pid, idle)
+    return store
+
+
+def test_cfg_hash():
+    assert cfg_hash(dict(a=1, b=[ 2 ])) == cfg_hash(dict(b=[ 2 ], a=1))
+    assert cfg_hash(dict(a=1)) != cfg_hash(dict(a=2))
+
+def test_proc_identity(spawn):
+    proc = spawn()
+    starttime, cmd_hash, state = proc_identity(proc.pid)
+    assert state in ('R', 'S')
+    # same command line, same hash
+    assert proc_identity(spawn().pid)[1] == cmd_hash
+    proc.kill()
+    proc.wait()
+    assert proc_identity(proc.pid) is None
+
+def test_adopt_running_processes(tmp_path, spawn):
+    first, second = spawn(), spawn()
+    record(tmp_path / 'state.json', 3, 'abc', first, second, idle=True)
+
+    store = StateStore(tmp_path / 'state.json')
+    assert store.cameras() == [ 3 ]
+    adopted = store.adopt(3, 'abc')
+    assert [ p.pid for p in adopted ] == [ first.pid, second.pid ]
+    assert all(isinstance(p, AdoptedProcess) and p.idle for p in adopted)
+    assert adopted[0].poll() is None
+    # a camera is adopted once
+    assert store.adopt(3, 'abc') is None
+
+    adopted[0].terminate()
+    # the test is the parent of the process, it is a zombie until it is reaped
+    assert first.wait(5) == -signal.SIGTERM
+    assert adopted[0].wait(5) == -1
+
+def test_dead_processes_are_not_adopted(tmp_path, spawn):
+    first, second = spawn(), spawn()
+    record(tmp_path / 'state.json', 1, 'abc', first, second)
+    first.kill()
+    first.wait()
+    adopted = StateStore(tmp_path / 'state.json').adopt(1, 'abc')
+    assert adopted[0] is None and adopted[1].pid == second.pid
+
+def test_reused_pid_is_not_adopted(tmp_path, spawn):
+    proc = spawn()
+    record(tmp_path / 'state.json', 1, 'abc', proc)
+    state = json.loads((tmp_path / 'state.json').read_text())
+    state['1']['processes']['0']['cmd_hash'] = 'another command'
+    (tmp_path / 'state.json').write_text(json.dumps(state))
+    assert StateStore(tmp_path / 'state.json').adopt(1, 'abc') == []
+    # the unrelated process is left alone
+    assert proc.poll() is None
+
+def test_changed_configuration_kills(tmp_path, spawn):
+    proc = spawn()
+    record(tmp_path / 'state.json', 1, 'abc', proc)
+    assert StateStore(tmp_path / 'state.json').adopt(1, 'def') is None
+    assert proc.wait(5) == -signal.SIGKILL
+
+def test_discard_kills(tmp_path, spawn):
+    proc = spawn()
+    record(tmp_path / 'state.json', 1, 'abc', proc)
+    StateStore(tmp_path / 'state.json').discard(1)
+    assert proc.wait(5) == -signal.SIGKILL
+
+def test_previous_cameras_stay_recorded(tmp_path, spawn):
+    proc = spawn()
+    record(tmp_path / 'state.json', 1, 'abc', proc)
+    store = StateStore(tmp_path / 'state.json')
+    store.set_camera(2, 'def')
+    # camera 1 was not adopted yet, a crash of this backend must not lose it
+    assert sorted(json.loads((tmp_path / 'state.json').read_text())) == [ '1', '2' ]
+    store.adopt(1, 'abc')
+    store.remove(2)
+    assert json.loads((tmp_path / 'state.json').read_text()) == dict()
+
+def test_missing_or_corrupt_state_file(tmp_path):
+    assert StateStore(tmp_path / 'state.json').cameras() == []
+    (tmp_path / 'state.json').write_text('{"1": ')
+    store = StateStore(tmp_path / 'state.json')
+    assert store.cameras() == [] and store.adopt(1, 'abc') is None
@@ -0,0 +1,217 @@
+# -*- coding: utf8 -*-
+
+import pytest
+
+import segment_analyser
+from segment_analyser import parse_sps, ts_resolution, mp4_resolution, segment_start_pts, m3u_get_segments, \
+                             SegmentProbeCache
+
+
+class BitWriter(object):
+    """Writes bits and Exp-Golomb codes, the inverse of BitReader"""
+    def __init__(self):
+        self.bits = list()
+
+    def u(self, n, value):
+        self.bits.extend((value >> (n - 1 - i)) & 1 for i in range(n))
+
+    def ue(self, value):
+        code = value + 1
+        n = code.bit_length()
+        self.u(n - 1, 0)
+        self.u(n, code)
+
+    def se(self, value):
+        self.ue(2 * value - 1 if value > 0 else -2 * value)
+
+    def rbsp(self):
+        # rbsp_stop_one_bit and alignment
+        bits = self.bits + [1]
+        bits += [0] * (-len(bits) % 8)
+        return bytes(int(''.join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits), 8))
+
+
+def emulation_prevention(rbsp):
+    out = bytearray()
+    zeros = 0
+    for byte in rbsp:
+        if zeros >= 2 and byte <= 3:
+            out.append(3)
+            zeros = 0
+        out.append(byte)
+        zeros = zeros + 1 if byte == 0 else 0
+    return bytes(out)
+
+def sps(width_mbs, height_units, profile=66, chroma=1, frame_mbs_only=1, crop=None,
+        scaling_matrix=False, poc_type=0):
+    w = BitWriter()
+    w.u(8, profile)
+    w.u(8, 0)
+    w.u(8, 40)
+    w.ue(0)
+    if profile in (100, 110, 122, 244):
+        w.ue(chroma)
+        if chroma == 3:
+            w.u(1, 0)
+        w.ue(0)
+        w.ue(0)
+        w.u(1, 0)
+        w.u(1, 1 if scaling_matrix else 0)
+        if scaling_matrix:
+            # first list present with a few deltas, the others absent
+            w.u(1, 1)
+            for delta in [ 1, -1, 0 ] + [ 0 ] * 13:
+                w.se(delta)
+            for _ in range(7 if chroma != 3 else 11):
+                w.u(1, 0)
+    w.ue(0)
+    w.ue(poc_type)
+    if poc_type == 0:
+        w.ue(2)
+    elif poc_type == 1:
+        w.u(1, 0)
+        w.se(-1)
+        w.se(2)
+        w.ue(2)
+        w.se(1)
+        w.se(-3)
+    w.ue(1)
+    w.u(1, 0)
+    w.ue(width_mbs - 1)
+    w.ue(height_units - 1)
+    w.u(1, frame_mbs_only)
+    if not frame_mbs_only:
+        w.u(1, 0)
+    w.u(1, 1)
+    w.u(1, 1 if crop else 0)
+    for value in crop or ():
+        w.ue(value)
+    w.u(1, 0) # vui_parameters_present_flag
+    return b'\x67' + emulation_prevention(w.rbsp())
+
+
+@pytest.mark.parametrize('nal, resolution', [
+    (sps(80, 45), (1280, 720)),
+    # 1088 coded lines, 8 cropped (4 units of 2 lines in 4:2:0)
+    (sps(120, 68, profile=100, crop=(0, 0, 0, 4)), (1920, 1080)),
+    (sps(40, 23, profile=100, crop=(0, 0, 0, 4), scaling_matrix=True), (640, 360)),
+    (sps(22, 18, poc_type=1), (352, 288)),
+    (sps(22, 18, poc_type=2), (352, 288)),
+    # interlaced: map units are field macroblock pairs
+    (sps(45, 18, frame_mbs_only=0, crop=(0, 0, 0, 0)), (720, 576)),
+    # 4:4:4: crop units of 1 pixel
+    (sps(120, 68, profile=244, chroma=3, crop=(1, 1, 0, 8)), (1918, 1080)),
+    # 4:0:0 (monochrome): crop units of 1 line
+    (sps(4, 3, profile=100, chroma=0, crop=(0, 0, 0, 1)), (64, 47)),
+])
+def test_parse_sps(nal, resolution):
+    assert parse_sps(nal) == resolution
+
+def test_parse_sps_emulation_prevention():
+    # the 30 leading zeros of the exp-golomb code need an emulation prevention byte
+    nal = sps(1 << 30, 1, crop=(0, 0, 0, 0))
+    assert b'\x00\x00\x03' in nal
+    assert parse_sps(nal) == (16 << 30, 16)
+
+
+def ts_packet(pid, payload, pusi=False):
+    header = bytes([ 0x47, (0x40 if pusi else 0) | (pid >> 8), pid & 0xff, 0x10 ])
+    packet = header + payload
+    assert len(packet) <= 188
+    if len(packet) < 188:
+        # adaptation field with stuffing
+        stuffing = 188 - len(packet)
+        header = bytes([ 0x47, (0x40 if pusi else 0) | (pid >> 8), pid & 0xff, 0x30 ])
+        adaptation = bytes([ stuffing - 1 ]) + (b'\x00' + b'\xff' * (stuffing - 2) if stuffing > 1 else b'')
+        packet = header + adaptation + payload
+    return packet
+
+def ts_segment(nal, pts=900000):
+    pat = b'\x00' + bytes([ 0x00, 0xb0, 0x0d, 0, 1, 0xc1, 0, 0, 0, 1, 0xe1, 0x00 ]) + b'\0' * 4
+    pmt = b'\x00' + bytes([ 0x02, 0xb0, 0x12, 0, 1, 0xc1, 0, 0, 0xe1, 0x01, 0xf0, 0x00,
+                            0x1b, 0xe1, 0x01, 0xf0, 0x00 ]) + b'\0' * 4
+    p = bytes([ 0x21 | ((pts >> 29) & 0x0e), (pts >> 22) & 0xff, ((pts >> 14) & 0xfe) | 1,
+                (pts >> 7) & 0xff, ((pts << 1) & 0xfe) | 1 ])
+    pes = b'\x00\x00\x01\xe0\x00\x00\x80\x80\x05' + p
+    es = b'\x00\x00\x00\x01\x09\xf0' + b'\x00\x00\x00\x01' + nal + b'\x00\x00\x00\x01\x68\xce\x38\x80'
+    return (ts_packet(0, pat, True) + ts_packet(0x100, pmt, True)
+            + ts_packet(0x101, pes + es[:150], True) + ts_packet(0x101, es[150:]))
+
+def test_ts_resolution(tmp_path):
+    segment = tmp_path / 'a.000.ts'
+    segment.write_bytes(ts_segment(sps(120, 68, profile=100, crop=(0, 0, 0, 4))))
+    assert ts_resolution(segment) == (1920, 1080)
+
+def test_ts_resolution_without_video(tmp_path):
+    segment = tmp_path / 'a.000.ts'
+    segment.write_bytes(ts_packet(0x1fff, b'\xff' * 184) * 4)
+    assert ts_resolution(segment) is None
+
+
+def write_playlist(directory, segments):
+    playlist = directory / 'a.m3u8'
+    lines = [ '#EXTM3U', '#EXT-X-TARGETDURATION:2' ]
+    for duration, name in segments:
+        lines += [ '#EXTINF:%g,' % (duration), name ]
+    playlist.write_text('\n'.join(lines) + '\n')
+    return playlist
+
+def test_m3u_get_segments(tmp_path):
+    playlist = write_playlist(tmp_path, [ (2.0, 'a.000.ts'), (1.5, 'a.001.ts') ])
+    assert m3u_get_segments(playlist) == [ (2.0, 'a.000.ts'), (1.5, 'a.001.ts') ]
+    assert m3u_get_segments(tmp_path / 'missing.m3u8') is None
+
+def test_probe_cache(tmp_path, monkeypatch):
+    analysed = list()
+    def counting_ts_resolution(filename):
+        analysed.append(filename.name)
+        return ts_resolution(filename)
+    monkeypatch.setattr(segment_analyser, 'ts_resolution', counting_ts_resolution)
+
+    data = ts_segment(sps(80, 45))
+    cache = SegmentProbeCache(window_size=2)
+    segments = list()
+    for i, (size, duration) in enumerate([ (1, 2.0), (3, 2.0), (2, 1.0) ]):
+        name = 'a.%03d.ts' % (i)
+        (tmp_path / name).write_bytes(data * size)
+        segments.append((duration, name))
+        result = cache.probe(write_playlist(tmp_path, segments[-2:]))
+    # every segment is analysed once
+    assert analysed == [ 'a.000.ts', 'a.001.ts', 'a.002.ts' ]
+    assert result['streams'] == [ { 'width': 1280, 'height': 720 } ]
+    # window of the last 2 segments: peak and average in bit/s
+    assert result['format']['bit_rate'] == len(data) * 2 * 8
+    assert result['format']['avg_bit_rate'] == int(len(data) * 5 * 8 / 3.0)
+
+def test_probe_empty_playlist(tmp_path):
+    assert SegmentProbeCache().probe(write_playlist(tmp_path, [])) is None
+
+
+def box(kind, payload):
+    return (8 + len(payload)).to_bytes(4, 'big') + kind + payload
+
+def test_mp4_resolution(tmp_path):
+    nal = sps(80, 45, profile=100)
+    avcc = bytes([ 1, 100, 0, 40, 0xff, 0xe1 ]) + len(nal).to_bytes(2, 'big') + nal + b'\x01\x00\x04\x68\xce\x38\x80'
+    init = tmp_path / 'p_init.mp4'
+    init.write_bytes(box(b'ftyp', b'iso5\0\0\0\0') + box(b'moov', box(b'avc1', b'\0' * 78 + box(b'avcC', avcc))))
+    assert mp4_resolution(init) == (1280, 720)
+
+def test_mp4_resolution_without_avcc(tmp_path):
+    init = tmp_path / 'p_init.mp4'
+    init.write_bytes(box(b'ftyp', b'iso5\0\0\0\0') + box(b'moov', box(b'hvc1', b'\0' * 78)))
+    assert mp4_resolution(init) is None
+
+
+def test_ts_start_pts(tmp_path):
+    segment = tmp_path / 'a.000.ts'
+    # 33 bit timestamp
+    segment.write_bytes(ts_segment(sps(80, 45), pts=(1 << 32) + 12345))
+    assert segment_start_pts(segment) == (1 << 32) + 12345
+
+@pytest.mark.parametrize('version, size', [ (0, 4), (1, 8) ])
+def test_fmp4_start_pts(tmp_path, version, size):
+    fragment = tmp_path / 'p.000.m4s'
+    tfdt = box(b'tfdt', bytes([ version, 0, 0, 0 ]) + (90000 * 3600).to_bytes(size, 'big'))
+    fragment.write_bytes(box(b'moof', box(b'traf', tfdt)) + box(b'mdat', b'\0' * 16))
+    assert segment_start_pts(fragment) == 90000 * 3600